@@ -0,0 +1,539 @@
+"""Офлайн-бенчмарк бота без реальных Instagram и Telegram.
+
+Поднимает в отдельном процессе два локальных сервера:
+  * фейковый ddinstagram + CDN: страницы рилсов (с мета-тегами или с видео, которое добавляет JS)
+    и mp4 с настраиваемой задержкой и скоростью;
+  * фейковый Telegram Bot API: getUpdates / sendVideo / sendMessage и остальные методы, которые вызывает бот.
+Сам бот (insta.py) запускается в этом процессе через обычный polling (или, с --webhook, через
+встроенный webhook-сервер: фейковый Bot API сам отправляет ему обновления), поэтому работают настоящие
+обработчики. Нагрузка - много пользователей, повторяющиеся ссылки и большие файлы.
+Результат - JSON с пропускной способностью, перцентилями задержки и пиковой памятью,
+который можно сохранить (--output) и сравнить с прошлым запуском (--compare).
+
+Пример:
+    python bench.py --users 50 --messages 4 --unique-reels 60 --output before.json
+    python bench.py --users 50 --messages 4 --unique-reels 60 --compare before.json
+    python bench.py --users 50 --messages 4 --unique-reels 60 --webhook
+Настройки бота задаются как обычно, через переменные окружения (STREAM_UPLOAD=0 python bench.py ...).
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from urllib.parse import parse_qs
+
+import aiohttp
+from aiohttp import web
+
+try:
+    import resource # Только для Unix: нужен для замера пиковой памяти
+except ImportError:
+    resource = None
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+TELEGRAM_FILE_LIMIT = 50 * 1024 * 1024 # Лимит загрузки для ботов в облачном Bot API
+PAYLOAD_BLOCK = os.urandom(1024 * 1024) # Из этого блока собираются mp4 любого размера
+
+def percentile(samples, fraction):
+    """Перцентиль по списку значений (fraction от 0 до 1), None для пустого списка."""
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def summarize(samples):
+    if not samples:
+        return {}
+    return {
+        'mean': sum(samples) / len(samples),
+        'p50': percentile(samples, 0.5),
+        'p90': percentile(samples, 0.9),
+        'p95': percentile(samples, 0.95),
+        'p99': percentile(samples, 0.99),
+        'max': max(samples),
+    }
+
+# --- Сценарий нагрузки ---
+def build_reels(args):
+    """Описание уникальных рилсов: shortcode -> вариант страницы и размер видео."""
+    rng = random.Random(args.seed)
+    reels = {}
+    for index in range(args.unique_reels):
+        shortcode = f"BENCH{index:05d}"
+        large = rng.random() < args.large_ratio
+        reels[shortcode] = {
+            'variant': 'js' if rng.random() < args.js_ratio else 'meta',
+            'size': int((args.large_size_mb if large else args.size_mb) * 1024 * 1024),
+        }
+    return reels
+
+def build_messages(args, reels):
+    """Сообщения пользователей. Популярные рилсы повторяются чаще (распределение Ципфа)."""
+    rng = random.Random(args.seed + 1)
+    shortcodes = list(reels)
+    weights = [1 / (rank + 1) ** args.zipf for rank in range(len(shortcodes))]
+    messages = []
+    for index in range(args.users * args.messages):
+        chosen = rng.choices(shortcodes, weights, k=args.links)
+        messages.append({
+            'chat_id': 100000 + index, # Свой чат у каждого сообщения - так задержка считается точно
+            'user_id': 1000 + index % args.users,
+            'text': ' '.join(f"https://www.instagram.com/reel/{shortcode}/?igsh=bench" for shortcode in chosen),
+        })
+    return messages
+
+# --- Фейковый ddinstagram и CDN ---
+class FakeInstagram:
+    def __init__(self, args, reels):
+        self.args = args
+        self.reels = reels
+        self.stats = {'page_requests': 0, 'cdn_requests': 0, 'cdn_bytes': 0}
+
+    async def page(self, request):
+        self.stats['page_requests'] += 1
+        await asyncio.sleep(self.args.page_latency)
+        shortcode = request.match_info['shortcode']
+        reel = self.reels.get(shortcode)
+        if reel is None:
+            return web.Response(status=404)
+        video_path = f"/videos/{shortcode}.mp4"
+        if reel['variant'] == 'meta':
+            html = (f'<html><head><meta property="og:video" content="{video_path}">'
+                    f'<meta name="twitter:player:stream" content="{video_path}"></head><body></body></html>')
+        else:
+            # Видео появляется только после выполнения JS - нужен браузер
+            html = ('<html><head></head><body><script>setTimeout(function () {'
+                    'var video = document.createElement("video");'
+                    f'video.src = "{video_path}"; document.body.appendChild(video);'
+                    '}, 50);</script></body></html>')
+        return web.Response(text=html, content_type='text/html')
+
+    async def video(self, request):
+        self.stats['cdn_requests'] += 1
+        reel = self.reels.get(request.match_info['shortcode'])
+        if reel is None:
+            return web.Response(status=404)
+        size = reel['size']
+        start, end, status = 0, size - 1, 200
+        range_header = request.headers.get('Range', '')
+        if range_header.startswith('bytes='):
+            first, _, last = range_header[6:].partition('-')
+            start = int(first or 0)
+            end = min(int(last), size - 1) if last else size - 1
+            status = 206
+        headers = {'Accept-Ranges': 'bytes', 'Content-Type': 'video/mp4'}
+        if status == 206:
+            headers['Content-Range'] = f"bytes {start}-{end}/{size}"
+        response = web.StreamResponse(status=status, headers=headers)
+        response.content_length = end - start + 1
+        await asyncio.sleep(self.args.cdn_latency)
+        await response.prepare(request)
+        chunk_size = 64 * 1024
+        bytes_per_second = self.args.cdn_bandwidth_mbps * 1024 * 1024 / 8
+        position = start
+        while position <= end:
+            length = min(chunk_size, end - position + 1)
+            offset = position % len(PAYLOAD_BLOCK)
+            chunk = (PAYLOAD_BLOCK[offset:] + PAYLOAD_BLOCK)[:length]
+            await response.write(chunk)
+            self.stats['cdn_bytes'] += length
+            position += length
+            if bytes_per_second:
+                await asyncio.sleep(length / bytes_per_second)
+        await response.write_eof()
+        return response
+
+# --- Фейковый Telegram Bot API ---
+class FakeBotApi:
+    def __init__(self, args):
+        self.args = args
+        self.updates = []
+        self.next_update_id = 1
+        self.new_updates = asyncio.Event()
+        self.enqueued_at = {} # chat_id -> время постановки сообщения
+        self.delivered_at = {} # chat_id -> время первого итогового ответа (видео или текст)
+        self.delivered_kind = {}
+        self.calls = {}
+        self.uploaded_bytes = 0
+        self.next_message_id = 1
+        self.next_file_id = 1
+        # Режим webhook: после setWebhook обновления отправляются боту POST-запросами, а не через getUpdates
+        self.webhook_url = None
+        self.webhook_secret = None
+        self.webhook_slots = None
+        self.webhook_errors = 0
+        self.inline_replies = 0
+        self._session = None
+        self._push_tasks = set()
+
+    def _message(self, chat_id, **extra):
+        message = {'message_id': self.next_message_id, 'date': int(time.time()),
+                   'chat': {'id': int(chat_id), 'type': 'private'}}
+        message.update(extra)
+        self.next_message_id += 1
+        return message
+
+    def _deliver(self, chat_id, kind):
+        chat_id = int(chat_id)
+        if chat_id in self.enqueued_at and chat_id not in self.delivered_at:
+            self.delivered_at[chat_id] = time.monotonic()
+            self.delivered_kind[chat_id] = kind
+
+    @staticmethod
+    def _ok(result):
+        return web.json_response({'ok': True, 'result': result})
+
+    async def _read_params(self, request):
+        """Параметры запроса: urlencoded-форма или multipart (файл читается с ограничением скорости)."""
+        params, file_size = {}, None
+        if request.content_type.startswith('multipart/'):
+            reader = await request.multipart()
+            bytes_per_second = self.args.upload_bandwidth_mbps * 1024 * 1024 / 8
+            while True:
+                part = await reader.next()
+                if part is None:
+                    break
+                if part.filename:
+                    file_size = file_size or 0 # В альбоме файлов несколько - считаем общий объем
+                    while True:
+                        chunk = await part.read_chunk(64 * 1024)
+                        if not chunk:
+                            break
+                        file_size += len(chunk)
+                        if bytes_per_second:
+                            await asyncio.sleep(len(chunk) / bytes_per_second)
+                else:
+                    params[part.name] = await part.text()
+        else:
+            body = await request.text()
+            params = {key: values[0] for key, values in parse_qs(body).items()}
+            params.update(request.query)
+        return params, file_size
+
+    async def handle(self, request):
+        params, file_size = await self._read_params(request)
+        return await self._call(request.match_info['method'], params, file_size)
+
+    async def _call(self, method, params, file_size=None):
+        self.calls[method] = self.calls.get(method, 0) + 1
+        chat_id = params.get('chat_id', 0)
+
+        if method == 'getUpdates':
+            offset = int(params.get('offset', 0))
+            self.updates = [update for update in self.updates if update['update_id'] >= offset]
+            if not self.updates:
+                self.new_updates.clear()
+                try:
+                    await asyncio.wait_for(self.new_updates.wait(), timeout=min(float(params.get('timeout', 1)), 1.0))
+                except asyncio.TimeoutError:
+                    pass
+            return self._ok(self.updates[:100])
+        if method == 'getMe':
+            return self._ok({'id': 1, 'is_bot': True, 'first_name': 'bench', 'username': 'bench_bot'})
+        if method == 'sendVideo':
+            if file_size is not None:
+                self.uploaded_bytes += file_size
+                if file_size > TELEGRAM_FILE_LIMIT:
+                    return web.json_response({'ok': False, 'error_code': 413,
+                                              'description': 'Request Entity Too Large'}, status=413)
+            self._deliver(chat_id, 'video')
+            file_id = params.get('video') or f"bench-file-{self.next_file_id}"
+            self.next_file_id += 1
+            return self._ok(self._message(chat_id, video={'file_id': file_id, 'file_unique_id': file_id,
+                                                          'width': 720, 'height': 1280, 'duration': 10}))
+        if method == 'sendMediaGroup':
+            if file_size is not None:
+                self.uploaded_bytes += file_size
+            self._deliver(chat_id, 'video')
+            messages = []
+            for media in json.loads(params.get('media', '[]')):
+                file_id = f"bench-file-{self.next_file_id}"
+                self.next_file_id += 1
+                messages.append(self._message(chat_id, video={'file_id': file_id, 'file_unique_id': file_id,
+                                                              'width': 720, 'height': 1280, 'duration': 10}))
+            return self._ok(messages)
+        if method == 'sendMessage':
+            text = params.get('text', '')
+            if not text.startswith('⏳'): # Сообщение о статусе - не итоговый ответ
+                self._deliver(chat_id, 'message')
+            return self._ok(self._message(chat_id, text=text))
+        if method == 'editMessageText':
+            text = params.get('text', '')
+            if not text.startswith('⏳'): # Статус заменен итоговым ответом (например, очередь пользователя заполнена)
+                self._deliver(chat_id, 'message')
+            return self._ok(self._message(chat_id, text=text))
+        if method == 'setWebhook':
+            self.webhook_url = params['url']
+            self.webhook_secret = params.get('secret_token')
+            self.webhook_slots = asyncio.Semaphore(int(params.get('max_connections', 40)))
+            pending, self.updates = self.updates, []
+            for update in pending:
+                self._push(update)
+            return self._ok(True)
+        return self._ok(True) # deleteMessage, sendChatAction и т.п.
+
+    def _push(self, update):
+        task = asyncio.ensure_future(self._post_update(update))
+        self._push_tasks.add(task)
+        task.add_done_callback(self._push_tasks.discard)
+
+    async def _post_update(self, update):
+        """Как Telegram: POST обновления на адрес webhook с секретом; ответ с method - это вызов Bot API."""
+        if self._session is None:
+            self._session = aiohttp.ClientSession()
+        headers = {}
+        if self.webhook_secret:
+            headers['X-Telegram-Bot-Api-Secret-Token'] = self.webhook_secret
+        async with self.webhook_slots:
+            try:
+                async with self._session.post(self.webhook_url, json=update, headers=headers) as response:
+                    if response.status != 200:
+                        self.webhook_errors += 1
+                        return
+                    reply = await response.json() if response.content_type == 'application/json' else None
+            except aiohttp.ClientError:
+                self.webhook_errors += 1
+                return
+        if reply and reply.get('method'):
+            self.inline_replies += 1
+            method = reply.pop('method')
+            await self._call(method, {key: str(value) for key, value in reply.items()})
+
+    async def enqueue(self, request):
+        """Служебный метод бенчмарка: добавляет входящие сообщения пользователей в getUpdates."""
+        for item in await request.json():
+            self.enqueued_at[item['chat_id']] = time.monotonic()
+            self.updates.append({'update_id': self.next_update_id, 'message': {
+                'message_id': self.next_update_id, 'date': int(time.time()),
+                'chat': {'id': item['chat_id'], 'type': 'private'},
+                'from': {'id': item['user_id'], 'is_bot': False, 'first_name': 'bench',
+                         'username': f"bench_user_{item['user_id']}"},
+                'text': item['text'],
+            }})
+            self.next_update_id += 1
+            if self.webhook_url:
+                self._push(self.updates.pop())
+        self.new_updates.set()
+        return web.json_response({'ok': True})
+
+    def latencies(self):
+        return [self.delivered_at[chat_id] - self.enqueued_at[chat_id] for chat_id in self.delivered_at]
+
+def run_fake_servers(args, reels, instagram_port, api_port, ready):
+    """Точка входа процесса с фейковыми серверами. Статистика отдается по GET /_stats на сервере Bot API."""
+    async def serve():
+        instagram = FakeInstagram(args, reels)
+        api = FakeBotApi(args)
+
+        async def stats(request):
+            latencies = api.latencies()
+            times = list(api.enqueued_at.values()) + list(api.delivered_at.values())
+            return web.json_response({
+                'enqueued': len(api.enqueued_at),
+                'completed': len(api.delivered_at),
+                'videos': sum(1 for kind in api.delivered_kind.values() if kind == 'video'),
+                'text_replies': sum(1 for kind in api.delivered_kind.values() if kind == 'message'),
+                'latencies': latencies,
+                'span': (max(times) - min(times)) if times else 0.0,
+                'uploaded_bytes': api.uploaded_bytes,
+                'api_calls': api.calls,
+                'webhook_errors': api.webhook_errors,
+                'inline_replies': api.inline_replies,
+                'instagram': instagram.stats,
+            })
+
+        instagram_app = web.Application()
+        instagram_app.router.add_get('/reel/{shortcode}/', instagram.page)
+        instagram_app.router.add_get('/videos/{shortcode}.mp4', instagram.video)
+        api_app = web.Application(client_max_size=4 * 1024 ** 3)
+        api_app.router.add_post('/_enqueue', api.enqueue)
+        api_app.router.add_get('/_stats', stats)
+        api_app.router.add_route('*', '/bot{token}/{method}', api.handle)
+        runners = []
+        for app, port in ((instagram_app, instagram_port), (api_app, api_port)):
+            runner = web.AppRunner(app, access_log=None)
+            await runner.setup()
+            await web.TCPSite(runner, '127.0.0.1', port).start()
+            runners.append(runner)
+        ready.set()
+        await asyncio.Event().wait()
+
+    asyncio.run(serve())
+
+# --- Запуск бота под нагрузкой ---
+def prepare_bot_dir(args):
+    """Временная папка с файлами бота: токен, администратор и разрешенные пользователи (по числовому id)."""
+    bot_dir = tempfile.mkdtemp(prefix='insta-bench-')
+    with open(os.path.join(bot_dir, 'bot-token.txt'), 'w') as f:
+        f.write('123456:BENCHMARK')
+    with open(os.path.join(bot_dir, 'adm.txt'), 'w') as f:
+        f.write('bench_admin')
+    with open(os.path.join(bot_dir, 'users.txt'), 'w') as f:
+        f.writelines(f"{1000 + index}\n" for index in range(args.users))
+    return bot_dir
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR,
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+async def drive_load(args, messages, api_url):
+    async with aiohttp.ClientSession() as session:
+        if args.rate:
+            for message in messages:
+                await session.post(f"{api_url}/_enqueue", json=[message])
+                await asyncio.sleep(1 / args.rate)
+        else:
+            await session.post(f"{api_url}/_enqueue", json=messages) # Все сообщения разом
+        deadline = time.monotonic() + args.timeout
+        while True:
+            async with session.get(f"{api_url}/_stats") as response:
+                stats = await response.json()
+            if stats['completed'] >= len(messages) or time.monotonic() > deadline:
+                return stats
+            await asyncio.sleep(0.2)
+
+async def run_benchmark(args):
+    reels = build_reels(args)
+    messages = build_messages(args, reels)
+    api_url = f"http://127.0.0.1:{args.api_port}"
+
+    ready = multiprocessing.Event()
+    servers = multiprocessing.Process(target=run_fake_servers,
+                                      args=(args, reels, args.instagram_port, args.api_port, ready), daemon=True)
+    servers.start()
+    if not ready.wait(10):
+        raise RuntimeError("Фейковые серверы не запустились")
+
+    bot_dir = prepare_bot_dir(args)
+    os.environ['BOT_DIR'] = bot_dir
+    os.environ['BOT_API_URL'] = api_url
+    os.environ['MIRROR_HOSTS'] = f"http://127.0.0.1:{args.instagram_port}"
+    os.environ['SPOOL_DIR'] = os.path.join(bot_dir, 'spool') # Временные файлы удалятся вместе с папкой бенчмарка
+    if args.webhook:
+        os.environ['WEBHOOK_URL'] = f"http://127.0.0.1:{args.webhook_port}"
+        os.environ['WEBHOOK_LISTEN'] = '127.0.0.1'
+        os.environ['WEBHOOK_PORT'] = str(args.webhook_port)
+    sys.path.insert(0, REPO_DIR)
+    import insta # Импорт только после настройки окружения: insta.py читает его при загрузке
+    insta.load_bot_files()
+    insta.open_storage()
+    insta.report_startup() # Время импорта попадет в stages как этап import
+
+    rss_before = peak_rss_mb()
+    if args.warm_browser:
+        await insta.browser_manager.start()
+    if args.webhook:
+        receiver = asyncio.ensure_future(insta.run_webhook()) # Фейковый setWebhook запомнит адрес и секрет
+    else:
+        receiver = asyncio.ensure_future(insta.run_polling(timeout=1, skip_pending=False))
+    started = time.monotonic()
+    try:
+        stats = await drive_load(args, messages, api_url)
+    finally:
+        receiver.cancel()
+        await asyncio.gather(receiver, return_exceptions=True)
+        await insta.browser_manager.close()
+        await insta.close_http_session()
+        await insta.bot.close_session()
+        servers.terminate()
+        shutil.rmtree(bot_dir, ignore_errors=True)
+    wall_time = time.monotonic() - started
+
+    stages = {}
+    for (name, labels), histogram in insta.metrics.histograms.items():
+        if name == 'stage_seconds':
+            stages[dict(labels)['stage']] = {'count': histogram.count, 'p50': histogram.quantile(0.5),
+                                             'p95': histogram.quantile(0.95), 'p99': histogram.quantile(0.99)}
+    return {
+        'commit': git_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'config': vars(args),
+        'bot_env': {key: value for key, value in os.environ.items()
+                    if key in ('STREAM_UPLOAD', 'JOB_CONCURRENCY', 'BROWSER_POOL_SIZE', 'RANGE_PARTS', 'STREAM_MEMORY_LIMIT')},
+        'messages': len(messages),
+        'completed': stats['completed'],
+        'videos_sent': stats['videos'],
+        'text_replies': stats['text_replies'],
+        'wall_time_s': wall_time,
+        'throughput_msg_s': stats['completed'] / stats['span'] if stats['span'] else None,
+        'latency_s': summarize(stats['latencies']),
+        'peak_rss_mb': peak_rss_mb(),
+        'rss_before_load_mb': rss_before,
+        'uploaded_bytes': stats['uploaded_bytes'],
+        'instagram': stats['instagram'],
+        'api_calls': stats['api_calls'],
+        'webhook_errors': stats['webhook_errors'],
+        'inline_replies': stats['inline_replies'],
+        'stages': stages,
+    }
+
+def compare(report, baseline):
+    """Печатает изменение основных показателей относительно прошлого отчета."""
+    rows = [('throughput_msg_s', report['throughput_msg_s'], baseline.get('throughput_msg_s')),
+            ('peak_rss_mb', report['peak_rss_mb'], baseline.get('peak_rss_mb'))]
+    for key in ('p50', 'p95', 'p99'):
+        rows.append((f"latency_{key}_s", report['latency_s'].get(key), baseline.get('latency_s', {}).get(key)))
+    print(f"Сравнение с {baseline.get('commit')}:", file=sys.stderr)
+    for name, new, old in rows:
+        if new is None or not old:
+            print(f"  {name}: {new} (было {old})", file=sys.stderr)
+        else:
+            print(f"  {name}: {old:.3f} -> {new:.3f} ({(new - old) * 100 / old:+.1f}%)", file=sys.stderr)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарк insta.py с фейковыми ddinstagram и Bot API.")
+    parser.add_argument('--users', type=int, default=20, help="число пользователей")
+    parser.add_argument('--messages', type=int, default=3, help="сообщений со ссылкой от каждого пользователя")
+    parser.add_argument('--links', type=int, default=1, help="ссылок в одном сообщении (больше 1 - отправка альбомами)")
+    parser.add_argument('--unique-reels', type=int, default=30, help="уникальных рилсов (меньше - больше повторов)")
+    parser.add_argument('--zipf', type=float, default=1.0, help="насколько популярные рилсы повторяются чаще")
+    parser.add_argument('--size-mb', type=float, default=5, help="размер обычного видео")
+    parser.add_argument('--large-ratio', type=float, default=0.1, help="доля больших видео")
+    parser.add_argument('--large-size-mb', type=float, default=40, help="размер большого видео")
+    parser.add_argument('--js-ratio', type=float, default=0.0, help="доля страниц, где видео добавляет JS (нужен Chromium)")
+    parser.add_argument('--page-latency', type=float, default=0.05, help="задержка страницы ddinstagram, с")
+    parser.add_argument('--cdn-latency', type=float, default=0.02, help="задержка первого байта CDN, с")
+    parser.add_argument('--cdn-bandwidth-mbps', type=float, default=400, help="скорость CDN на соединение, Мбит/с (0 - без ограничения)")
+    parser.add_argument('--upload-bandwidth-mbps', type=float, default=200, help="скорость загрузки в Bot API, Мбит/с (0 - без ограничения)")
+    parser.add_argument('--rate', type=float, default=0, help="сообщений в секунду (0 - все сразу)")
+    parser.add_argument('--timeout', type=float, default=300, help="сколько ждать обработки всех сообщений, с")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--instagram-port', type=int, default=18081)
+    parser.add_argument('--api-port', type=int, default=18082)
+    parser.add_argument('--webhook', action='store_true', help="получать обновления через webhook вместо polling")
+    parser.add_argument('--webhook-port', type=int, default=18083)
+    parser.add_argument('--warm-browser', action='store_true', help="запустить Chromium до начала нагрузки")
+    parser.add_argument('--output', help="куда сохранить JSON-отчет (по умолчанию - stdout)")
+    parser.add_argument('--compare', help="JSON-отчет прошлого запуска для сравнения")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    report = asyncio.run(run_benchmark(args))
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report, json.load(f))
+
+if __name__ == '__main__':
+    main()
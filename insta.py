@@ -1,45 +1,82 @@
+import time
+IMPORT_STARTED = time.perf_counter() # Для замера холодного старта: сколько заняли импорт и загрузка скрипта
 import telebot
 import os
 from telebot.async_telebot import AsyncTeleBot
+from telebot import asyncio_helper
 import asyncio
 import sys
 import aiohttp
 import tempfile
 import shutil # Оставим импорт, хотя в новой функции он не используется
-from bs4 import BeautifulSoup
-from urllib.parse import urlparse # <<< Добавлен импорт
+from urllib.parse import urlparse, urljoin # <<< Добавлен импорт
 import traceback # <<< Добавлен импорт
-from playwright.async_api import async_playwright
+import contextlib
+import functools
+import re
+import sqlite3
+import threading
+import collections
+import bisect
+import contextvars
+import secrets
+import hashlib
+import base64
+import json
+import socket
+import signal
+# Playwright, BeautifulSoup и aiohttp.web импортируются там, где используются: без них быстрее холодный старт
+try:
+    import resource # Только для Unix: нужен для замера пиковой памяти
+except ImportError:
+    resource = None
+
+# --- Папка с файлами бота (токен, администратор, пользователи, кэш) ---
+# По умолчанию - папка скрипта; BOT_DIR позволяет запустить бота с другим набором файлов (например, в бенчмарке)
+BOT_DIR = os.environ.get('BOT_DIR') or os.path.dirname(os.path.abspath(__file__))
 
 # --- Чтение токена бота из файла ---
-try:
-    # Используем относительный путь, если скрипт и файл в одной папке
-    token_file_path = os.path.join(os.path.dirname(__file__), 'bot-token.txt')
-    if not os.path.exists(token_file_path):
-        # Если не найден рядом, пробуем абсолютный путь (как в оригинале)
-        token_file_path = 'bot-token.txt'
-
-    with open(token_file_path, 'r') as file:
-        botToken = file.read().strip() # .strip() удаляет пробелы и переносы строк
-except FileNotFoundError:
-    print(f"Ошибка: Файл токена 'bot-token.txt' не найден.")
-    print("Пожалуйста, убедитесь, что файл существует в той же папке, что и скрипт, или по пути 'bot-token.txt'.")
-    sys.exit(1) # Используем ненулевой код выхода для ошибок
-except OSError as e:
-    print(f"Ошибка при чтении файла токена 'bot-token.txt': {e}")
-    sys.exit(1)
-
-if not botToken:
-    print("Ошибка: Токен не найден в файле 'bot-token.txt'.")
-    print("Пожалуйста, добавьте валидный токен в файл.")
-    sys.exit(1)
+def read_bot_token():
+    """Читает токен бота из файла bot-token.txt."""
+    try:
+        # Используем относительный путь, если скрипт и файл в одной папке
+        token_file_path = os.path.join(BOT_DIR, 'bot-token.txt')
+        if not os.path.exists(token_file_path):
+            # Если не найден рядом, пробуем абсолютный путь (как в оригинале)
+            token_file_path = 'bot-token.txt'
+
+        with open(token_file_path, 'r') as file:
+            botToken = file.read().strip() # .strip() удаляет пробелы и переносы строк
+    except FileNotFoundError:
+        print(f"Ошибка: Файл токена 'bot-token.txt' не найден.")
+        print("Пожалуйста, убедитесь, что файл существует в той же папке, что и скрипт, или по пути 'bot-token.txt'.")
+        sys.exit(1) # Используем ненулевой код выхода для ошибок
+    except OSError as e:
+        print(f"Ошибка при чтении файла токена 'bot-token.txt': {e}")
+        sys.exit(1)
+
+    if not botToken:
+        print("Ошибка: Токен не найден в файле 'bot-token.txt'.")
+        print("Пожалуйста, добавьте валидный токен в файл.")
+        sys.exit(1)
+
+    return botToken
 
 # --- Запуск бота в асинхронном режиме ---
-print("Запуск бота...")
-bot = AsyncTeleBot(botToken)
+# Адрес Bot API можно переопределить (например, для локального тестового сервера)
+BOT_API_URL = os.environ.get('BOT_API_URL')
+if BOT_API_URL:
+    asyncio_helper.API_URL = BOT_API_URL.rstrip('/') + '/bot{0}/{1}'
+# Собственный сервер Bot API, запущенный с --local на этой же машине: файлы до 2000 МБ,
+# видео отправляется по пути к файлу на диске, без копирования байтов через multipart
+BOT_API_LOCAL = os.environ.get('BOT_API_LOCAL', '0') == '1'
+BOT_API_LOCAL_DIR = os.environ.get('BOT_API_LOCAL_DIR') or None # Папка для видео, доступная серверу Bot API по тому же пути
+# Максимальный размер видео для отправки; ссылки на файлы больше лимита даже не скачиваются
+TELEGRAM_UPLOAD_LIMIT = int(os.environ.get('TELEGRAM_UPLOAD_LIMIT', '0')) or (2000 if BOT_API_LOCAL else 50) * 1024 * 1024
+bot = AsyncTeleBot('', validate_token=False) # Токен подставляет load_bot_files() при запуске, а не при импорте
 
 # --- Администратор бота ---
-ADMIN_FILE = os.path.join(os.path.dirname(__file__), 'adm.txt') # Файл, где хранится username администратора
+ADMIN_FILE = os.path.join(BOT_DIR, 'adm.txt') # Файл, где хранится username администратора
 
 def read_admin_username():
     """Читает username администратора из файла adm.txt."""
@@ -63,190 +100,1907 @@ def read_admin_username():
 
     return admin_username
 
-ADMIN_USERNAME = read_admin_username() # Читаем username администратора из файла
+ADMIN_USERNAME = None # Читается из файла в load_bot_files()
+
+def load_bot_files():
+    """Читает токен и username администратора. Вызывается при запуске бота или воркера, а не при импорте модуля."""
+    global ADMIN_USERNAME
+    token = read_bot_token()
+    try:
+        telebot.util.validate_token(token)
+    except ValueError as e:
+        print(f"Ошибка: неверный токен в файле 'bot-token.txt': {e}")
+        sys.exit(1)
+    bot.token = token
+    bot.bot_id = telebot.util.extract_bot_id(token)
+    ADMIN_USERNAME = read_admin_username() # Читаем username администратора из файла
 
 # --- Файлы для управления пользователями и доступом ---
-USERS_FILE = os.path.join(os.path.dirname(__file__), 'users.txt')
-ACCESS_LOG_FILE = os.path.join(os.path.dirname(__file__), 'access.txt')
+USERS_FILE = os.path.join(BOT_DIR, 'users.txt')
+ACCESS_LOG_FILE = os.path.join(BOT_DIR, 'access.txt')
 
-# --- Функции для работы с файлом users.txt (храним usernames) ---
-def read_users_file():
-    """Читает список usernames из файла users.txt."""
-    users = []
-    if os.path.exists(USERS_FILE):
-        try:
-            with open(USERS_FILE, 'r') as f:
-                for line in f:
-                    username = line.strip()
-                    if username: # Добавляем только непустые строки
-                        users.append(username)
+# --- Метрики: время этапов, счетчики и эндпоинт /metrics для Prometheus ---
+METRICS_PORT = int(os.environ.get('METRICS_PORT', '0')) # 0 - HTTP-эндпоинт /metrics выключен
+METRICS_PREFIX = 'insta_bot_'
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300) # Секунды
+SIZE_BUCKETS = tuple(mb * 1024 * 1024 for mb in (0.5, 1, 2, 5, 10, 20, 30, 50, 100, 200, 500, 2000)) # Байты
+QUANTILES = (0.5, 0.95, 0.99)
+
+class Histogram:
+    """Гистограмма с фиксированными корзинами: запись - один bisect, память не растет."""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # Последняя корзина - все, что больше максимальной границы
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Оценка квантиля линейной интерполяцией внутри корзины."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        cumulative = 0
+        for index, count in enumerate(self.counts):
+            if count and cumulative + count >= rank:
+                lower = self.buckets[index - 1] if index > 0 else 0.0
+                upper = self.buckets[index] if index < len(self.buckets) else self.buckets[-1]
+                return lower + (upper - lower) * (rank - cumulative) / count
+            cumulative += count
+        return self.buckets[-1]
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+
+class Metrics:
+    """Счетчики и гистограммы процесса в формате Prometheus."""
+
+    def __init__(self):
+        self.counters = {} # (имя, метки) -> значение
+        self.histograms = {} # (имя, метки) -> Histogram
+
+    def count(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram(buckets)
+        histogram.observe(value)
+
+    @contextlib.contextmanager
+    def stage(self, stage):
+        """Замеряет время этапа обработки (работает и вокруг await)."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            self.observe('stage_seconds', elapsed, stage=stage)
+            trace = _trace.get()
+            if trace is not None:
+                trace.append((stage, elapsed))
+
+    def render(self):
+        """Текст для /metrics в формате Prometheus."""
+        lines = []
+        declared = set()
+        for (name, labels), value in sorted(self.counters.items()):
+            if name not in declared:
+                lines.append(f"# TYPE {METRICS_PREFIX}{name} counter")
+                declared.add(name)
+            lines.append(f"{METRICS_PREFIX}{name}{_format_labels(labels)} {value}")
+        names = sorted({name for name, _ in self.histograms})
+        for name in names:
+            # Метки одной метрики должны идти подряд: сначала сама гистограмма, затем квантили отдельной метрикой
+            series = sorted((labels, histogram) for (hist_name, labels), histogram in self.histograms.items() if hist_name == name)
+            full_name = METRICS_PREFIX + name
+            lines.append(f"# TYPE {full_name} histogram")
+            for labels, histogram in series:
+                cumulative = 0
+                for bound, count in zip(histogram.buckets + (float('inf'),), histogram.counts):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append(f"{full_name}_bucket{_format_labels(labels + (('le', le),))} {cumulative}")
+                lines.append(f"{full_name}_sum{_format_labels(labels)} {histogram.sum}")
+                lines.append(f"{full_name}_count{_format_labels(labels)} {histogram.count}")
+            lines.append(f"# TYPE {full_name}_quantile gauge")
+            for labels, histogram in series:
+                for q in QUANTILES:
+                    lines.append(f"{full_name}_quantile{_format_labels(labels + (('quantile', str(q)),))} {histogram.quantile(q)}")
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+
+# --- Отладочная трассировка запросов отдельных пользователей (/trace) ---
+# Для пользователей из этого набора каждый запрос печатает время всех своих этапов.
+trace_users = {user.strip().lstrip('@') for user in os.environ.get('TRACE_USERS', '').split(',') if user.strip()}
+_trace = contextvars.ContextVar('trace', default=None)
+
+def start_trace(message: telebot.types.Message):
+    """Включает трассировку текущего запроса, если пользователь в trace_users. Возвращает список этапов или None."""
+    user = message.from_user
+    if str(user.id) in trace_users or (user.username and user.username in trace_users):
+        trace = []
+        _trace.set(trace)
+        return trace
+    return None
+
+def print_trace(trace, message: telebot.types.Message):
+    if trace is None:
+        return
+    user_text = f"@{message.from_user.username}" if message.from_user.username else str(message.from_user.id)
+    stages = ", ".join(f"{stage}={seconds:.3f}с" for stage, seconds in trace)
+    print(f"[trace {user_text}] {stages}")
+
+async def handle_metrics(request):
+    from aiohttp import web
+    return web.Response(text=metrics.render(), content_type='text/plain', charset='utf-8')
+
+async def start_metrics_server():
+    """Поднимает HTTP-сервер с /metrics, если задан METRICS_PORT. Возвращает runner для остановки."""
+    if not METRICS_PORT:
+        return None
+    from aiohttp import web # Серверная часть aiohttp нужна только с METRICS_PORT или WEBHOOK_URL
+    app = web.Application()
+    app.router.add_get('/metrics', handle_metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, '0.0.0.0', METRICS_PORT).start()
+    print(f"Метрики доступны на :{METRICS_PORT}/metrics")
+    return runner
+
+# --- Хранилище пользователей и лога доступа в памяти ---
+class LineSetStore:
+    """Множество строк из текстового файла (одна запись на строку), загруженное в память.
+
+    Файл перечитывается, только если изменилось его время модификации (например, его
+    отредактировали вручную). Добавление в лог - дозапись в конец файла, удаление -
+    атомарная перезапись через временный файл и os.replace.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._items = [] # Порядок как в файле - для /list
+        self._set = set()
+        self._mtime = None
+
+    def _stat_mtime(self):
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def _refresh(self):
+        mtime = self._stat_mtime()
+        if mtime == self._mtime:
+            return
+        items = []
+        if mtime is not None:
+            try:
+                with open(self.path, 'r') as f:
+                    items = [line.strip() for line in f if line.strip()] # Только непустые строки
+            except OSError as e:
+                print(f"Ошибка чтения файла {self.path}: {e}")
+                return # Оставляем то, что уже было загружено
+        self._items = list(dict.fromkeys(items))
+        self._set = set(self._items)
+        self._mtime = mtime
+
+    def items(self):
+        self._refresh()
+        return list(self._items)
+
+    def __contains__(self, item):
+        self._refresh()
+        return item in self._set
+
+    def append(self, item):
+        """Добавляет запись дозаписью в конец файла. Возвращает False, если она уже есть."""
+        self._refresh()
+        if item in self._set:
+            return False
+        try:
+            with open(self.path, 'a+b') as f:
+                line = item.encode() + b'\n'
+                if f.tell() > 0:
+                    f.seek(-1, os.SEEK_END)
+                    if f.read(1) != b'\n': # Файл правили вручную и не поставили перенос в конце
+                        line = b'\n' + line
+                f.write(line)
         except OSError as e:
-            print(f"Ошибка чтения файла пользователей {USERS_FILE}: {e}")
-            # Не выходим из программы, но список будет пуст
-    return users
+            print(f"Ошибка записи в файл {self.path}: {e}")
+            return False
+        self._items.append(item)
+        self._set.add(item)
+        self._mtime = self._stat_mtime()
+        return True
 
-def write_users_file(users):
-    """Записывает список usernames в файл users.txt."""
-    try:
-        with open(USERS_FILE, 'w') as f:
-            for username in users:
-                f.write(username + '\n')
-    except OSError as e:
-        print(f"Ошибка записи в файл пользователей {USERS_FILE}: {e}")
+    def remove(self, item):
+        """Удаляет запись и атомарно перезаписывает файл. Возвращает False, если записи не было."""
+        self._refresh()
+        if item not in self._set:
+            return False
+        items = [existing for existing in self._items if existing != item]
+        temp_path = f"{self.path}.tmp"
+        try:
+            with open(temp_path, 'w') as f:
+                f.writelines(existing + '\n' for existing in items)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, self.path)
+        except OSError as e:
+            print(f"Ошибка записи в файл {self.path}: {e}")
+            return False
+        self._items = items
+        self._set.discard(item)
+        self._mtime = self._stat_mtime()
+        return True
+
+users_store = LineSetStore(USERS_FILE)
+access_store = LineSetStore(ACCESS_LOG_FILE)
+
+# --- Функции для работы с users.txt (храним usernames или числовые id пользователей) ---
+def read_users_file():
+    """Возвращает список пользователей из users.txt (из памяти, файл перечитывается только при изменении)."""
+    return users_store.items()
 
 def add_user_to_file(username):
-    """Добавляет username в файл users.txt."""
-    users = read_users_file()
-    if username not in users:
-        users.append(username)
-        write_users_file(users)
-        return True
-    return False
+    """Добавляет username (или числовой id) в файл users.txt."""
+    return users_store.append(username)
 
 def delete_user_from_file(username):
-    """Удаляет username из файла users.txt."""
-    users = read_users_file()
-    if username in users:
-        users.remove(username)
-        write_users_file(users)
-        return True
-    return False
+    """Удаляет username (или числовой id) из файла users.txt."""
+    return users_store.remove(username)
+
+def display_user(user_key):
+    """Как показывать пользователя в ответах: username с @, числовой id - как есть."""
+    return user_key if user_key.isdigit() else f"@{user_key}"
 
 def is_user_authorized(message: telebot.types.Message):
-    """Проверяет, авторизован ли пользователь (есть ли его username в users.txt)."""
-    authorized_users = read_users_file()
+    """Проверяет, авторизован ли пользователь: по числовому id или по username из users.txt."""
+    # Числовой id не меняется, поэтому работает и без username, и после смены username
+    if str(message.from_user.id) in users_store:
+        return True
     username = message.from_user.username
-    # Добавим проверку на случай, если у пользователя нет username (@...)
     if username:
-        return username in authorized_users
-    else:
-        print(f"Предупреждение: У пользователя {message.from_user.id} ({message.from_user.first_name}) нет username.")
-        return False # Пользователи без username не могут быть авторизованы по этой логике
+        return username in users_store
+    print(f"Предупреждение: У пользователя {message.from_user.id} ({message.from_user.first_name}) нет username.")
+    return False
 
-# --- Функция для логирования доступа в access.txt (логируем usernames) ---
+# --- Функция для логирования доступа в access.txt ---
 def log_access(message: telebot.types.Message):
-    """Логирует username в access.txt, только если его там еще нет."""
-    username = message.from_user.username
-    if not username:
-        # Не логируем пользователей без username
-        return
+    """Логирует username (или id, если username нет) в access.txt, только если его там еще нет."""
+    user_key = message.from_user.username or str(message.from_user.id)
+    access_store.append(user_key)
+
+# --- Кэш file_id Telegram (SQLite) ---
+# Telegram позволяет переотправить уже загруженное видео по его file_id без передачи файла.
+# Храним соответствие "shortcode рилса -> file_id", чтобы популярные рилсы не качать заново.
+FILE_CACHE_DB = os.path.join(BOT_DIR, 'file_cache.sqlite3')
+FILE_CACHE_TTL = int(os.environ.get('FILE_CACHE_TTL', str(30 * 24 * 3600))) # Секунд жизни записи (по умолчанию 30 дней)
+FILE_CACHE_MAX_ENTRIES = int(os.environ.get('FILE_CACHE_MAX_ENTRIES', '10000')) # Больше записей - удаляем давно не использованные
+
+# Ссылки на рилсы, посты и IGTV: instagram.com/reel/..., /reels/..., /p/..., /tv/..., короткий домен instagr.am.
+# Домен проверяется целиком (notinstagram.com не подходит), /reels/audio/... - страница звука, а не рилс
+SHORTCODE_RE = re.compile(r'(?<![\w.-])(?:(?:www\.|m\.)?instagram\.com|instagr\.am)/(?:[\w.]+/)?(reels?|p|tv)/(?!audio/)([A-Za-z0-9_-]+)')
+
+def reel_shortcode(instagram_url):
+    """Возвращает shortcode рилса из ссылки (например, 'C1a2B3c4' из .../reel/C1a2B3c4/?igsh=...)."""
+    match = SHORTCODE_RE.search(instagram_url)
+    return match.group(2) if match else None
+
+def extract_instagram_links(text):
+    """Находит в тексте все ссылки Instagram и приводит их к виду https://www.instagram.com/<тип>/<shortcode>/.
+
+    Повторы одного shortcode убираются, порядок ссылок сохраняется.
+    """
+    links = {}
+    for match in SHORTCODE_RE.finditer(text):
+        kind, shortcode = match.groups()
+        if kind == 'reels':
+            kind = 'reel'
+        links.setdefault(shortcode, f"https://www.instagram.com/{kind}/{shortcode}/")
+    return list(links.values())
+
+class FileIdCache:
+    """Постоянный кэш shortcode -> file_id с TTL и ограничением по количеству записей."""
+
+    def __init__(self, path=FILE_CACHE_DB, ttl=FILE_CACHE_TTL, max_entries=FILE_CACHE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._db:
+            self._db.execute("CREATE TABLE IF NOT EXISTS file_ids ("
+                             "shortcode TEXT PRIMARY KEY, file_id TEXT NOT NULL, "
+                             "created_at REAL NOT NULL, last_used REAL NOT NULL)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS file_ids_last_used ON file_ids (last_used)")
+
+    def _get(self, shortcode):
+        now = time.time()
+        with self._lock, self._db:
+            row = self._db.execute("SELECT file_id, created_at FROM file_ids WHERE shortcode = ?",
+                                   (shortcode,)).fetchone()
+            if row is None:
+                return None
+            file_id, created_at = row
+            if now - created_at > self.ttl:
+                self._db.execute("DELETE FROM file_ids WHERE shortcode = ?", (shortcode,))
+                return None
+            self._db.execute("UPDATE file_ids SET last_used = ? WHERE shortcode = ?", (now, shortcode))
+            return file_id
 
-    # Создаем файл, если его нет
-    if not os.path.exists(ACCESS_LOG_FILE):
+    def _put(self, shortcode, file_id):
+        now = time.time()
+        with self._lock, self._db:
+            self._db.execute("INSERT OR REPLACE INTO file_ids (shortcode, file_id, created_at, last_used) "
+                             "VALUES (?, ?, ?, ?)", (shortcode, file_id, now, now))
+            # Удаляем просроченные и самые давно использованные записи сверх лимита
+            self._db.execute("DELETE FROM file_ids WHERE created_at < ?", (now - self.ttl,))
+            self._db.execute("DELETE FROM file_ids WHERE shortcode IN (SELECT shortcode FROM file_ids "
+                             "ORDER BY last_used DESC LIMIT -1 OFFSET ?)", (self.max_entries,))
+
+    def _delete(self, shortcode):
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM file_ids WHERE shortcode = ?", (shortcode,))
+
+    async def get(self, shortcode):
+        """Возвращает file_id из кэша или None. Запросы к SQLite выполняются вне event loop."""
         try:
-            open(ACCESS_LOG_FILE, 'a').close()
-        except OSError as e:
-            print(f"Ошибка создания файла лога доступа {ACCESS_LOG_FILE}: {e}")
-            return # Не можем логировать, если файл не создается
+            file_id = await asyncio.to_thread(self._get, shortcode)
+        except sqlite3.Error as e:
+            print(f"Ошибка чтения кэша file_id: {e}")
+            file_id = None
+        if file_id:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return file_id
+
+    async def put(self, shortcode, file_id):
+        try:
+            await asyncio.to_thread(self._put, shortcode, file_id)
+        except sqlite3.Error as e:
+            print(f"Ошибка записи в кэш file_id: {e}")
+
+    async def delete(self, shortcode):
+        try:
+            await asyncio.to_thread(self._delete, shortcode)
+        except sqlite3.Error as e:
+            print(f"Ошибка удаления из кэша file_id: {e}")
+
+    def report(self):
+        total = self.hits + self.misses
+        ratio = self.hits * 100 / total if total else 0.0
+        return f"попаданий: {self.hits}/{total} ({ratio:.0f}%)"
+
+file_id_cache = None # Открывается в open_storage() при запуске, а не при импорте
+
+# --- Пул браузера Playwright ---
+# Chromium запускается один раз при старте бота и живет все время работы.
+# Запросы получают страницы из ограниченного пула контекстов, а не запускают браузер заново.
+BROWSER_POOL_SIZE = int(os.environ.get('BROWSER_POOL_SIZE', '2')) # Сколько страниц может работать одновременно
+BROWSER_CONTEXT_MAX_USES = int(os.environ.get('BROWSER_CONTEXT_MAX_USES', '50')) # После стольких запросов контекст пересоздается
+USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/110.0.0.0 Safari/537.36'
+
+def peak_rss_mb():
+    """Возвращает пиковое потребление памяти (RSS) процессом бота в МБ."""
+    if resource is None:
+        return 0.0
+    # На Linux ru_maxrss в килобайтах
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+class _PageSlot:
+    """Контекст браузера со своей страницей, который переиспользуется между запросами."""
+
+    def __init__(self, context, page, generation):
+        self.context = context
+        self.page = page
+        self.generation = generation # Номер запуска браузера, в котором создан контекст
+        self.uses = 0
+        self.crashed = False
+        page.on('crash', self._on_crash)
+
+    def _on_crash(self, *args):
+        self.crashed = True
+
+    def is_usable(self, generation, max_uses):
+        return (not self.crashed and not self.page.is_closed()
+                and self.generation == generation and self.uses < max_uses)
+
+class BrowserManager:
+    """Держит один "теплый" Chromium и раздает страницы из ограниченного пула."""
+
+    def __init__(self, pool_size=BROWSER_POOL_SIZE, max_uses=BROWSER_CONTEXT_MAX_USES):
+        self.pool_size = max(1, pool_size)
+        self.max_uses = max(1, max_uses)
+        self._playwright = None
+        self._browser = None
+        self._generation = 0
+        self._lock = asyncio.Lock()
+        # Очередь свободных слотов: None означает, что контекст нужно создать заново
+        self._slots = asyncio.Queue()
+        for _ in range(self.pool_size):
+            self._slots.put_nowait(None)
+        # Статистика для сравнения холодных и теплых запросов
+        self.cold_requests = 0
+        self.warm_requests = 0
+        self.cold_seconds = 0.0
+        self.warm_seconds = 0.0
+        self.browser_restarts = 0
+
+    async def start(self):
+        """Запускает браузер (или перезапускает, если он упал)."""
+        async with self._lock:
+            if self._browser is not None and self._browser.is_connected():
+                return
+            if self._browser is not None:
+                print("Браузер Playwright отключился, перезапускаем...")
+                self.browser_restarts += 1
+            started = time.perf_counter()
+            with metrics.stage('browser_launch'):
+                if self._playwright is None:
+                    from playwright.async_api import async_playwright # Импорт при первом запуске браузера, а не при старте бота
+                    self._playwright = await async_playwright().start()
+                self._browser = await self._playwright.chromium.launch(headless=True)
+            self._generation += 1 # Все старые контексты станут недействительными
+            print(f"Браузер Playwright запущен за {time.perf_counter() - started:.2f} с.")
+
+    async def warm(self):
+        """Запускает браузер и заранее создает один контекст со страницей, чтобы первый запрос был теплым."""
+        await self.start()
+        slot = await self._slots.get()
+        try:
+            if slot is None:
+                slot = await self._new_slot()
+        finally:
+            self._slots.put_nowait(slot)
+
+    async def close(self):
+        """Закрывает все контексты, браузер и сам Playwright."""
+        async with self._lock:
+            while not self._slots.empty():
+                slot = self._slots.get_nowait()
+                if slot is not None:
+                    await self._close_slot(slot)
+            if self._browser is not None:
+                try:
+                    await self._browser.close()
+                except Exception as e:
+                    print(f"Ошибка при закрытии браузера: {e}")
+                self._browser = None
+            if self._playwright is not None:
+                await self._playwright.stop()
+                self._playwright = None
+        print("Браузер Playwright остановлен.")
+
+    async def _close_slot(self, slot):
+        try:
+            await slot.context.close()
+        except Exception as e:
+            print(f"Ошибка при закрытии контекста браузера: {e}")
+
+    async def _new_slot(self):
+        if self._browser is None or not self._browser.is_connected():
+            await self.start()
+        context = await self._browser.new_context(user_agent=USER_AGENT)
+        await context.route('**/*', block_heavy_resources)
+        page = await context.new_page()
+        return _PageSlot(context, page, self._generation)
+
+    @contextlib.asynccontextmanager
+    async def page(self):
+        """Выдает страницу из пула. Ждет, если все страницы заняты."""
+        with metrics.stage('page_acquire'):
+            slot = await self._slots.get()
+        started = time.perf_counter()
+        cold = False
+        try:
+            if slot is not None and not slot.is_usable(self._generation, self.max_uses):
+                await self._close_slot(slot)
+                slot = None
+            if slot is None:
+                cold = True
+                with metrics.stage('context_create'):
+                    slot = await self._new_slot()
+            slot.uses += 1
+            yield slot.page
+        except BaseException:
+            # Страница могла остаться в неизвестном состоянии - пересоздадим контекст
+            if slot is not None:
+                slot.crashed = True
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            if cold:
+                self.cold_requests += 1
+                self.cold_seconds += elapsed
+            else:
+                self.warm_requests += 1
+                self.warm_seconds += elapsed
+            if slot is not None and not slot.is_usable(self._generation, self.max_uses):
+                await self._close_slot(slot)
+                slot = None
+            self._slots.put_nowait(slot)
+
+    def report(self):
+        """Короткая сводка: среднее время холодных/теплых запросов и пиковая память."""
+        cold_avg = self.cold_seconds / self.cold_requests if self.cold_requests else 0.0
+        warm_avg = self.warm_seconds / self.warm_requests if self.warm_requests else 0.0
+        return (f"холодных: {self.cold_requests} (ср. {cold_avg:.2f} с), "
+                f"теплых: {self.warm_requests} (ср. {warm_avg:.2f} с), "
+                f"перезапусков браузера: {self.browser_restarts}, пиковая RSS: {peak_rss_mb():.0f} МБ")
+
+browser_manager = BrowserManager()
+
+# --- Общая HTTP-сессия aiohttp ---
+# Одна сессия на все приложение: переиспользование соединений (keep-alive) и кэш DNS до CDN.
+HTTP_LIMIT = int(os.environ.get('HTTP_LIMIT', '100')) # Всего одновременных соединений
+HTTP_LIMIT_PER_HOST = int(os.environ.get('HTTP_LIMIT_PER_HOST', '16')) # Соединений к одному хосту
+HTTP_DNS_CACHE_TTL = 300 # Секунд кэширования DNS
+HTTP_KEEPALIVE_TIMEOUT = 60 # Секунд держим простаивающее соединение
+
+_http_session = None
+
+def get_http_session():
+    """Возвращает общую aiohttp-сессию, создавая ее при первом обращении (нужен запущенный event loop)."""
+    global _http_session
+    if _http_session is None or _http_session.closed:
+        connector = aiohttp.TCPConnector(limit=HTTP_LIMIT, limit_per_host=HTTP_LIMIT_PER_HOST,
+                                         ttl_dns_cache=HTTP_DNS_CACHE_TTL,
+                                         keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT)
+        _http_session = aiohttp.ClientSession(connector=connector, headers={'User-Agent': USER_AGENT})
+    return _http_session
+
+async def close_http_session():
+    """Закрывает общую сессию при остановке бота."""
+    global _http_session
+    if _http_session is not None and not _http_session.closed:
+        await _http_session.close()
+    _http_session = None
+
+async def close_bot_session():
+    """Закрывает сессию telebot для запросов к Bot API (bot.close_session падает, если ее еще не создавали)."""
+    if asyncio_helper.session_manager.session is not None:
+        await bot.close_session()
+
+# --- Поиск URL видео: сначала статический HTML, потом браузер ---
+STATIC_FETCH_TIMEOUT = 15 # Секунд на обычный GET страницы
+BROWSER_VIDEO_TIMEOUT = 30000 # Миллисекунд ожидания тега с видео в браузере
+# ddinstagram отдает готовые мета-теги "ботам" превью ссылок, поэтому представляемся Telegram
+STATIC_USER_AGENT = 'TelegramBot (like TwitterBot)'
+# Типы ресурсов, которые браузеру не нужны для поиска ссылки на видео
+BLOCKED_RESOURCE_TYPES = {'image', 'font', 'stylesheet', 'media'}
+# Селекторы в порядке приоритета (как и раньше: сначала мета-теги, потом <video>/<source>)
+VIDEO_SELECTORS = (
+    ('meta[name="twitter:player:stream"]', 'content'),
+    ('meta[property="og:video"]', 'content'),
+    ('meta[property="og:video:secure_url"]', 'content'),
+    ('video[src]', 'src'),
+    ('video source[src]', 'src'),
+)
+# Фото ищем только в постах (/p/): у рилса og:image - это всего лишь обложка
+PHOTO_SELECTORS = (
+    ('meta[property="og:image"]', 'content'),
+)
+
+class TierStats:
+    """Считает попадания и время для каждого уровня поиска видео (static/browser)."""
+
+    def __init__(self):
+        self.tiers = {}
+
+    def record(self, tier, hit, seconds):
+        stats = self.tiers.setdefault(tier, {'hits': 0, 'misses': 0, 'seconds': 0.0})
+        stats['hits' if hit else 'misses'] += 1
+        stats['seconds'] += seconds
+
+    def report(self):
+        parts = []
+        for tier, stats in self.tiers.items():
+            total = stats['hits'] + stats['misses']
+            parts.append(f"{tier}: {stats['hits']}/{total} ({stats['hits'] * 100 / total:.0f}%), "
+                         f"ср. {stats['seconds'] / total:.2f} с")
+        return "; ".join(parts)
 
+extract_stats = TierStats()
+
+class MirrorError(Exception):
+    """Зеркало не ответило: сетевая ошибка, таймаут или статус 5xx (в отличие от ответа "медиа нет")."""
+
+def absolute_video_url(video_url, page_url):
+    """Делает URL видео абсолютным относительно страницы."""
+    return urljoin(page_url, video_url) if video_url else video_url
+
+def find_media_in_html(html, photos=False):
+    """Ищет медиа в HTML: видео (мета-теги twitter/og, затем <video> и <source>), если видео нет - фото.
+
+    Возвращает список (тип, URL) в порядке на странице. Карусель зеркало описывает повторяющимися
+    тегами - для каждого типа берем селектор, который нашел больше всего элементов (при равенстве -
+    более приоритетный). У видео og:image - это обложка: если фото не больше, чем видео, все они
+    обложки, а в смешанной карусели обложкой считается фото, стоящее прямо перед видео.
+    """
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(html, 'html.parser')
+    positions = {id(tag): index for index, tag in enumerate(soup.find_all(True))}
+    groups = (('video', VIDEO_SELECTORS), ('photo', PHOTO_SELECTORS)) if photos else (('video', VIDEO_SELECTORS),)
+    found = {}
+    for kind, selectors in groups:
+        found[kind] = []
+        for selector, attribute in selectors:
+            tags = {}
+            for tag in soup.select(selector):
+                if tag.get(attribute):
+                    tags.setdefault(tag[attribute], positions[id(tag)]) # Повтор URL - тот же элемент
+            if len(tags) > len(found[kind]):
+                found[kind] = [(position, kind, media_url) for media_url, position in tags.items()]
+                print(f"Найдены медиа ({selector}): {len(tags)} шт., первое: {next(iter(tags))}")
+    videos, images = found['video'], found.get('photo', [])
+    if len(images) <= len(videos):
+        images = []
+    media = sorted(videos + images)
+    return [(kind, media_url) for index, (_, kind, media_url) in enumerate(media)
+            if not (kind == 'photo' and index + 1 < len(media) and media[index + 1][1] == 'video')]
+
+async def extract_media_static(url):
+    """Уровень 1: обычный GET без браузера и разбор серверного HTML. Возвращает список (тип, URL)."""
+    headers = {'User-Agent': STATIC_USER_AGENT}
+    timeout = aiohttp.ClientTimeout(total=STATIC_FETCH_TIMEOUT)
+    with metrics.stage('static_fetch'):
+        async with get_http_session().get(url, headers=headers, allow_redirects=True, timeout=timeout) as response:
+            if response.status >= 500:
+                raise MirrorError(f"статус {response.status}")
+            if response.status != 200:
+                print(f"Статическая загрузка {url}: статус {response.status}")
+                return []
+            html = await response.text()
+    with metrics.stage('static_parse'):
+        return find_media_in_html(html, photos='/p/' in urlparse(url).path)
+
+async def block_heavy_resources(route):
+    """Обработчик маршрутизации Playwright: не грузим картинки, шрифты, стили и медиа."""
+    if route.request.resource_type in BLOCKED_RESOURCE_TYPES:
+        await route.abort()
+    else:
+        await route.continue_()
+
+async def extract_media_browser(url):
+    """Уровень 2: рендеринг страницы в браузере. Останавливаемся, как только появился тег с медиа.
+
+    В постах (/p/) ждем и фото, у рилсов - только видео. Готовый DOM (даже если тег так и не
+    появился) разбирается так же, как статический HTML: список (тип, URL) в порядке на странице.
+    """
+    from playwright.async_api import Error as PlaywrightError, TimeoutError as PlaywrightTimeoutError
+    print(f"Загружаем страницу с помощью Playwright: {url}")
+    photos = '/p/' in urlparse(url).path
+    selectors = VIDEO_SELECTORS + PHOTO_SELECTORS if photos else VIDEO_SELECTORS
+    any_media_selector = ', '.join(selector for selector, _ in selectors)
     try:
-        # Читаем существующие записи
-        with open(ACCESS_LOG_FILE, 'r') as f:
-            access_log = f.read().splitlines()
-
-        # Добавляем, если пользователя еще нет в логе
-        if username not in access_log:
-            with open(ACCESS_LOG_FILE, 'a') as f: # Открываем в режиме добавления 'a'
-                f.write(username + '\n')
+        async with browser_manager.page() as page:
+            # Не ждем networkidle: достаточно, чтобы в DOM появился любой тег с медиа
+            with metrics.stage('page_goto'):
+                try:
+                    response = await page.goto(url, wait_until='commit', timeout=60000)
+                except PlaywrightError as e: # Страница не загрузилась (сеть, таймаут) - виновато зеркало
+                    raise MirrorError(str(e)) from e
+                if response is not None and response.status >= 500:
+                    raise MirrorError(f"статус {response.status}")
+            with metrics.stage('tag_extraction'):
+                try:
+                    await page.wait_for_selector(any_media_selector, state='attached', timeout=BROWSER_VIDEO_TIMEOUT)
+                except PlaywrightTimeoutError:
+                    print(f"На странице {url} так и не появился тег с медиа, разбираем то, что есть.")
+                html = await page.content()
+            with metrics.stage('static_parse'):
+                return find_media_in_html(html, photos=photos)
+    finally:
+        print(f"Статистика браузера: {browser_manager.report()}")
+
+async def extract_media(url):
+    """Ищет медиа по уровням: сначала дешевый статический, затем браузер. Возвращает список (тип, абсолютный URL).
+
+    Пустой список - зеркало ответило, но медиа нет (удалено, закрыто). Если же ни один уровень
+    не получил ответа от зеркала (сеть, таймаут, 5xx), выбрасывается MirrorError.
+    """
+    answered = False
+    mirror_error = None
+    for tier, extractor in (('static', extract_media_static), ('browser', extract_media_browser)):
+        started = time.perf_counter()
+        media = []
+        try:
+            media = await extractor(url)
+            answered = True
+        except (MirrorError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+            print(f"Зеркало не ответило ({tier}) для {url}: {e!r}")
+            mirror_error = e if isinstance(e, MirrorError) else MirrorError(repr(e))
+        except Exception as e:
+            print(f"Ошибка поиска видео ({tier}) для {url}: {e}")
+            if tier == 'browser':
+                traceback.print_exc()
+        extract_stats.record(tier, bool(media), time.perf_counter() - started)
+        print(f"Статистика поиска видео: {extract_stats.report()}")
+        if media:
+            return [(kind, absolute_video_url(media_url, url)) for kind, media_url in media]
+    if mirror_error is not None and not answered:
+        raise mirror_error
+    return []
+
+# --- Зеркала ddinstagram: учет здоровья и хеджированные запросы ---
+# Список зеркал через запятую. Если первое зеркало не ответило за свое p90 время,
+# параллельно запрашивается следующее; побеждает первый ответ. Ответ "медиа нет" окончательный:
+# другие зеркала ради него не спрашиваем, и ошибкой зеркала (для предохранителя) он не считается.
+MIRROR_HOSTS = [host.strip() for host in os.environ.get('MIRROR_HOSTS', 'ddinstagram.com').split(',') if host.strip()]
+MIRROR_DEFAULT_HEDGE_DELAY = 3.0 # Секунд до хеджирования, пока по зеркалу нет статистики
+MIRROR_LATENCY_WINDOW = 50 # Сколько последних задержек хранить на зеркало
+MIRROR_BREAKER_FAILURES = 3 # Столько ошибок подряд - и зеркало временно выключается
+MIRROR_BREAKER_COOLDOWN = 60.0 # Секунд, после которых выключенное зеркало снова пробуется одним запросом
+
+def percentile(samples, fraction):
+    """Перцентиль по списку значений (fraction от 0 до 1), None для пустого списка."""
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+class MirrorHealth:
+    """Задержки, ошибки и предохранитель (circuit breaker) одного зеркала."""
+
+    def __init__(self, host):
+        self.host = host
+        self.latencies = collections.deque(maxlen=MIRROR_LATENCY_WINDOW)
+        self.successes = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.open_until = 0.0 # До этого момента (time.monotonic) зеркало выключено
+        self.probing = False # Идет пробный запрос после выключения
+
+    def available(self):
+        if self.consecutive_failures < MIRROR_BREAKER_FAILURES:
+            return True
+        # Предохранитель сработал: после паузы пропускаем один пробный запрос
+        return time.monotonic() >= self.open_until and not self.probing
+
+    def hedge_delay(self):
+        return percentile(self.latencies, 0.9) or MIRROR_DEFAULT_HEDGE_DELAY
+
+    def score(self):
+        """Чем меньше, тем лучше: медианная задержка с поправкой на долю ошибок."""
+        median = percentile(self.latencies, 0.5) or MIRROR_DEFAULT_HEDGE_DELAY
+        total = self.successes + self.failures
+        error_rate = self.failures / total if total else 0.0
+        return median * (1 + 4 * error_rate)
+
+    def record(self, ok, seconds):
+        self.probing = False
+        if ok:
+            self.successes += 1
+            self.consecutive_failures = 0
+            self.latencies.append(seconds)
+        else:
+            self.failures += 1
+            self.consecutive_failures += 1
+            if self.consecutive_failures >= MIRROR_BREAKER_FAILURES:
+                self.open_until = time.monotonic() + MIRROR_BREAKER_COOLDOWN
+                print(f"Зеркало {self.host} временно отключено после {self.consecutive_failures} ошибок подряд.")
+
+    def record_cancelled(self, seconds):
+        """Запрос проиграл хедж и отменен через seconds: настоящая задержка не меньше.
+
+        Такое значение учитываем, только если оно больше текущей оценки - иначе оно занизило бы p90 медленного зеркала.
+        """
+        self.probing = False
+        if seconds > self.hedge_delay():
+            self.latencies.append(seconds)
+
+    def report(self):
+        p90 = percentile(self.latencies, 0.9)
+        p90_text = f"{p90:.2f} с" if p90 is not None else "нет данных"
+        state = "доступно" if self.available() else "отключено"
+        return f"{self.host}: {state}, успехов {self.successes}, ошибок {self.failures}, p90 {p90_text}"
+
+mirror_health = {host: MirrorHealth(host) for host in MIRROR_HOSTS}
+
+def mirror_url(instagram_url, host):
+    """Заменяет домен instagram.com в ссылке на домен зеркала (зеркало может быть указано со схемой: http://host:port)."""
+    parsed = urlparse(instagram_url)
+    if '://' in host:
+        scheme, host = host.split('://', 1)
+        parsed = parsed._replace(scheme=scheme)
+    return parsed._replace(netloc=host).geturl()
+
+async def _extract_from_mirror(instagram_url, health):
+    started = time.perf_counter()
+    try:
+        media = await extract_media(mirror_url(instagram_url, health.host))
+    except asyncio.CancelledError:
+        # Проиграл хедж: ошибкой это не считаем, но зеркало отвечало как минимум столько времени
+        health.record_cancelled(time.perf_counter() - started)
+        raise
+    except MirrorError:
+        health.record(False, time.perf_counter() - started)
+        raise
+    health.record(True, time.perf_counter() - started) # Ответ получен, даже если медиа нет
+    return media
+
+async def extract_media_hedged(instagram_url):
+    """Ищет медиа на зеркалах: лучшее по статистике первым, следующее - если первое медлит или не ответило.
+
+    Первый полученный ответ окончательный, даже пустой (медиа нет).
+    """
+    candidates = sorted((health for health in mirror_health.values() if health.available()),
+                        key=MirrorHealth.score)
+    if not candidates:
+        # Все зеркала выключены - пробуем то, что раньше всех включится обратно
+        candidates = [min(mirror_health.values(), key=lambda health: health.open_until)]
+    pending = {}
+    media = []
+    try:
+        while candidates or pending:
+            if candidates and (not pending or len(pending) < 2):
+                health = candidates.pop(0)
+                if health.consecutive_failures >= MIRROR_BREAKER_FAILURES:
+                    health.probing = True
+                if pending:
+                    print(f"Зеркало медлит, отправляем хеджированный запрос на {health.host}.")
+                pending[asyncio.ensure_future(_extract_from_mirror(instagram_url, health))] = health
+            # Ждем первый ответ, но не дольше p90 самого свежего запроса - потом хеджируем
+            hedge_delay = pending[next(reversed(pending))].hedge_delay() if candidates else None
+            done, _ = await asyncio.wait(pending, timeout=hedge_delay, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                pending.pop(task)
+                if not task.cancelled() and task.exception() is None:
+                    media = task.result()
+                    return media
+    finally:
+        for task in pending:
+            task.cancel() # Проигравшие запросы больше не нужны
+        print(f"Зеркала: {'; '.join(health.report() for health in mirror_health.values())}")
+    return media
+
+async def extract_video_url_hedged(instagram_url):
+    """URL первого видео по ссылке (для рилсов) или None."""
+    for kind, media_url in await extract_media_hedged(instagram_url):
+        if kind == 'video':
+            return media_url
+    return None
+
+# --- Папка временных файлов (spool) ---
+# Все скачанные видео и фото лежат в одной папке, в имени файла - pid процесса. Если процесс убили
+# посреди скачивания, его файлы удалит уборщик: при старте и затем каждые SPOOL_SWEEP_INTERVAL секунд.
+SPOOL_DIR = (os.environ.get('SPOOL_DIR') or (BOT_API_LOCAL_DIR if BOT_API_LOCAL else None)
+             or os.path.join(tempfile.gettempdir(), 'insta-bot-spool'))
+SPOOL_MAX_AGE = int(os.environ.get('SPOOL_MAX_AGE', '3600')) # Файлы старше (секунд) удаляются, даже если процесс жив
+SPOOL_SWEEP_INTERVAL = int(os.environ.get('SPOOL_SWEEP_INTERVAL', '600')) # Секунд между уборками
+SPOOL_NAME_RE = re.compile(r'insta-(\d+)-')
+
+def spool_file(suffix):
+    """Создает пустой временный файл в SPOOL_DIR. Возвращает (дескриптор, путь), как tempfile.mkstemp."""
+    os.makedirs(SPOOL_DIR, exist_ok=True)
+    return tempfile.mkstemp(suffix=suffix, prefix=f"insta-{os.getpid()}-", dir=SPOOL_DIR)
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0) # Сигнал 0 ничего не делает, только проверяет, что процесс существует
+    except ProcessLookupError:
+        return False
+    except OSError:
+        return True # Процесс есть, но принадлежит другому пользователю
+    return True
+
+def sweep_spool(own=False):
+    """Удаляет осиротевшие файлы: их процесс уже завершился или файл старше SPOOL_MAX_AGE.
+
+    own=True - удалить и файлы текущего процесса (при остановке, когда они уже никому не нужны).
+    Возвращает количество удаленных файлов.
+    """
+    try:
+        entries = list(os.scandir(SPOOL_DIR))
+    except FileNotFoundError:
+        return 0
     except OSError as e:
-        print(f"Ошибка чтения/записи в файл лога доступа {ACCESS_LOG_FILE}: {e}")
+        print(f"Ошибка чтения папки временных файлов {SPOOL_DIR}: {e}")
+        return 0
+    removed = 0
+    now = time.time()
+    for entry in entries:
+        match = SPOOL_NAME_RE.match(entry.name)
+        if not match:
+            continue # Чужие файлы (например, в общей папке BOT_API_LOCAL_DIR) не трогаем
+        pid = int(match.group(1))
+        try:
+            if pid == os.getpid():
+                orphaned = own or now - entry.stat().st_mtime > SPOOL_MAX_AGE
+            else:
+                orphaned = not _pid_alive(pid) or now - entry.stat().st_mtime > SPOOL_MAX_AGE
+            if orphaned:
+                os.remove(entry.path)
+                removed += 1
+        except FileNotFoundError:
+            continue # Файл успел удалить сам владелец
+        except OSError as e:
+            print(f"Ошибка удаления временного файла {entry.path}: {e}")
+    metrics.count('spool_files_removed_total', removed)
+    return removed
 
-# --- Функция скачивания видео (ОБНОВЛЕННАЯ ВЕРСИЯ) ---
-from playwright.async_api import async_playwright
-import asyncio
-# ... (остальные импорты)
+async def spool_sweeper():
+    """Фоновая уборка папки временных файлов: сразу при старте, затем раз в SPOOL_SWEEP_INTERVAL секунд."""
+    while True:
+        removed = await asyncio.to_thread(sweep_spool)
+        if removed:
+            print(f"Удалено осиротевших временных файлов: {removed} (папка {SPOOL_DIR})")
+        await asyncio.sleep(SPOOL_SWEEP_INTERVAL)
 
-async def download_video_playwright(url):
-    print(f"Загружаем страницу с помощью Playwright: {url}")
-    video_url = None
-    temp_file_path = None
+# --- Скачивание файла: параллельные Range-запросы или один поток ---
+DOWNLOAD_TIMEOUT = aiohttp.ClientTimeout(total=300, sock_read=60)
+RANGE_MIN_SIZE = int(os.environ.get('RANGE_MIN_SIZE', str(4 * 1024 * 1024))) # Меньшие файлы качаем одним потоком
+RANGE_PARTS = int(os.environ.get('RANGE_PARTS', '4')) # На сколько частей делим большой файл
+WRITE_BUFFER_SIZE = 1024 * 1024 # Копим столько байт перед записью на диск в отдельном потоке
+CONTENT_RANGE_RE = re.compile(r'bytes (\d+)-(\d+)/(\d+)')
+
+class DownloadError(Exception):
+    """Файл скачан не полностью или не прошел проверку размера/контрольной суммы."""
+
+class VideoTooBigError(DownloadError):
+    """Видео больше TELEGRAM_UPLOAD_LIMIT - его все равно не получится отправить."""
 
+    def __init__(self, size):
+        super().__init__(f"размер {size} байт больше лимита Telegram {TELEGRAM_UPLOAD_LIMIT} байт")
+        self.size = size
+
+def check_upload_limit(size):
+    """Проверяет размер из заголовков ответа до скачивания тела."""
+    if size is not None and size > TELEGRAM_UPLOAD_LIMIT:
+        raise VideoTooBigError(size)
+
+def _preallocate(fd, size):
+    """Резервирует место под файл заранее, чтобы части можно было писать по своим смещениям."""
+    if hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(fd, 0, size)
+            return
+        except OSError:
+            pass # Например, файловая система не поддерживает fallocate
+    os.ftruncate(fd, size)
+
+def _file_md5_base64(path):
+    digest = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(WRITE_BUFFER_SIZE), b''):
+            digest.update(block)
+    return base64.b64encode(digest.digest()).decode()
+
+def _pwrite_all(fd, data, offset):
+    """os.pwrite до конца буфера: запись может оказаться короткой. Возвращает число записанных байт."""
+    view = memoryview(data)
+    written = 0
+    while written < len(view):
+        count = os.pwrite(fd, view[written:], offset + written)
+        if count == 0:
+            raise OSError(f"не удалось записать {len(view) - written} байт со смещения {offset + written}")
+        written += count
+    return written
+
+async def _fd_io(func, *args):
+    """Выполняет func(*args) с файловым дескриптором в отдельном потоке.
+
+    Поток нельзя прервать, поэтому при отмене ждем, пока начатая операция закончится, и только
+    потом пробрасываем отмену: иначе дескриптор закроют (а ОС может выдать тот же номер другому
+    файлу), пока поток еще пишет в него.
+    """
+    operation = asyncio.ensure_future(asyncio.to_thread(func, *args))
+    try:
+        return await asyncio.shield(operation)
+    except asyncio.CancelledError:
+        while not operation.done():
+            with contextlib.suppress(asyncio.CancelledError):
+                await asyncio.wait({operation})
+        if not operation.cancelled():
+            operation.exception() # Ошибка уже не важна - задачу отменили
+        raise
+
+async def _write_stream(response, fd, offset):
+    """Пишет тело ответа в файл с указанного смещения. Запись на диск идет вне event loop."""
+    written = 0
+    buffer = bytearray()
+    async for chunk in response.content.iter_chunked(64 * 1024):
+        buffer += chunk
+        if len(buffer) >= WRITE_BUFFER_SIZE:
+            written += await _fd_io(_pwrite_all, fd, bytes(buffer), offset + written)
+            buffer.clear()
+    if buffer:
+        written += await _fd_io(_pwrite_all, fd, bytes(buffer), offset + written)
+    return written
+
+async def _download_range(session, video_url, fd, start, end, etag):
+    """Скачивает байты start..end (включительно) и пишет их в файл по смещению start."""
+    headers = {'Range': f'bytes={start}-{end}'}
+    if etag:
+        headers['If-Range'] = etag # Если файл на CDN поменялся, сервер вернет 200 вместо 206
+    async with session.get(video_url, headers=headers, timeout=DOWNLOAD_TIMEOUT) as response:
+        if response.status != 206:
+            raise DownloadError(f"часть {start}-{end}: статус {response.status} вместо 206")
+        written = await _write_stream(response, fd, start)
+    if written != end - start + 1:
+        raise DownloadError(f"часть {start}-{end}: получено {written} байт вместо {end - start + 1}")
+
+async def download_to_file(video_url, path):
+    """Скачивает video_url в path и возвращает размер файла.
+
+    Первый запрос идет с заголовком Range. Если сервер поддерживает диапазоны и файл большой,
+    остальные части качаются параллельно в заранее выделенный файл. Если нет - тело первого
+    ответа просто читается целиком (один поток).
+    """
+    session = get_http_session()
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
     try:
-        async with async_playwright() as p:
-            # Можно попробовать разные браузеры (chromium, firefox, webkit)
-            # headless=True - запускать без видимого окна браузера
-            browser = await p.chromium.launch(headless=True)
-            page = await browser.new_page(user_agent='Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/110.0.0.0 Safari/537.36') # Задаем User Agent
+        headers = {'Range': f'bytes=0-{RANGE_MIN_SIZE - 1}'}
+        async with session.get(video_url, headers=headers, allow_redirects=True, timeout=DOWNLOAD_TIMEOUT) as response:
+            content_range = CONTENT_RANGE_RE.match(response.headers.get('Content-Range', ''))
+            if response.status == 200 or (response.status == 206 and not content_range):
+                # Сервер не поддерживает диапазоны - качаем одним потоком
+                expected_size = response.content_length if response.status == 200 else None
+                check_upload_limit(expected_size)
+                size = await _write_stream(response, fd, 0)
+                content_md5 = response.headers.get('Content-MD5')
+            elif response.status == 206:
+                first_end, expected_size = int(content_range.group(2)), int(content_range.group(3))
+                check_upload_limit(expected_size)
+                await _fd_io(_preallocate, fd, expected_size)
+                etag = response.headers.get('ETag')
+                content_md5 = None # Content-MD5 у 206 относится только к части
+                video_url = str(response.url) # Остальные части берем с того же адреса после редиректов
+                # Остаток файла делим на части и качаем параллельно с первой
+                rest_start = first_end + 1
+                parts = []
+                if rest_start < expected_size:
+                    part_size = -(-(expected_size - rest_start) // RANGE_PARTS)
+                    for start in range(rest_start, expected_size, part_size):
+                        end = min(start + part_size, expected_size) - 1
+                        parts.append(asyncio.ensure_future(_download_range(session, video_url, fd, start, end, etag)))
+                try:
+                    first_written = await _write_stream(response, fd, 0)
+                    if first_written != first_end + 1:
+                        raise DownloadError(f"первая часть: получено {first_written} байт вместо {first_end + 1}")
+                    await asyncio.gather(*parts)
+                finally:
+                    for part in parts:
+                        part.cancel()
+                    # Дескриптор закрывается ниже - сначала дожидаемся, пока части допишут начатое
+                    await asyncio.gather(*parts, return_exceptions=True)
+                size = expected_size
+                print(f"Видео скачано в {len(parts) + 1} потока(ов) по диапазонам.")
+            else:
+                raise DownloadError(f"статус {response.status}")
+    finally:
+        os.close(fd)
+
+    # --- Проверки в конце: размер и, если сервер прислал, контрольная сумма ---
+    actual_size = os.path.getsize(path)
+    if expected_size is not None and actual_size != expected_size:
+        raise DownloadError(f"размер файла {actual_size} байт, ожидалось {expected_size}")
+    if actual_size != size:
+        raise DownloadError(f"размер файла {actual_size} байт, записано {size}")
+    if content_md5 and await asyncio.to_thread(_file_md5_base64, path) != content_md5:
+        raise DownloadError("контрольная сумма Content-MD5 не совпала")
+    return actual_size
 
+# --- Потоковая передача: CDN -> Telegram без промежуточного файла ---
+# Загрузка в Telegram начинается, как только пришли первые байты с CDN.
+# Небольшие видео держим в памяти, большие после STREAM_MEMORY_LIMIT байт уходят во временный файл,
+# поэтому одна задача занимает в памяти не больше STREAM_MEMORY_LIMIT + STREAM_CHUNK_SIZE байт.
+STREAM_UPLOAD = os.environ.get('STREAM_UPLOAD', '1') == '1' # 0 - старый режим: скачать файл целиком, потом отправить
+STREAM_MEMORY_LIMIT = int(os.environ.get('STREAM_MEMORY_LIMIT', str(8 * 1024 * 1024)))
+STREAM_CHUNK_SIZE = 256 * 1024
+
+class VideoStreamPayload(aiohttp.payload.AsyncIterablePayload):
+    """Тело multipart-загрузки, которое читается прямо из VideoStream.
+
+    Если CDN сообщил длину, она уходит в Content-Length вместо chunked. VideoStream хранит все
+    скачанные байты, поэтому replay() дает новое тело с начала видео - для повтора после 429.
+    """
+
+    def __init__(self, stream):
+        super().__init__(stream.iter_chunks(), content_type='video/mp4')
+        self._stream = stream
+        self._known_size = stream.expected_size if stream.error is None else None
+
+    @property
+    def size(self):
+        return self._known_size
+
+    def replay(self):
+        return VideoStreamPayload(self._stream)
+
+class VideoStream:
+    """Скачивает видео с CDN в фоне. Читатели получают байты по мере их поступления.
+
+    Все скачанные байты сохраняются (в памяти или на диске), поэтому видео можно отправить
+    повторно - например, другому участнику single-flight, если первая отправка не удалась.
+    """
+
+    def __init__(self, response, memory_limit=STREAM_MEMORY_LIMIT):
+        self.expected_size = response.content_length # None, если сервер не прислал Content-Length
+        self.size = 0
+        self.done = False
+        self.error = None
+        self.path = None # Путь к временному файлу, если видео не поместилось в память
+        self._memory_limit = memory_limit
+        self._buffer = bytearray()
+        self._fd = None
+        self._changed = asyncio.Condition()
+        self._task = asyncio.ensure_future(self._pump(response))
+
+    async def _pump(self, response):
+        try:
+            with metrics.stage('cdn_download'):
+                async with response:
+                    async for chunk in response.content.iter_chunked(STREAM_CHUNK_SIZE):
+                        await self._append(chunk)
+            if self.expected_size is not None and self.size != self.expected_size:
+                raise DownloadError(f"получено {self.size} байт, ожидалось {self.expected_size}")
+            if self.size == 0:
+                raise DownloadError("скачан пустой файл")
+            metrics.observe('file_size_bytes', self.size, buckets=SIZE_BUCKETS)
+        except asyncio.CancelledError:
+            self.error = DownloadError("скачивание отменено")
+            raise
+        except Exception as e:
+            print(f"Ошибка потокового скачивания видео: {e}")
+            metrics.count('failures_total', cause='cdn_error')
+            self.error = e
+        finally:
+            metrics.count('downloaded_bytes_total', self.size)
+            self.done = True
+            await self._notify()
+
+    async def _notify(self):
+        async with self._changed:
+            self._changed.notify_all()
+
+    async def _append(self, chunk):
+        if self._fd is None and len(self._buffer) + len(chunk) > self._memory_limit:
+            # Видео больше лимита памяти - переносим накопленное во временный файл
+            fd, self.path = spool_file('.mp4')
             try:
-                # Переходим на страницу и ждем полной загрузки (включая JS)
-                await page.goto(url, wait_until='networkidle', timeout=60000) # Увеличим таймаут
-                print(f"Страница {url} загружена.")
-
-                # --- Попытка найти видео URL после выполнения JS ---
-                # Способ 1: Искать мета-теги снова (вдруг JS их добавил?)
-                video_meta_tag_twitter = await page.query_selector('meta[name="twitter:player:stream"]')
-                if video_meta_tag_twitter:
-                    video_url = await video_meta_tag_twitter.get_attribute('content')
-                    print(f"Найден twitter:player:stream URL: {video_url}")
-
-                if not video_url:
-                    video_meta_tag_og = await page.query_selector('meta[property="og:video"]')
-                    if video_meta_tag_og:
-                        video_url = await video_meta_tag_og.get_attribute('content')
-                        print(f"Найден og:video URL: {video_url}")
-
-                # Способ 2: Искать тег <video>
-                if not video_url:
-                    video_element = await page.query_selector('video')
-                    if video_element:
-                        video_url = await video_element.get_attribute('src')
-                        print(f"Найден URL в теге <video>: {video_url}")
-                        # Иногда URL может быть в <source> внутри <video>
-                        if not video_url:
-                             source_element = await video_element.query_selector('source')
-                             if source_element:
-                                 video_url = await source_element.get_attribute('src')
-                                 print(f"Найден URL в теге <source>: {video_url}")
-
-                # --- Если URL найден, скачиваем его (можно через aiohttp или Playwright) ---
-                if video_url:
-                     # Убедимся, что URL абсолютный
-                     if video_url.startswith('/'):
-                          parsed_original_url = urlparse(url)
-                          base_url = f"{parsed_original_url.scheme}://{parsed_original_url.netloc}"
-                          video_url = base_url + video_url
-                     print(f"Извлеченный абсолютный URL видео: {video_url}")
-
-                     # Скачивание через aiohttp (как раньше, но с найденным URL)
-                     async with aiohttp.ClientSession() as session:
-                          headers = { # Можно добавить те же заголовки
-                               'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/110.0.0.0 Safari/537.36'
-                          }
-                          async with session.get(video_url, headers=headers, allow_redirects=True, timeout=300) as video_response:
-                               if video_response.status == 200:
-                                    with tempfile.NamedTemporaryFile(delete=False, suffix='.mp4') as temp_file_obj:
-                                         temp_file_path = temp_file_obj.name
-                                         bytes_downloaded = 0
-                                         async for chunk in video_response.content.iter_chunked(8192):
-                                              if chunk:
-                                                   temp_file_obj.write(chunk)
-                                                   bytes_downloaded += len(chunk)
-                                         print(f"Видео скачано в: {temp_file_path} ({bytes_downloaded} байт)")
-                                         if bytes_downloaded == 0:
-                                              print("Ошибка: Скачан пустой файл.")
-                                              os.remove(temp_file_path)
-                                              temp_file_path = None
-                               else:
-                                    print(f"Ошибка скачивания видео ({video_url}): Статус {video_response.status}")
-                else:
-                     print("Не удалось найти URL видео на странице после загрузки JS.")
-                     # Можно сохранить HTML после JS для анализа
-                     # html_after_js = await page.content()
-                     # with open("debug_after_js.html", "w", encoding="utf-8") as f:
-                     #     f.write(html_after_js)
-                     # print("HTML после выполнения JS сохранен в debug_after_js.html")
-
-            except Exception as e:
-                print(f"Ошибка при обработке страницы Playwright: {e}")
-                traceback.print_exc()
-            finally:
-                 await browser.close()
+                await _fd_io(_pwrite_all, fd, bytes(self._buffer), 0)
+            except BaseException:
+                os.close(fd) # Читатели этот дескриптор еще не видели; файл удалит close()
+                raise
+            self._fd = fd
+            self._buffer = bytearray()
+        if self._fd is None:
+            self._buffer += chunk
+        else:
+            await _fd_io(_pwrite_all, self._fd, chunk, self.size)
+        self.size += len(chunk)
+        await self._notify()
+
+    async def iter_chunks(self):
+        """Отдает видео с начала, дожидаясь еще не скачанных байтов."""
+        offset = 0
+        while True:
+            async with self._changed:
+                await self._changed.wait_for(lambda: offset < self.size or self.done)
+            if offset >= self.size:
+                if self.error:
+                    raise self.error
+                return
+            end = min(self.size, offset + STREAM_CHUNK_SIZE)
+            if self._fd is None:
+                data = bytes(self._buffer[offset:end])
+            else:
+                data = await _fd_io(os.pread, self._fd, end - offset, offset)
+            offset += len(data)
+            yield data
+
+    async def wait_complete(self):
+        """Ждет окончания скачивания и возвращает размер видео."""
+        await asyncio.shield(self._task)
+        if self.error:
+            raise self.error
+        return self.size
+
+    def upload_payload(self):
+        """Тело для multipart-загрузки, которое читается прямо из потока."""
+        return VideoStreamPayload(self)
+
+    def close(self):
+        """Останавливает скачивание и освобождает память/временный файл.
+
+        Файл закрывается, только когда скачивание действительно остановилось: отмененная
+        задача сначала дожидается уже начатой записи на диск (см. _fd_io).
+        """
+        self._task.cancel()
+        self._buffer = bytearray()
+        if self._task.done():
+            self._release_file()
+        else:
+            self._task.add_done_callback(lambda task: self._release_file())
+
+    def _release_file(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+        remove_temp_file(self.path)
+
+async def open_video_stream(video_url):
+    """Начинает скачивание видео и возвращает VideoStream, как только пришли заголовки ответа."""
+    response = await get_http_session().get(video_url, allow_redirects=True, timeout=DOWNLOAD_TIMEOUT)
+    if response.status != 200:
+        response.release()
+        raise DownloadError(f"статус {response.status}")
+    try:
+        check_upload_limit(response.content_length)
+    except VideoTooBigError:
+        response.close() # Тело не дочитываем - соединение закрываем
+        raise
+    return VideoStream(response)
+
+def release_video(video):
+    """Освобождает результат загрузки: временный файл или поток."""
+    if isinstance(video, VideoStream):
+        video.close()
+    elif isinstance(video, str):
+        remove_temp_file(video)
+
+# --- Функция скачивания видео ---
+async def download_to_temp_file(media_url, suffix='.mp4'):
+    """Скачивает медиа во временный файл. Возвращает путь, VideoTooBigError (без скачивания) или None."""
+    # Для локального сервера Bot API SPOOL_DIR - папка, которую сервер сможет прочитать (см. BOT_API_LOCAL_DIR)
+    fd, temp_file_path = spool_file(suffix)
+    os.close(fd)
+    if BOT_API_LOCAL:
+        os.chmod(temp_file_path, 0o644) # Сервер Bot API может работать от другого пользователя
+    try:
+        with metrics.stage('cdn_download'):
+            bytes_downloaded = await download_to_file(media_url, temp_file_path)
+    except VideoTooBigError as e:
+        print(f"Видео не скачиваем: {e}")
+        remove_temp_file(temp_file_path)
+        return e
+    except (DownloadError, aiohttp.ClientError, asyncio.TimeoutError, OSError) as e:
+        print(f"Ошибка скачивания видео ({media_url}): {e}")
+        metrics.count('failures_total', cause='cdn_error')
+        remove_temp_file(temp_file_path)
+        return None
+    print(f"Видео скачано в: {temp_file_path} ({bytes_downloaded} байт)")
+    metrics.count('downloaded_bytes_total', bytes_downloaded)
+    metrics.observe('file_size_bytes', bytes_downloaded, buckets=SIZE_BUCKETS)
+    if bytes_downloaded == 0:
+        print("Ошибка: Скачан пустой файл.")
+        remove_temp_file(temp_file_path)
+        return None
+    return temp_file_path
+
+async def download_video(url):
+    """Находит URL видео для ссылки Instagram через зеркала ddinstagram и скачивает его.
+
+    В потоковом режиме возвращает VideoStream сразу после начала скачивания,
+    иначе - путь к полностью скачанному временному файлу. Если видео больше лимита
+    Telegram - VideoTooBigError (без скачивания). При ошибке - None.
+    """
+    temp_file_path = None
+
+    try:
+        with metrics.stage('video_url_lookup'):
+            video_url = await extract_video_url_hedged(url)
+
+        if video_url and STREAM_UPLOAD and not BOT_API_LOCAL:
+             print(f"Извлеченный абсолютный URL видео: {video_url}")
+             try:
+                  return await open_video_stream(video_url)
+             except VideoTooBigError as e:
+                  print(f"Видео не скачиваем: {e}")
+                  return e
+             except (DownloadError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+                  print(f"Ошибка скачивания видео ({video_url}): {e}")
+                  metrics.count('failures_total', cause='cdn_error')
+        elif video_url:
+             print(f"Извлеченный абсолютный URL видео: {video_url}")
+             temp_file_path = await download_to_temp_file(video_url)
+        else:
+             print("Не удалось найти URL видео ни в HTML, ни после загрузки JS.")
+             metrics.count('failures_total', cause='no_video_url')
+
     except Exception as e:
-        print(f"Ошибка при запуске/работе Playwright: {e}")
+        print(f"Ошибка при скачивании видео: {e}")
         traceback.print_exc()
+        metrics.count('failures_total', cause='unexpected')
+
+    return temp_file_path # Возвращаем путь, VideoTooBigError или None
+
+# --- Объединение одновременных запросов одного и того же рилса (single-flight) ---
+def remove_temp_file(path):
+    """Удаляет временный файл видео, если он существует."""
+    if path and os.path.exists(path):
+        try:
+            os.remove(path)
+            print(f"Временный файл {path} удален.")
+        except OSError as e:
+            print(f"Ошибка удаления временного файла {path}: {e}")
+
+class _Flight:
+    """Одна общая загрузка рилса, которую ждут все, кто прислал ту же ссылку."""
 
-    return temp_file_path # Возвращаем путь или None
+    def __init__(self, task):
+        self.task = task # Задача скачивания: результат - VideoStream, путь к временному файлу, VideoTooBigError или None
+        self.refs = 0 # Сколько обработчиков сейчас используют результат
+        self.file_id = None # file_id после первой успешной отправки - остальным не нужно загружать файл
+        self.send_lock = asyncio.Lock() # Отправляем по очереди, чтобы остальные могли взять file_id
+
+    @property
+    def result(self):
+        return self.task.result()
+
+class SingleFlight:
+    """Первый запрос по ключу запускает загрузку, остальные одновременные запросы ждут ее результат.
+
+    Временный файл удаляется, только когда его отпустил последний ожидающий.
+    Ошибка загрузки достается всем ожидающим сразу, без повторных попыток.
+    """
+
+    def __init__(self, release=release_video):
+        self._flights = {}
+        self._release = release
+
+    def __contains__(self, key):
+        return key in self._flights
+
+    @contextlib.asynccontextmanager
+    async def join(self, key, fetch):
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = _Flight(asyncio.ensure_future(fetch()))
+            self._flights[key] = flight
+        else:
+            print(f"Запрос {key} уже выполняется, ждем его результат.")
+        flight.refs += 1
+        try:
+            # shield: отмена одного ожидающего не должна отменять загрузку для остальных
+            await asyncio.shield(flight.task)
+            yield flight
+        finally:
+            flight.refs -= 1
+            if flight.refs == 0:
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+                if flight.task.done():
+                    self._release_result(flight.task)
+                else:
+                    # Все ожидающие ушли раньше времени - освободим файл, когда загрузка закончится
+                    flight.task.add_done_callback(self._release_result)
+
+    def _release_result(self, task):
+        if not task.cancelled() and task.exception() is None:
+            self._release(task.result())
+
+video_flights = SingleFlight()
+
+# --- Планировщик задач: общий лимит, очередь по кругу между пользователями ---
+# Одновременно выполняется не больше JOB_CONCURRENCY задач (скачивание + отправка).
+# Очередь обходится по кругу: один пользователь с 20 ссылками не задерживает остальных.
+JOB_CONCURRENCY = int(os.environ.get('JOB_CONCURRENCY', '0')) or max(BROWSER_POOL_SIZE, os.cpu_count() or 1)
+JOB_USER_QUEUE_LIMIT = int(os.environ.get('JOB_USER_QUEUE_LIMIT', '5')) # Сколько задач один пользователь может держать в очереди
+
+class QueueFullError(Exception):
+    """У пользователя уже слишком много задач в очереди."""
+
+class _Job:
+    def __init__(self, user_id, on_position, batch=None):
+        self.user_id = user_id
+        self.batch = batch # Задачи одного пакета (ссылки одного сообщения) занимают в очереди одно место
+        self.on_position = on_position # async-функция, получающая новое место в очереди
+        self.position = None
+        self.started = asyncio.get_running_loop().create_future()
+        self.enqueued_at = time.perf_counter()
+
+class JobScheduler:
+    """Ограничивает число одновременных задач и раздает свободные места пользователям по кругу."""
+
+    def __init__(self, concurrency=JOB_CONCURRENCY, per_user_limit=JOB_USER_QUEUE_LIMIT):
+        self.concurrency = max(1, concurrency)
+        self.per_user_limit = max(1, per_user_limit)
+        self.running = 0
+        self._queues = collections.OrderedDict() # user_id -> deque задач; порядок - очередь обхода по кругу
+        self._notify_tasks = set()
+        self._batches = collections.Counter() # batch -> сколько его задач ждет или выполняется
+        # Статистика ожидания в очереди
+        self.started_jobs = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def depth(self):
+        """Сколько задач ждет в очереди."""
+        return sum(len(queue) for queue in self._queues.values())
+
+    def _entries(self, queue):
+        """Сколько мест в очереди занимает пользователь: пакет задач считается одним местом."""
+        return len({job if job.batch is None else job.batch for job in queue})
+
+    def _order(self):
+        """Порядок запуска ожидающих задач при обходе пользователей по кругу."""
+        queues = [list(queue) for queue in self._queues.values()]
+        order = []
+        for round_index in range(max((len(queue) for queue in queues), default=0)):
+            order.extend(queue[round_index] for queue in queues if round_index < len(queue))
+        return order
+
+    def _dispatch(self):
+        while self.running < self.concurrency and self._queues:
+            user_id, queue = next(iter(self._queues.items()))
+            job = queue.popleft()
+            if job.started.done():
+                # Ожидание уже отменили, но run() еще не успел убрать задачу - место ей не нужно
+                if not queue:
+                    del self._queues[user_id]
+                continue
+            # Пользователь уходит в конец круга; если задач больше нет - удаляем его из очереди
+            del self._queues[user_id]
+            if queue:
+                self._queues[user_id] = queue
+            self.running += 1
+            job.started.set_result(None)
+        self._report_positions()
+
+    def _report_positions(self):
+        for position, job in enumerate(self._order(), start=1):
+            if job.position != position:
+                job.position = position
+                if job.on_position:
+                    task = asyncio.ensure_future(self._notify(job, position))
+                    self._notify_tasks.add(task)
+                    task.add_done_callback(self._notify_tasks.discard)
+
+    async def _notify(self, job, position):
+        try:
+            await job.on_position(position)
+        except Exception as e:
+            print(f"Не удалось сообщить место в очереди: {e}")
+
+    def _remove(self, job):
+        queue = self._queues.get(job.user_id)
+        if queue and job in queue:
+            queue.remove(job)
+            if not queue:
+                del self._queues[job.user_id]
+
+    async def run(self, user_id, job_factory, on_position=None, batch=None):
+        """Ставит задачу в очередь и выполняет job_factory(), когда подойдет очередь.
+
+        Выбрасывает QueueFullError, если у пользователя уже per_user_limit задач в очереди.
+        Задачи с одинаковым batch считаются одной: пока хоть одна из них ждет или выполняется,
+        остальные принимаются без проверки лимита.
+        """
+        queue = self._queues.get(user_id)
+        if (queue is not None and not (batch is not None and self._batches[batch])
+                and self._entries(queue) >= self.per_user_limit):
+            raise QueueFullError(user_id)
+        if batch is not None:
+            self._batches[batch] += 1
+        try:
+            return await self._run(_Job(user_id, on_position, batch), job_factory)
+        finally:
+            if batch is not None:
+                self._batches[batch] -= 1
+                if not self._batches[batch]:
+                    del self._batches[batch]
+
+    async def _run(self, job, job_factory):
+        self._queues.setdefault(job.user_id, collections.deque()).append(job)
+        self._dispatch()
+        try:
+            await job.started
+        except asyncio.CancelledError:
+            if job.started.done() and not job.started.cancelled():
+                self.running -= 1 # Место уже выдали, но задача не успела начаться
+            else:
+                self._remove(job)
+            self._dispatch()
+            raise
+        wait = time.perf_counter() - job.enqueued_at
+        self.started_jobs += 1
+        self.total_wait += wait
+        metrics.observe('queue_wait_seconds', wait)
+        self.max_wait = max(self.max_wait, wait)
+        try:
+            return await job_factory()
+        finally:
+            self.running -= 1
+            self._dispatch()
+
+    def report(self):
+        avg_wait = self.total_wait / self.started_jobs if self.started_jobs else 0.0
+        return (f"выполняется: {self.running}/{self.concurrency}, в очереди: {self.depth()}, "
+                f"ожидание ср. {avg_wait:.2f} с, макс. {self.max_wait:.2f} с")
+
+job_scheduler = JobScheduler()
+
+# --- Очередь задач для отдельных процессов-воркеров (SQLite) ---
+# По желанию скачивание и отправку можно вынести из процесса бота: обработчик сообщений только
+# кладет задачу в файл SQLite, а процессы `python insta.py --worker` (каждый со своим браузером)
+# забирают задачи, скачивают и отправляют видео. Воркеры могут работать и на других машинах,
+# если файл очереди лежит на общем диске с рабочими блокировками.
+# Задача выдается воркеру "в аренду" на JOB_LEASE_SECONDS и продлевается, пока он работает.
+# Если воркер упал, аренда истекает и задачу забирает другой воркер (не больше JOB_MAX_ATTEMPTS раз).
+WORKERS = int(os.environ.get('WORKERS', '0')) # Сколько процессов-воркеров запускать вместе с ботом
+JOB_QUEUE_ENABLED = WORKERS > 0 or os.environ.get('JOB_QUEUE', '0') == '1' # Воркеры могут быть запущены отдельно
+JOB_QUEUE_DB = os.environ.get('JOB_QUEUE_DB') or os.path.join(BOT_DIR, 'jobs.sqlite3')
+JOB_LEASE_SECONDS = float(os.environ.get('JOB_LEASE_SECONDS', '120'))
+JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', '3'))
+JOB_POLL_INTERVAL = float(os.environ.get('JOB_POLL_INTERVAL', '0.5')) # Как часто свободный воркер проверяет очередь
+WORKER_CONCURRENCY = int(os.environ.get('WORKER_CONCURRENCY', '0')) or BROWSER_POOL_SIZE # Задач одновременно в одном воркере
+WORKER_DRAIN_TIMEOUT = float(os.environ.get('WORKER_DRAIN_TIMEOUT', '60')) # Сколько ждать текущие задачи при остановке
+
+class JobQueue:
+    """Постоянная очередь задач в SQLite с арендой, подтверждением и повторами."""
+
+    def __init__(self, path=JOB_QUEUE_DB, lease=JOB_LEASE_SECONDS, max_attempts=JOB_MAX_ATTEMPTS,
+                 per_user_limit=JOB_USER_QUEUE_LIMIT):
+        self.lease = lease
+        self.max_attempts = max(1, max_attempts)
+        self.per_user_limit = max(1, per_user_limit)
+        self._lock = threading.Lock()
+        # Транзакции открываем сами (BEGIN IMMEDIATE), чтобы два процесса не забрали одну задачу
+        self._db = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS jobs ("
+                         "id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL, "
+                         "round INTEGER NOT NULL, payload TEXT NOT NULL, "
+                         "state TEXT NOT NULL DEFAULT 'queued', attempts INTEGER NOT NULL DEFAULT 0, "
+                         "worker TEXT, lease_until REAL, created_at REAL NOT NULL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS jobs_order ON jobs (state, round, id)")
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._db
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+
+    def _enqueue(self, user_id, payload):
+        with self._transaction() as db:
+            queued, active = db.execute("SELECT COUNT(CASE WHEN state = 'queued' THEN 1 END), COUNT(*) "
+                                        "FROM jobs WHERE user_id = ?", (user_id,)).fetchone()
+            if queued >= self.per_user_limit:
+                raise QueueFullError(user_id)
+            # Номер "круга": задачи выдаются по кругу между пользователями, как в JobScheduler
+            cursor = db.execute("INSERT INTO jobs (user_id, round, payload, created_at) VALUES (?, ?, ?, ?)",
+                                (user_id, active, json.dumps(payload), time.time()))
+            return cursor.lastrowid
+
+    def _claim(self, worker):
+        now = time.time()
+        with self._transaction() as db:
+            # Задачи упавших воркеров: возвращаем в очередь или отказываемся после JOB_MAX_ATTEMPTS попыток
+            abandoned = []
+            for job_id, attempts, payload in db.execute("SELECT id, attempts, payload FROM jobs "
+                                                        "WHERE state = 'running' AND lease_until < ?",
+                                                        (now,)).fetchall():
+                if attempts >= self.max_attempts:
+                    db.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+                    abandoned.append(json.loads(payload))
+                else:
+                    db.execute("UPDATE jobs SET state = 'queued', worker = NULL WHERE id = ?", (job_id,))
+            row = db.execute("SELECT id, payload, attempts, created_at FROM jobs WHERE state = 'queued' "
+                             "ORDER BY round, id LIMIT 1").fetchone()
+            if row is None:
+                return None, abandoned
+            job_id, payload, attempts, created_at = row
+            db.execute("UPDATE jobs SET state = 'running', worker = ?, lease_until = ?, attempts = attempts + 1 "
+                       "WHERE id = ?", (worker, now + self.lease, job_id))
+            return (job_id, json.loads(payload), attempts + 1, created_at), abandoned
+
+    def _extend(self, job_id, worker):
+        with self._transaction() as db:
+            cursor = db.execute("UPDATE jobs SET lease_until = ? WHERE id = ? AND worker = ? AND state = 'running'",
+                                (time.time() + self.lease, job_id, worker))
+            return cursor.rowcount > 0
+
+    def _ack(self, job_id, worker):
+        with self._transaction() as db:
+            db.execute("DELETE FROM jobs WHERE id = ? AND worker = ?", (job_id, worker))
+
+    def _release(self, job_id, worker, count_attempt):
+        with self._transaction() as db:
+            row = db.execute("SELECT attempts, payload FROM jobs WHERE id = ? AND worker = ?",
+                             (job_id, worker)).fetchone()
+            if row is None:
+                return None
+            attempts, payload = row
+            if not count_attempt:
+                attempts -= 1 # Задачу не начинали всерьез (остановка воркера) - попытку не засчитываем
+            if attempts >= self.max_attempts:
+                db.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+                return json.loads(payload)
+            db.execute("UPDATE jobs SET state = 'queued', worker = NULL, attempts = ? WHERE id = ?",
+                       (attempts, job_id))
+            return None
+
+    def _counts(self):
+        with self._lock:
+            return dict(self._db.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall())
+
+    async def enqueue(self, user_id, payload):
+        """Кладет задачу в очередь. Выбрасывает QueueFullError, если у пользователя слишком много задач."""
+        return await asyncio.to_thread(self._enqueue, user_id, payload)
+
+    async def claim(self, worker):
+        """Забирает следующую задачу: ((id, payload, попытка, время постановки) или None, брошенные задачи)."""
+        return await asyncio.to_thread(self._claim, worker)
+
+    async def extend(self, job_id, worker):
+        """Продлевает аренду. False - задачу уже отдали другому воркеру."""
+        return await asyncio.to_thread(self._extend, job_id, worker)
+
+    async def ack(self, job_id, worker):
+        """Подтверждает выполнение: задача удаляется из очереди."""
+        await asyncio.to_thread(self._ack, job_id, worker)
+
+    async def release(self, job_id, worker, count_attempt=True):
+        """Возвращает задачу в очередь. Если попытки исчерпаны, удаляет ее и возвращает payload."""
+        return await asyncio.to_thread(self._release, job_id, worker, count_attempt)
+
+    async def report(self):
+        try:
+            counts = await asyncio.to_thread(self._counts)
+        except sqlite3.Error as e:
+            return f"ошибка чтения очереди: {e}"
+        return f"в очереди: {counts.get('queued', 0)}, выполняется: {counts.get('running', 0)}"
+
+job_queue = None # Открывается в open_storage(), если очередь включена или это воркер
+
+def open_storage(worker=False):
+    """Открывает файлы SQLite: кэш file_id и очередь задач. Как и load_bot_files(), вызывается при запуске."""
+    global file_id_cache, job_queue
+    if file_id_cache is None:
+        file_id_cache = FileIdCache()
+    if job_queue is None and (JOB_QUEUE_ENABLED or worker):
+        job_queue = JobQueue()
+
+# --- Исходящие запросы к Bot API: лимиты Telegram, 429 и приоритеты ---
+# Telegram пропускает от бота примерно 30 сообщений в секунду всего и около 1 в секунду в один чат.
+# Все запросы telebot, адресованные чату, проходят через один диспетчер: он выдает разрешения
+# по токен-бакетам (общему и на каждый чат) - сначала видео, потом текст, потом статусы.
+# Устаревшие статусы (правка сообщения, которое уже снова правят или удаляют) выбрасываются,
+# не дойдя до Telegram. На ответ 429 чат замолкает на retry_after секунд, и запрос повторяется.
+OUTBOUND_GLOBAL_RATE = float(os.environ.get('OUTBOUND_GLOBAL_RATE', '30')) # Сообщений в секунду на всего бота (0 - без лимита)
+OUTBOUND_CHAT_RATE = float(os.environ.get('OUTBOUND_CHAT_RATE', '1')) # Сообщений в секунду в один чат (0 - без лимита)
+OUTBOUND_CHAT_BURST = int(os.environ.get('OUTBOUND_CHAT_BURST', '3')) # Сколько сообщений в чат можно отправить подряд без ожидания
+OUTBOUND_MAX_RETRIES = int(os.environ.get('OUTBOUND_MAX_RETRIES', '5')) # Повторов после 429
+# Приоритеты (меньше - раньше): доставка медиа важнее текста, текст важнее статусов
+OUTBOUND_STATUS_PRIORITY = 2 # Статусы не забирают последний токен чата - он остается для видео
+OUTBOUND_PRIORITIES = {'sendVideo': 0, 'sendMediaGroup': 0, 'sendPhoto': 0, 'sendDocument': 0,
+                       'editMessageText': OUTBOUND_STATUS_PRIORITY}
+OUTBOUND_DEFAULT_PRIORITY = 1
+# Эти методы не создают сообщений: токены на них не тратим, но паузу после 429 соблюдаем
+OUTBOUND_UNMETERED = {'sendChatAction', 'deleteMessage'}
+
+class TokenBucket:
+    """Токен-бакет: rate токенов в секунду, не больше capacity подряд."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = max(1.0, capacity)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0 # После 429 до этого момента (time.monotonic) ничего не отправляем
+
+    def delay(self, now, reserve=0):
+        """Через сколько секунд можно будет взять токен, оставив reserve токенов (0 - можно сейчас)."""
+        pause = max(0.0, self.paused_until - now)
+        if self.rate <= 0:
+            return pause
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        needed = min(1 + reserve, self.capacity)
+        return max(pause, 0.0 if self.tokens >= needed else (needed - self.tokens) / self.rate)
+
+    def take(self):
+        if self.rate > 0:
+            self.tokens -= 1
+
+    def idle(self, now):
+        return self.delay(now) == 0 and self.tokens >= self.capacity
+
+class _Permit:
+    def __init__(self, method, chat_id):
+        self.priority = OUTBOUND_PRIORITIES.get(method, OUTBOUND_DEFAULT_PRIORITY)
+        self.chat_id = chat_id
+        self.future = asyncio.get_running_loop().create_future() # True - отправлять, False - запрос устарел
+
+class OutboundDispatcher:
+    """Выдает разрешения на запросы к Bot API с учетом лимитов, приоритетов и ответов 429."""
+
+    def __init__(self, global_rate=OUTBOUND_GLOBAL_RATE, chat_rate=OUTBOUND_CHAT_RATE, chat_burst=OUTBOUND_CHAT_BURST):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.global_bucket = TokenBucket(global_rate, global_rate) # Не больше секундного запаса подряд
+        self._chat_buckets = {}
+        self._waiting = [] # Ожидающие разрешения в порядке поступления
+        self._edits = {} # (chat_id, message_id) -> ожидающая правка этого сообщения
+        self._timer = None
+        self.dropped = 0
+        self.throttled = 0
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) > 10000: # Забываем чаты, которые давно ничего не получали
+                now = time.monotonic()
+                self._chat_buckets = {key: value for key, value in self._chat_buckets.items() if not value.idle(now)}
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    def _drop(self, permit):
+        self._waiting.remove(permit)
+        permit.future.set_result(False)
+
+    def _grant(self):
+        """Раздает разрешения по приоритету; если кому-то не хватило токенов - заводит таймер."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        now = time.monotonic()
+        next_delay = None
+        for permit in sorted(self._waiting, key=lambda permit: permit.priority): # sorted устойчив - внутри приоритета по очереди
+            chat_bucket = self._chat_bucket(permit.chat_id)
+            reserve = 1 if permit.priority >= OUTBOUND_STATUS_PRIORITY else 0
+            delay = max(chat_bucket.delay(now, reserve), self.global_bucket.delay(now))
+            if delay > 0:
+                next_delay = delay if next_delay is None else min(next_delay, delay)
+                continue
+            chat_bucket.take()
+            self.global_bucket.take()
+            self._waiting.remove(permit)
+            permit.future.set_result(True)
+        if next_delay is not None:
+            self._timer = asyncio.get_running_loop().call_later(next_delay, self._grant)
+
+    async def acquire(self, method, chat_id, message_id=None):
+        """Ждет разрешения на запрос. Возвращает False, если запрос устарел и отправлять его не нужно."""
+        edit_key = (chat_id, message_id) if message_id is not None else None
+        if method == 'deleteMessage' and edit_key in self._edits:
+            self._drop(self._edits.pop(edit_key)) # Сообщение удаляется - править его уже незачем
+        if method in OUTBOUND_UNMETERED:
+            delay = self._chat_bucket(chat_id).paused_until - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            return True
+
+        permit = _Permit(method, chat_id)
+        if method.startswith('editMessage') and edit_key is not None:
+            if edit_key in self._edits:
+                self._drop(self._edits[edit_key]) # Новая правка заменяет еще не отправленную старую
+            self._edits[edit_key] = permit
+        self._waiting.append(permit)
+        self._grant()
+        try:
+            return await permit.future
+        finally:
+            if edit_key is not None and self._edits.get(edit_key) is permit:
+                del self._edits[edit_key]
+            if permit in self._waiting: # Вызывающий отменен, пока ждал (его future тоже отменено)
+                self._waiting.remove(permit)
+
+    def pause(self, chat_id, seconds):
+        """Telegram ответил 429: в этот чат ничего не отправляем seconds секунд."""
+        bucket = self._chat_bucket(chat_id)
+        bucket.paused_until = max(bucket.paused_until, time.monotonic() + seconds)
+
+    async def call(self, method, params, files, send):
+        """Выполняет send(files) в порядке очереди и повторяет его после 429."""
+        chat_id = params.get('chat_id') if params else None
+        if chat_id is None: # getUpdates, setWebhook и т.п. - не сообщения, отправляем сразу
+            return await send(files)
+        chat_id = str(chat_id)
+        message_id = params.get('message_id')
+        for attempt in range(OUTBOUND_MAX_RETRIES + 1):
+            started = time.perf_counter()
+            if not await self.acquire(method, chat_id, message_id):
+                self.dropped += 1
+                metrics.count('outbound_dropped_total', method=method)
+                return True # Так Bot API отвечает на правку и chat action - вызывающему этого достаточно
+            metrics.observe('outbound_wait_seconds', time.perf_counter() - started)
+            try:
+                return await send(files)
+            except asyncio_helper.ApiTelegramException as e:
+                retry_after = (e.result_json.get('parameters') or {}).get('retry_after') if e.error_code == 429 else None
+                if retry_after is None or attempt == OUTBOUND_MAX_RETRIES:
+                    raise
+                if files:
+                    # aiohttp закрывает отправленные файлы - открываем их заново, а поток из VideoStream читаем с начала
+                    files = _reopen_files(files)
+                    if files is None:
+                        raise
+                self.throttled += 1
+                metrics.count('outbound_throttled_total', method=method)
+                print(f"Telegram просит подождать {retry_after} с ({method}, чат {chat_id}), повтор {attempt + 1}.")
+                self.pause(chat_id, retry_after)
+
+    def report(self):
+        return (f"ожидают отправки: {len(self._waiting)}, выброшено устаревших: {self.dropped}, "
+                f"ответов 429: {self.throttled}")
+
+def _reopen_files(files):
+    """Файлы запроса для повтора: заново открытые с диска или тела, которые умеют начать сначала (replay).
+
+    None - если какой-то файл повторить нельзя.
+    """
+    sources = {}
+    for key, value in files.items():
+        file_name, file = value if isinstance(value, tuple) else (None, value)
+        if hasattr(file, 'replay'):
+            sources[key] = (file_name, file.replay)
+            continue
+        path = getattr(getattr(file, 'file', file), 'name', None) # У telebot.types.InputFile файл лежит в .file
+        if not isinstance(path, str) or not os.path.isfile(path):
+            return None
+        sources[key] = (file_name, functools.partial(open, path, 'rb'))
+    return {key: (file_name, reopen()) if file_name else reopen() for key, (file_name, reopen) in sources.items()}
+
+outbound = OutboundDispatcher()
+_background_tasks = set()
+
+def run_in_background(coro):
+    """Запускает корутину (например, правку статуса) без ожидания, сохраняя ссылку на задачу до ее конца."""
+    task = asyncio.ensure_future(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+_send_api_request = asyncio_helper._process_request
+
+async def _dispatched_request(token, url, method='get', params=None, files=None, **kwargs):
+    # telebot меняет params (забирает timeout), поэтому на каждую попытку - своя копия
+    return await outbound.call(url, params, files,
+                               lambda files: _send_api_request(token, url, method, dict(params) if params else params, files, **kwargs))
+
+asyncio_helper._process_request = _dispatched_request # Все методы AsyncTeleBot идут через диспетчер
+
+# --- Ответы на сообщения ---
+# В режиме webhook простой текстовый ответ можно вернуть прямо в HTTP-ответе на webhook
+# (Telegram сам выполнит указанный метод) - это экономит один запрос к Bot API.
+_inline_reply = contextvars.ContextVar('inline_reply', default=None)
+
+class _InlineReply:
+    """Место для ответа, который можно вернуть в теле ответа на webhook."""
+
+    def __init__(self):
+        self.payload = None
+        self.ready = asyncio.Event()
+        self.closed = False # HTTP-ответ уже отправлен - дальше отвечаем только через API
+
+    def offer(self, payload):
+        if self.closed or self.payload is not None:
+            return False
+        self.payload = payload
+        self.ready.set()
+        return True
+
+async def reply_text(chat_id, text, parse_mode=None):
+    """Отправляет текстовый ответ. Используется только для последнего ответа обработчика,
+    поэтому при webhook он может уйти в теле ответа без порядка с другими сообщениями."""
+    slot = _inline_reply.get()
+    payload = {'method': 'sendMessage', 'chat_id': chat_id, 'text': text}
+    if parse_mode:
+        payload['parse_mode'] = parse_mode
+    if slot is not None and slot.offer(payload):
+        return
+    await bot.send_message(chat_id, text, parse_mode=parse_mode)
 
 # --- Обработчики команд бота ---
 
@@ -254,21 +2008,21 @@ async def download_video_playwright(url):
 async def start_command(message: telebot.types.Message):
     """Обработчик команды /start - приветственное сообщение."""
     log_access(message) # Логируем заход
-    await bot.send_message(message.chat.id, "👋 Привет! Я бот для скачивания видео из Instagram.\n\n"
+    await reply_text(message.chat.id, "👋 Привет! Я бот для скачивания видео из Instagram.\n\n"
                              "Просто отправь мне ссылку на Instagram Reels, и я постараюсь его скачать и отправить тебе! 🚀")
 
-@bot.message_handler(commands=['add', 'del', 'list'])
+@bot.message_handler(commands=['add', 'del', 'list', 'trace'])
 async def admin_commands(message: telebot.types.Message):
-    """Обработчик команд администратора: /add, /del, /list."""
+    """Обработчик команд администратора: /add, /del, /list, /trace."""
     # Проверяем наличие username у отправителя команды
     admin_username = message.from_user.username
     if not admin_username:
-         await bot.send_message(message.chat.id, "🚫 Для использования команд администратора у вас должен быть установлен username в Telegram.")
+         await reply_text(message.chat.id, "🚫 Для использования команд администратора у вас должен быть установлен username в Telegram.")
          return
 
     # Проверяем права администратора
     if admin_username != ADMIN_USERNAME:
-        await bot.send_message(message.chat.id, "🚫 У вас нет прав администратора для выполнения этой команды.")
+        await reply_text(message.chat.id, "🚫 У вас нет прав администратора для выполнения этой команды.")
         return
 
     # Обработка самой команды
@@ -278,162 +2032,778 @@ async def admin_commands(message: telebot.types.Message):
     if command == 'list':
         users = read_users_file()
         if users:
-            # Форматируем список с @ перед каждым именем
-            users_list_text = "\n".join([f"@{u}" for u in users])
-            await bot.send_message(message.chat.id, f"👥 Список авторизованных пользователей:\n{users_list_text}")
+            # Форматируем список с @ перед каждым именем (числовые id без @)
+            users_list_text = "\n".join([display_user(u) for u in users])
+            await reply_text(message.chat.id, f"👥 Список авторизованных пользователей:\n{users_list_text}")
         else:
-             await bot.send_message(message.chat.id, "👥 Список авторизованных пользователей пуст.")
+             await reply_text(message.chat.id, "👥 Список авторизованных пользователей пуст.")
 
     elif command == 'add':
         if len(command_parts) < 2:
-            await bot.send_message(message.chat.id, "⚠️ Пожалуйста, укажите username для добавления после команды /add (например, `/add someusername`).", parse_mode='Markdown')
+            await reply_text(message.chat.id, "⚠️ Пожалуйста, укажите username или числовой id для добавления после команды /add (например, `/add someusername` или `/add 123456789`).", parse_mode='Markdown')
             return
         # Убираем возможное @ в начале имени пользователя
         username_to_add = command_parts[1].lstrip('@')
         if not username_to_add: # Проверка на пустой username после lstrip
-            await bot.send_message(message.chat.id, "⚠️ Пожалуйста, укажите корректный username для добавления.")
+            await reply_text(message.chat.id, "⚠️ Пожалуйста, укажите корректный username для добавления.")
             return
 
         if add_user_to_file(username_to_add):
-            await bot.send_message(message.chat.id, f"✅ Пользователь @{username_to_add} успешно добавлен.")
-            print(f"Admin @{admin_username} added user @{username_to_add}") # Лог в консоль
+            await reply_text(message.chat.id, f"✅ Пользователь {display_user(username_to_add)} успешно добавлен.")
+            print(f"Admin @{admin_username} added user {display_user(username_to_add)}") # Лог в консоль
         else:
-            await bot.send_message(message.chat.id, f"⚠️ Пользователь @{username_to_add} уже есть в списке.")
+            await reply_text(message.chat.id, f"⚠️ Пользователь {display_user(username_to_add)} уже есть в списке.")
 
     elif command == 'del':
         if len(command_parts) < 2:
-            await bot.send_message(message.chat.id, "⚠️ Пожалуйста, укажите username для удаления после команды /del (например, `/del someusername`).", parse_mode='Markdown')
+            await reply_text(message.chat.id, "⚠️ Пожалуйста, укажите username или числовой id для удаления после команды /del (например, `/del someusername` или `/del 123456789`).", parse_mode='Markdown')
             return
         # Убираем возможное @ в начале имени пользователя
         username_to_delete = command_parts[1].lstrip('@')
         if not username_to_delete: # Проверка на пустой username после lstrip
-            await bot.send_message(message.chat.id, "⚠️ Пожалуйста, укажите корректный username для удаления.")
+            await reply_text(message.chat.id, "⚠️ Пожалуйста, укажите корректный username для удаления.")
             return
 
         if delete_user_from_file(username_to_delete):
-            await bot.send_message(message.chat.id, f"✅ Пользователь @{username_to_delete} успешно удален.")
-            print(f"Admin @{admin_username} deleted user @{username_to_delete}") # Лог в консоль
+            await reply_text(message.chat.id, f"✅ Пользователь {display_user(username_to_delete)} успешно удален.")
+            print(f"Admin @{admin_username} deleted user {display_user(username_to_delete)}") # Лог в консоль
+        else:
+            await reply_text(message.chat.id, f"⚠️ Пользователь {display_user(username_to_delete)} не найден в списке.")
+
+    elif command == 'trace':
+        if len(command_parts) < 2:
+            traced = ", ".join(sorted(trace_users)) or "никого"
+            await reply_text(message.chat.id, f"🔍 Трассировка включена для: {traced}.\nВключить/выключить: `/trace username` или `/trace 123456789`.", parse_mode='Markdown')
+            return
+        user_to_trace = command_parts[1].lstrip('@')
+        if user_to_trace in trace_users:
+            trace_users.discard(user_to_trace)
+            await reply_text(message.chat.id, f"🔍 Трассировка для {user_to_trace} выключена.")
+        else:
+            trace_users.add(user_to_trace)
+            await reply_text(message.chat.id, f"🔍 Трассировка для {user_to_trace} включена, этапы запросов печатаются в лог.")
+
+async def send_downloaded_video(chat_id, flight, shortcode):
+    """Отправляет скачанное видео. Если другой участник single-flight уже загрузил его, шлет по file_id."""
+    video = flight.result
+
+    async with flight.send_lock:
+        if flight.file_id:
+            try:
+                with metrics.stage('telegram_send_file_id'):
+                    await bot.send_video(chat_id, flight.file_id)
+                print("Видео отправлено по file_id из общей загрузки.")
+                metrics.count('requests_total', result='sent_shared')
+                return
+            except asyncio_helper.ApiTelegramException as e:
+                print(f"Не удалось отправить видео по file_id, загружаем файл: {e}")
+
+        # Отправляем видео как файл
+        # Используем try-except для отправки, чтобы поймать возможные ошибки Telegram API
+        started = time.perf_counter()
+        try:
+            await bot.send_chat_action(chat_id, 'upload_video') # Показываем статус "отправка видео"
+            with metrics.stage('telegram_upload'):
+                if isinstance(video, VideoStream):
+                    # Байты идут в Telegram по мере скачивания с CDN
+                    sent_message = await bot.send_video(chat_id, ('video.mp4', video.upload_payload()), timeout=60)
+                    file_size = await video.wait_complete()
+                elif BOT_API_LOCAL:
+                    # Локальный сервер Bot API сам читает файл с диска
+                    file_size = os.path.getsize(video)
+                    sent_message = await bot.send_video(chat_id, 'file://' + os.path.abspath(video),
+                                                        timeout=60 + file_size // (1024 * 1024))
+                else:
+                    file_size = os.path.getsize(video)
+                    with open(video, 'rb') as video_file:
+                        # Добавляем подпись к видео с оригинальной ссылкой
+                        #caption_text = f"Видео из: {instagram_url}"
+                        sent_message = await bot.send_video(chat_id, video_file, timeout=60) # Увеличим таймаут на отправку
+            print(f"Видео успешно отправлено ({file_size} байт) за {time.perf_counter() - started:.2f} с.")
+            metrics.count('requests_total', result='sent')
+            if sent_message.video:
+                flight.file_id = sent_message.video.file_id
+                if shortcode:
+                    await file_id_cache.put(shortcode, flight.file_id)
+        except asyncio_helper.ApiTelegramException as e:
+            print(f"Ошибка Telegram API при отправке видео: {e}")
+            file_size = video.size if isinstance(video, VideoStream) else os.path.getsize(video)
+            # Проверяем на ошибку размера файла: 413 Request Entity Too Large или "file is too big"
+            if e.error_code == 413 or "file is too big" in str(e).lower():
+                 metrics.count('failures_total', cause='too_big')
+                 await bot.send_message(chat_id, f"😔 Видео скачано, но оно слишком большое для отправки через Telegram (больше {TELEGRAM_UPLOAD_LIMIT // (1024*1024)} МБ).\nРазмер файла: {file_size / (1024*1024):.2f} МБ")
+            else:
+                 metrics.count('failures_total', cause='telegram_error')
+                 await bot.send_message(chat_id, f"Не удалось отправить видео. Ошибка Telegram: {e}")
+        except Exception as e_send:
+            print(f"Неожиданная ошибка при отправке видео: {e_send}")
+            metrics.count('failures_total', cause='upload_error')
+            await bot.send_message(chat_id, f"Произошла неожиданная ошибка при отправке видео.")
+
+async def deliver_video(chat_id, reel_url, shortcode, status_message_id):
+    """Скачивает (или дожидается уже идущей загрузки) и отправляет видео, убирая сообщение о статусе."""
+    # Одинаковые ссылки, присланные одновременно, скачиваются один раз
+    flight_key = shortcode or reel_url
+    async with video_flights.join(flight_key, lambda: download_video(reel_url)) as flight:
+        # Удаляем сообщение "Скачиваю..."
+        try:
+            await bot.delete_message(chat_id, status_message_id)
+        except Exception as e:
+            print(f"Не удалось удалить сообщение о статусе: {e}") # Не критично, просто логируем
+
+        # --- Отправка видео или сообщения об ошибке ---
+        if isinstance(flight.result, VideoTooBigError):
+            metrics.count('failures_total', cause='too_big')
+            await bot.send_message(chat_id, f"😔 Видео слишком большое для отправки через Telegram (больше {TELEGRAM_UPLOAD_LIMIT // (1024*1024)} МБ).\nРазмер файла: {flight.result.size / (1024*1024):.2f} МБ")
+        elif flight.result:
+            await send_downloaded_video(chat_id, flight, shortcode)
+        else:
+             # Если download_video вернул None
+             await bot.send_message(chat_id, "😔 Не удалось скачать видео с этой ссылки. Возможно, ссылка недействительна, видео удалено или сайт ddinstagram временно недоступен.")
+
+async def enqueue_job(message, processing_message, **payload):
+    """Кладет задачу (рилс или несколько ссылок) в очередь SQLite; выполнит ее один из процессов-воркеров."""
+    payload.update(chat_id=message.chat.id, user_id=message.from_user.id,
+                   status_message_id=processing_message.message_id)
+    try:
+        job_id = await job_queue.enqueue(message.from_user.id, payload)
+    except QueueFullError:
+        metrics.count('failures_total', cause='queue_full')
+        await bot.edit_message_text(f"⚠️ У вас уже {JOB_USER_QUEUE_LIMIT} ссылок в очереди. Дождитесь, пока они скачаются, и отправьте эту ссылку еще раз.",
+                                    message.chat.id, processing_message.message_id)
+        return
+    except sqlite3.Error as e:
+        print(f"Не удалось поставить задачу в очередь: {e}")
+        metrics.count('failures_total', cause='unexpected')
+        await bot.edit_message_text("😔 Не удалось поставить ссылку в очередь. Попробуйте позже.",
+                                    message.chat.id, processing_message.message_id)
+        return
+    print(f"Задача {job_id} поставлена в очередь воркеров ({await job_queue.report()}).")
+
+# --- Несколько ссылок, посты и карусели: параллельное скачивание и отправка альбомами ---
+MEDIA_GROUP_SIZE = 10 # Больше элементов в одном альбоме Telegram не принимает
+MESSAGE_LINK_LIMIT = int(os.environ.get('MESSAGE_LINK_LIMIT', '10')) # Сколько ссылок из одного сообщения обрабатывать
+# Сколько слайдов одной карусели качать одновременно: вся карусель занимает одно место в планировщике,
+# а каждый большой файл качается еще и RANGE_PARTS потоками
+SLIDE_DOWNLOAD_CONCURRENCY = int(os.environ.get('SLIDE_DOWNLOAD_CONCURRENCY', '2'))
+
+class MediaItem:
+    """Один элемент для отправки: видео или фото из временного файла либо по file_id."""
+
+    def __init__(self, kind, path=None, file_id=None, cache_key=None):
+        self.kind = kind # 'video' или 'photo'
+        self.path = path # Временный файл, удаляется после отправки
+        self.file_id = file_id # Файл, уже загруженный в Telegram
+        self.cache_key = cache_key # shortcode, если это единственное видео поста: его file_id кэшируем
+        self.size = os.path.getsize(path) if path else 0
+
+async def download_post(link):
+    """Находит все медиа по ссылке (у карусели - все слайды) и скачивает их, не больше SLIDE_DOWNLOAD_CONCURRENCY сразу.
+
+    Возвращает список результатов по элементам: MediaItem, VideoTooBigError или None.
+    """
+    with metrics.stage('video_url_lookup'):
+        media = await extract_media_hedged(link)
+    if not media:
+        print(f"Не удалось найти медиа по ссылке {link}.")
+        metrics.count('failures_total', cause='no_video_url')
+        return [None]
+    if len(media) > 1:
+        print(f"Карусель {link}: {len(media)} элементов.")
+    slots = asyncio.Semaphore(max(1, SLIDE_DOWNLOAD_CONCURRENCY))
+
+    async def download_slide(kind, media_url):
+        async with slots:
+            return await download_to_temp_file(media_url, '.mp4' if kind == 'video' else '.jpg')
+
+    results = await asyncio.gather(*(download_slide(kind, media_url) for kind, media_url in media))
+    cache_key = reel_shortcode(link) if len(media) == 1 and media[0][0] == 'video' else None
+    return [MediaItem(kind, path=result, cache_key=cache_key) if isinstance(result, str) else result
+            for (kind, _), result in zip(media, results)]
+
+def media_groups(items):
+    """Делит элементы на альбомы: не больше MEDIA_GROUP_SIZE штук, а при multipart-загрузке - не больше лимита по объему."""
+    groups, group, group_size = [], [], 0
+    for item in items:
+        upload_size = 0 if BOT_API_LOCAL else item.size
+        if group and (len(group) == MEDIA_GROUP_SIZE or group_size + upload_size > TELEGRAM_UPLOAD_LIMIT):
+            groups.append(group)
+            group, group_size = [], 0
+        group.append(item)
+        group_size += upload_size
+    if group:
+        groups.append(group)
+    return groups
+
+def _media_input(item, files):
+    if item.file_id:
+        return item.file_id
+    if BOT_API_LOCAL:
+        return 'file://' + os.path.abspath(item.path) # Локальный сервер Bot API сам читает файл с диска
+    return files.enter_context(open(item.path, 'rb'))
+
+async def _send_group(chat_id, group):
+    timeout = 60 + sum(item.size for item in group) // (1024 * 1024)
+    with contextlib.ExitStack() as files:
+        if len(group) == 1: # Альбом из одного элемента Telegram не принимает
+            item = group[0]
+            send = bot.send_video if item.kind == 'video' else bot.send_photo
+            messages = [await send(chat_id, _media_input(item, files), timeout=timeout)]
         else:
-            await bot.send_message(message.chat.id, f"⚠️ Пользователь @{username_to_delete} не найден в списке.")
+            media = [(telebot.types.InputMediaVideo if item.kind == 'video' else telebot.types.InputMediaPhoto)(_media_input(item, files))
+                     for item in group]
+            messages = await bot.send_media_group(chat_id, media, timeout=timeout)
+    for item, sent_message in zip(group, messages):
+        if item.cache_key and not item.file_id and sent_message.video:
+            await file_id_cache.put(item.cache_key, sent_message.video.file_id)
+
+async def send_media_items(chat_id, group):
+    """Отправляет группу одним альбомом; если Telegram отказал - по одному элементу. Возвращает число отправленных."""
+    try:
+        with metrics.stage('telegram_upload'):
+            await _send_group(chat_id, group)
+        return len(group)
+    except asyncio_helper.ApiTelegramException as e:
+        print(f"Ошибка Telegram API при отправке {len(group)} элементов: {e}")
+        if len(group) > 1:
+            # Повторяем по одному: ошибка одного элемента (например, устаревший file_id) не теряет остальные
+            return sum([await send_media_items(chat_id, [item]) for item in group])
+        if group[0].file_id and group[0].cache_key:
+            await file_id_cache.delete(group[0].cache_key) # file_id мог стать недействительным
+        return 0
+
+async def deliver_links(chat_id, user_id, links, status_message_id):
+    """Скачивает все элементы по ссылкам параллельно (в пределах общего лимита задач) и отправляет альбомами."""
+    downloaded = [] # Все скачанные элементы - чтобы удалить временные файлы в любом случае
+    batch = object() # Ссылки одного сообщения занимают в очереди пользователя одно место
+
+    async def fetch(link):
+        shortcode = reel_shortcode(link)
+        if shortcode:
+            with metrics.stage('cache_lookup'):
+                cached_file_id = await file_id_cache.get(shortcode)
+            if cached_file_id:
+                return [MediaItem('video', file_id=cached_file_id, cache_key=shortcode)]
+        try:
+            results = await job_scheduler.run(user_id, lambda: download_post(link), batch=batch)
+        except QueueFullError as e:
+            metrics.count('failures_total', cause='queue_full')
+            return [e]
+        except Exception as e:
+            print(f"Ошибка при скачивании {link}: {e}")
+            traceback.print_exc()
+            metrics.count('failures_total', cause='unexpected')
+            return [None]
+        downloaded.extend(result for result in results if isinstance(result, MediaItem))
+        return results
+
+    try:
+        results = [result for post in await asyncio.gather(*(fetch(link) for link in links)) for result in post]
+        print(f"Очередь задач: {job_scheduler.report()}")
+        try:
+            await bot.delete_message(chat_id, status_message_id)
+        except Exception as e:
+            print(f"Не удалось удалить сообщение о статусе: {e}")
+
+        items = [result for result in results if isinstance(result, MediaItem)]
+        too_big = [result for result in results if isinstance(result, VideoTooBigError)]
+        queue_full = sum(isinstance(result, QueueFullError) for result in results)
+        sent = 0
+        for group in media_groups(items):
+            sent += await send_media_items(chat_id, group)
+        print(f"Отправлено {sent} из {len(results)} элементов по {len(links)} ссылкам.")
+        if sent:
+            metrics.count('requests_total', result='sent_batch')
+
+        # --- Сообщение о том, что отправить не удалось ---
+        problems = []
+        if too_big:
+            metrics.count('failures_total', len(too_big), cause='too_big')
+            problems.append(f"слишком большие для Telegram (больше {TELEGRAM_UPLOAD_LIMIT // (1024*1024)} МБ): {len(too_big)}")
+        if queue_full:
+            problems.append(f"не поместились в очередь (у вас уже {JOB_USER_QUEUE_LIMIT} ссылок в очереди): {queue_full}")
+        failed = len(results) - sent - len(too_big) - queue_full
+        if failed:
+            problems.append(f"не удалось скачать или отправить: {failed}")
+        if problems:
+            await bot.send_message(chat_id, f"😔 Отправлено {sent} из {len(results)}.\n" + "\n".join(problems))
+    finally:
+        for item in downloaded:
+            remove_temp_file(item.path)
+
+async def process_links(message: telebot.types.Message, links):
+    """Несколько ссылок или пост (возможно, карусель) от авторизованного пользователя."""
+    print(f"Ссылки для обработки: {', '.join(links)}")
+    processing_message = await bot.send_message(message.chat.id, "⏳ Ищу и скачиваю видео... Пожалуйста, подождите.")
+    if JOB_QUEUE_ENABLED:
+        await enqueue_job(message, processing_message, links=links)
+        return
+    await deliver_links(message.chat.id, message.from_user.id, links, processing_message.message_id)
+
+async def process_reel(message: telebot.types.Message, instagram_url):
+    """Отправляет видео по ссылке авторизованного пользователя: из кэша или через очередь загрузок."""
+    # --- Проверка кэша file_id: если рилс уже отправляли, переотправляем без скачивания ---
+    shortcode = reel_shortcode(instagram_url)
+    if shortcode:
+        with metrics.stage('cache_lookup'):
+            cached_file_id = await file_id_cache.get(shortcode)
+        print(f"Кэш file_id: {file_id_cache.report()}")
+        if cached_file_id:
+            try:
+                await bot.send_video(message.chat.id, cached_file_id)
+                print(f"Видео {shortcode} отправлено из кэша file_id.")
+                metrics.count('requests_total', result='sent_cached')
+                return
+            except asyncio_helper.ApiTelegramException as e:
+                # file_id мог стать недействительным - удаляем запись и качаем заново
+                print(f"Не удалось отправить видео {shortcode} по file_id: {e}")
+                await file_id_cache.delete(shortcode)
+
+    # --- Процесс скачивания ---
+    # Убираем параметры типа ?igsh=... , так как ddinstagram может их не любить.
+    # Домен instagram.com заменяется на зеркало уже при скачивании (см. MIRROR_HOSTS)
+    reel_url = instagram_url.split('?')[0]
+    print(f"URL для обработки: {reel_url}")
+
+    # Отправляем сообщение о начале скачивания
+    processing_message = await bot.send_message(message.chat.id, "⏳ Ищу и скачиваю видео... Пожалуйста, подождите.")
+    if JOB_QUEUE_ENABLED:
+        # Скачиванием и отправкой займется один из процессов-воркеров
+        await enqueue_job(message, processing_message, reel_url=reel_url, shortcode=shortcode)
+        return
+
+    deliver = lambda: deliver_video(message.chat.id, reel_url, shortcode, processing_message.message_id)
+
+    if (shortcode or reel_url) in video_flights:
+        # Такой же рилс уже скачивается - просто ждем его, место в очереди не занимаем
+        await deliver()
+        return
+
+    was_queued = False
+
+    async def show_queue_position(position):
+        nonlocal was_queued
+        was_queued = True
+        await bot.edit_message_text(f"⏳ Ваша ссылка в очереди, место: {position}. Пожалуйста, подождите.",
+                                    message.chat.id, processing_message.message_id)
+
+    async def restore_status():
+        try:
+            await bot.edit_message_text("⏳ Ищу и скачиваю видео... Пожалуйста, подождите.",
+                                        message.chat.id, processing_message.message_id)
+        except Exception as e:
+            print(f"Не удалось обновить сообщение о статусе: {e}")
+
+    async def deliver_when_ready():
+        if was_queued: # Очередь подошла - возвращаем обычный статус, но скачивание ради этого не ждет
+            run_in_background(restore_status())
+        await deliver()
+
+    try:
+        await job_scheduler.run(message.from_user.id, deliver_when_ready, on_position=show_queue_position)
+    except QueueFullError:
+        metrics.count('failures_total', cause='queue_full')
+        await bot.edit_message_text(f"⚠️ У вас уже {JOB_USER_QUEUE_LIMIT} ссылок в очереди. Дождитесь, пока они скачаются, и отправьте эту ссылку еще раз.",
+                                    message.chat.id, processing_message.message_id)
+    print(f"Очередь задач: {job_scheduler.report()}")
+    print(f"Исходящие запросы: {outbound.report()}")
 
 # --- Обработчик текстовых сообщений (основная функция бота) ---
 @bot.message_handler(func=lambda message: message.text is not None and not message.text.startswith("/")) # Обработка всех текстовых сообщений, НЕ являющихся командами
 async def make_some(message: telebot.types.Message):
-    """Обработчик текстовых сообщений, включая проверку на ссылку Reel и ответ на любой другой текст."""
+    """Обработчик текстовых сообщений, включая поиск ссылок Instagram и ответ на любой другой текст."""
 
-    # Проверка на ссылку Reel (более гибкая)
+    # Ищем все ссылки на рилсы, посты и IGTV (instagram.com и instagr.am, с лишним текстом вокруг)
     text = message.text.strip() # Убираем пробелы по краям
-    if "instagram.com/reel/" in text:
-        # Извлекаем URL, даже если в сообщении есть лишний текст
-        # Простой способ: ищем первое вхождение https://...instagram.com/reel/...
-        url_start_index = text.find("https://www.instagram.com/reel/")
-        if url_start_index == -1:
-             url_start_index = text.find("https://instagram.com/reel/") # Без www
-
-        if url_start_index != -1:
-            # Находим конец URL (пробел, перенос строки или конец строки)
-            url_end_index = len(text)
-            for char in [' ', '\n', '\t']:
-                found_index = text.find(char, url_start_index)
-                if found_index != -1:
-                    url_end_index = min(url_end_index, found_index)
-            instagram_url = text[url_start_index:url_end_index]
-            print(f"Извлечен URL: {instagram_url}")
-        else:
-            # Если не нашли по https, может быть без него? Маловероятно, но для полноты
-            if text.startswith("instagram.com/reel/") or text.startswith("www.instagram.com/reel/"):
-                 instagram_url = "https://" + text.split()[0] # Берем первое слово
-                 print(f"Извлечен URL (без https): {instagram_url}")
-            else:
-                 await bot.send_message(message.chat.id, "🤔 Не смог точно распознать ссылку на Instagram Reel в вашем сообщении.")
-                 return # Выходим, если URL не извлечен
+    links = extract_instagram_links(text)
+    if links:
+        print(f"Извлечены ссылки: {', '.join(links)}")
 
         # --- Проверка авторизации ---
         if not is_user_authorized(message):
             # Получаем username администратора для сообщения
             admin_contact = f"@{ADMIN_USERNAME}" if ADMIN_USERNAME else "администратору"
-            await bot.send_message(message.chat.id, f"🔒 Извините, у вас нет доступа к этому боту.\n\n"
+            await reply_text(message.chat.id, f"🔒 Извините, у вас нет доступа к этому боту.\n\n"
                                      f"Обратитесь к {admin_contact}, чтобы получить разрешение на использование.")
             # Дополнительно логируем попытку неавторизованного доступа
             user_info = f"user_id={message.from_user.id}"
             if message.from_user.username:
                 user_info += f", username=@{message.from_user.username}"
-            print(f"Неавторизованная попытка доступа от {user_info} со ссылкой: {instagram_url}")
+            print(f"Неавторизованная попытка доступа от {user_info} со ссылками: {', '.join(links)}")
             return
 
         log_access(message) # Логируем успешный авторизованный доступ
 
-        # --- Процесс скачивания ---
-        ddinstagram_url = instagram_url.replace("instagram.com", "ddinstagram.com")
-        # Убираем параметры типа ?igsh=... , так как ddinstagram может их не любить
-        ddinstagram_url = ddinstagram_url.split('?')[0]
-        print(f"ddinstagram URL для обработки: {ddinstagram_url}")
+        if len(links) > MESSAGE_LINK_LIMIT:
+            await bot.send_message(message.chat.id, f"⚠️ В сообщении {len(links)} ссылок, скачаю первые {MESSAGE_LINK_LIMIT}.")
+            links = links[:MESSAGE_LINK_LIMIT]
 
-        # Отправляем сообщение о начале скачивания
-        processing_message = await bot.send_message(message.chat.id, "⏳ Ищу и скачиваю видео... Пожалуйста, подождите.")
+        trace = start_trace(message) # Отладочная трассировка для пользователей из /trace
+        try:
+            with metrics.stage('total'):
+                if len(links) == 1 and '/p/' not in links[0]:
+                    await process_reel(message, links[0]) # Один рилс - потоковая отправка, очередь с местом и т.д.
+                else:
+                    await process_links(message, links) # Несколько ссылок или пост, который может быть каруселью
+        finally:
+            _trace.set(None)
+            print_trace(trace, message)
 
-        video_path = await download_video_playwright(ddinstagram_url)
+    # Обработка других ссылок Instagram (профили, истории и т.п.)
+    elif "instagram.com/" in text or "instagr.am/" in text:
+        await reply_text(message.chat.id, "⚠️ Похоже, это ссылка на Instagram, но не на рилс или пост.\n"
+                                 "Я умею скачивать рилсы, посты (включая карусели) и IGTV: ссылки вида `https://www.instagram.com/reel/...`, `/p/...`, `/tv/...`.")
 
-        # Удаляем сообщение "Скачиваю..."
+    # Обработка любого другого текста
+    else:
+        await reply_text(message.chat.id, "🤔 Чтобы я скачал видео, отправь мне, пожалуйста, ссылку на Instagram Reel.")
+
+
+# --- Режим webhook (встроенный HTTP-сервер aiohttp) ---
+# Если задан WEBHOOK_URL, бот получает обновления через webhook вместо long polling.
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL') # Публичный адрес, например https://example.com (путь добавится сам)
+WEBHOOK_LISTEN = os.environ.get('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.environ.get('WEBHOOK_PORT', '8443'))
+WEBHOOK_PATH = os.environ.get('WEBHOOK_PATH', '/telegram-webhook')
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET') or secrets.token_urlsafe(32) # Проверяется в заголовке каждого запроса
+WEBHOOK_INLINE_WAIT = float(os.environ.get('WEBHOOK_INLINE_WAIT', '0.5')) # Сколько ждать ответа, чтобы вернуть его прямо в webhook
+WEBHOOK_MAX_CONNECTIONS = int(os.environ.get('WEBHOOK_MAX_CONNECTIONS', '40'))
+
+_update_tasks = set()
+
+async def _process_update(update, slot):
+    _inline_reply.set(slot) # Контекст задачи: reply_text увидит место для ответа именно этого обновления
+    try:
+        await bot.process_new_updates([update])
+    except Exception as e:
+        print(f"Ошибка обработки обновления {update.update_id}: {e}")
+        traceback.print_exc()
+
+async def handle_webhook(request):
+    """Принимает обновление от Telegram и обрабатывает его теми же обработчиками, что и polling."""
+    from aiohttp import web
+    token = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+    if not secrets.compare_digest(token.encode(), WEBHOOK_SECRET.encode()): # Сравнение за постоянное время
+        return web.Response(status=403)
+    try:
+        update = telebot.types.Update.de_json(await request.json())
+    except ValueError:
+        return web.Response(status=400)
+
+    slot = _InlineReply()
+    # Каждое обновление обрабатывается в своей задаче, не дожидаясь остальных
+    task = asyncio.create_task(_process_update(update, slot))
+    _update_tasks.add(task)
+    task.add_done_callback(_update_tasks.discard)
+
+    ready = asyncio.ensure_future(slot.ready.wait())
+    await asyncio.wait({ready, task}, timeout=WEBHOOK_INLINE_WAIT, return_when=asyncio.FIRST_COMPLETED)
+    ready.cancel()
+    slot.closed = True
+    if slot.payload is not None:
+        return web.json_response(slot.payload)
+    return web.Response()
+
+def make_webhook_app():
+    from aiohttp import web
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, handle_webhook)
+    return app
+
+async def run_webhook():
+    """Регистрирует webhook в Telegram и обслуживает входящие обновления, пока бот не остановят."""
+    from aiohttp import web
+    runner = web.AppRunner(make_webhook_app())
+    await runner.setup()
+    site = web.TCPSite(runner, WEBHOOK_LISTEN, WEBHOOK_PORT)
+    await site.start()
+    try:
+        await bot.set_webhook(url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET,
+                              drop_pending_updates=True, max_connections=WEBHOOK_MAX_CONNECTIONS)
+        print(f"Webhook запущен на {WEBHOOK_LISTEN}:{WEBHOOK_PORT}{WEBHOOK_PATH}.")
+        await asyncio.Event().wait() # Работаем до отмены (Ctrl+C / остановка процесса)
+    finally:
+        await runner.cleanup()
+
+# --- Polling: свой цикл getUpdates ---
+# bot.polling() при отмене закрывает общую сессию Bot API, и уже принятые сообщения не могут
+# доотправить видео. Этот цикл при отмене просто перестает спрашивать обновления.
+POLLING_TIMEOUT = 20 # Секунд long polling в одном запросе getUpdates
+POLLING_MAX_ERROR_INTERVAL = 60 # Максимальная пауза между повторами после ошибок
+
+async def run_polling(timeout=POLLING_TIMEOUT, skip_pending=True):
+    """Получает обновления через getUpdates, пока задачу не отменят. Каждое обновление обрабатывается в своей задаче."""
+    offset = None
+    if skip_pending:
+        pending = await bot.get_updates(offset=-1)
+        if pending:
+            offset = pending[-1].update_id + 1
+    error_interval = 0.25
+    while True:
         try:
-            await bot.delete_message(message.chat.id, processing_message.message_id)
+            updates = await bot.get_updates(offset=offset, timeout=timeout, request_timeout=timeout + 10)
         except Exception as e:
-            print(f"Не удалось удалить сообщение о статусе: {e}") # Не критично, просто логируем
+            print(f"Ошибка получения обновлений, повтор через {error_interval:.2f} с: {e}")
+            await asyncio.sleep(error_interval)
+            error_interval = min(error_interval * 2, POLLING_MAX_ERROR_INTERVAL)
+            continue
+        error_interval = 0.25
+        for update in updates:
+            offset = update.update_id + 1
+            task = asyncio.create_task(_process_update(update, None))
+            _update_tasks.add(task)
+            task.add_done_callback(_update_tasks.discard)
 
-        # --- Отправка видео или сообщения об ошибке ---
-        if video_path:
+# --- Холодный старт: прогрев браузера и соединений в фоне ---
+PREWARM_TIMEOUT = aiohttp.ClientTimeout(total=10)
+
+async def _prewarm_browser():
+    try:
+        await browser_manager.warm()
+    except Exception as e:
+        # Не страшно: браузер запустится при первом запросе, которому он понадобится
+        print(f"Не удалось заранее запустить браузер: {e}")
+
+async def _prewarm_mirror(host):
+    """Открывает соединение с зеркалом (DNS, TCP, TLS), которое потом останется в пуле keep-alive сессии."""
+    url = mirror_url('https://www.instagram.com/', host)
+    try:
+        async with get_http_session().head(url, allow_redirects=False, timeout=PREWARM_TIMEOUT):
+            pass
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        print(f"Не удалось заранее подключиться к зеркалу {host}: {e}")
+
+async def prewarm():
+    """Прогревает браузер и HTTP-соединения с зеркалами, пока бот уже принимает сообщения.
+
+    Первый запрос, которому нужен браузер, просто дождется запуска (BrowserManager.start под блокировкой).
+    """
+    started = time.perf_counter()
+    await asyncio.gather(_prewarm_browser(), *(_prewarm_mirror(host) for host in MIRROR_HOSTS))
+    elapsed = time.perf_counter() - started
+    metrics.observe('stage_seconds', elapsed, stage='prewarm')
+    print(f"Прогрев браузера и соединений занял {elapsed:.2f} с.")
+
+def report_startup():
+    """Печатает и записывает в метрики время импорта модулей и загрузки скрипта."""
+    metrics.observe('stage_seconds', IMPORT_SECONDS, stage='import')
+    print(f"Импорт модулей и загрузка скрипта: {IMPORT_SECONDS:.2f} с.")
+
+# --- Процесс-воркер (python insta.py --worker) ---
+def _job_title(payload):
+    return payload.get('reel_url') or ', '.join(payload['links'])
+
+async def _keep_lease(job_id, worker):
+    """Продлевает аренду задачи, пока воркер над ней работает."""
+    while True:
+        await asyncio.sleep(job_queue.lease / 3)
+        try:
+            if not await job_queue.extend(job_id, worker):
+                print(f"Аренда задачи {job_id} потеряна: ее мог забрать другой воркер.")
+                return
+        except sqlite3.Error as e:
+            print(f"Не удалось продлить аренду задачи {job_id}: {e}")
+
+async def _report_abandoned(payloads):
+    """Сообщает пользователям о задачах, которые не удалось выполнить за JOB_MAX_ATTEMPTS попыток."""
+    for payload in payloads:
+        metrics.count('failures_total', cause='worker_lost')
+        print(f"Задача {_job_title(payload)} снята после {JOB_MAX_ATTEMPTS} попыток.")
+        try:
+            await bot.delete_message(payload['chat_id'], payload['status_message_id'])
+        except Exception as e:
+            print(f"Не удалось удалить сообщение о статусе: {e}")
+        try:
+            await bot.send_message(payload['chat_id'], "😔 Не удалось скачать видео с этой ссылки. Попробуйте отправить ее еще раз позже.")
+        except Exception as e:
+            print(f"Не удалось сообщить об ошибке пользователю: {e}")
+
+async def _worker_slot(worker, stopping):
+    """Забирает задачи из очереди одну за другой, пока воркер не начал останавливаться."""
+    while not stopping.is_set():
+        try:
+            claimed, abandoned = await job_queue.claim(worker)
+        except sqlite3.Error as e:
+            print(f"Ошибка чтения очереди задач: {e}")
+            claimed, abandoned = None, []
+        await _report_abandoned(abandoned)
+        if claimed is None:
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(stopping.wait(), JOB_POLL_INTERVAL)
+            continue
+
+        job_id, payload, attempt, created_at = claimed
+        metrics.observe('queue_wait_seconds', max(0.0, time.time() - created_at))
+        print(f"Воркер {worker}: задача {job_id} (попытка {attempt}), {_job_title(payload)}")
+        lease = asyncio.create_task(_keep_lease(job_id, worker))
+        try:
+            with metrics.stage('total'):
+                if 'links' in payload:
+                    await deliver_links(payload['chat_id'], payload['user_id'], payload['links'],
+                                        payload['status_message_id'])
+                else:
+                    await deliver_video(payload['chat_id'], payload['reel_url'], payload['shortcode'],
+                                        payload['status_message_id'])
+        except asyncio.CancelledError:
+            # Не успели доделать до конца остановки - задачу заберет другой воркер
+            with contextlib.suppress(sqlite3.Error):
+                await asyncio.shield(job_queue.release(job_id, worker, count_attempt=False))
+            raise
+        except Exception as e:
+            print(f"Ошибка при выполнении задачи {job_id}: {e}")
+            traceback.print_exc()
+            try:
+                given_up = await job_queue.release(job_id, worker)
+            except sqlite3.Error as e:
+                print(f"Не удалось вернуть задачу {job_id} в очередь: {e}")
+            else:
+                if given_up:
+                    await _report_abandoned([given_up])
+        else:
             try:
-                file_size = os.path.getsize(video_path)
-                print(f"Размер скачанного файла: {file_size} байт")
+                await job_queue.ack(job_id, worker)
+            except sqlite3.Error as e:
+                print(f"Не удалось подтвердить задачу {job_id}: {e}")
+        finally:
+            lease.cancel()
+
+async def run_worker():
+    """Процесс-воркер: свой браузер, WORKER_CONCURRENCY задач одновременно, плавная остановка по SIGTERM."""
+    worker = f"{socket.gethostname()}:{os.getpid()}"
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        with contextlib.suppress(NotImplementedError): # add_signal_handler недоступен в Windows
+            loop.add_signal_handler(sig, stopping.set)
 
-                # Отправляем видео как файл
-                # Используем try-except для отправки, чтобы поймать возможные ошибки Telegram API
+    load_bot_files()
+    open_storage(worker=True)
+    report_startup()
+    # Браузер запускается в фоне: первая задача, если придет раньше, дождется его
+    warmup = asyncio.create_task(prewarm())
+    sweeper = asyncio.create_task(spool_sweeper())
+    slots = [asyncio.create_task(_worker_slot(worker, stopping)) for _ in range(max(1, WORKER_CONCURRENCY))]
+    print(f"Воркер {worker} запущен: задач одновременно {len(slots)}, очередь {JOB_QUEUE_DB}.")
+    try:
+        await stopping.wait()
+        # Новые задачи больше не берем, текущие доделываем не дольше WORKER_DRAIN_TIMEOUT
+        print(f"Воркер {worker} останавливается, ждем текущие задачи (до {WORKER_DRAIN_TIMEOUT:.0f} с)...")
+        _, pending = await asyncio.wait(slots, timeout=WORKER_DRAIN_TIMEOUT)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+    finally:
+        for task in (warmup, sweeper):
+            task.cancel()
+        await asyncio.gather(warmup, sweeper, return_exceptions=True)
+        await browser_manager.close()
+        await close_http_session()
+        await close_bot_session()
+        sweep_spool(own=True)
+        print(f"Воркер {worker} остановлен.")
+
+async def _run_local_worker(index):
+    """Держит запущенным один локальный процесс-воркер и перезапускает его, если он упал."""
+    while True:
+        process = await asyncio.create_subprocess_exec(sys.executable, os.path.abspath(__file__), '--worker')
+        print(f"Воркер #{index} запущен (pid {process.pid}).")
+        try:
+            code = await process.wait()
+        except asyncio.CancelledError:
+            # Бот останавливается: просим воркер доделать текущие задачи и ждем его
+            if process.returncode is None:
+                process.terminate()
                 try:
-                    await bot.send_chat_action(message.chat.id, 'upload_video') # Показываем статус "отправка видео"
-                    with open(video_path, 'rb') as video_file:
-                        # Добавляем подпись к видео с оригинальной ссылкой
-                        #caption_text = f"Видео из: {instagram_url}"
-                        await bot.send_video(message.chat.id, video_file, timeout=60) # Увеличим таймаут на отправку
-                    print("Видео успешно отправлено.")
-                except telebot.apihelper.ApiTelegramException as e:
-                    print(f"Ошибка Telegram API при отправке видео: {e}")
-                    # Проверяем на специфичную ошибку размера файла (лимит Telegram 50 МБ для ботов)
-                    if "file is too big" in str(e).lower() or e.error_code == 400:
-                         await bot.send_message(message.chat.id, f"😔 Видео скачано, но оно слишком большое для отправки через Telegram (больше 50 МБ).\nРазмер файла: {file_size / (1024*1024):.2f} МБ")
-                    else:
-                         await bot.send_message(message.chat.id, f"Не удалось отправить видео. Ошибка Telegram: {e}")
-                except Exception as e_send:
-                    print(f"Неожиданная ошибка при отправке видео: {e_send}")
-                    await bot.send_message(message.chat.id, f"Произошла неожиданная ошибка при отправке видео.")
-
-            finally: # Блок finally выполнится в любом случае после try (даже если была ошибка)
-                # Удаляем временный файл после попытки отправки
-                if os.path.exists(video_path):
-                    try:
-                        os.remove(video_path)
-                        print(f"Временный файл {video_path} удален.")
-                    except OSError as e:
-                        print(f"Ошибка удаления временного файла {video_path}: {e}")
-        else:
-             # Если download_video вернул None
-             await bot.send_message(message.chat.id, "😔 Не удалось скачать видео с этой ссылки. Возможно, ссылка недействительна, видео удалено или сайт ddinstagram временно недоступен.")
+                    await asyncio.wait_for(process.wait(), WORKER_DRAIN_TIMEOUT + 10)
+                except asyncio.TimeoutError:
+                    process.kill()
+                    await process.wait()
+            raise
+        print(f"Воркер #{index} завершился с кодом {code}, перезапускаем...")
+        await asyncio.sleep(1)
 
-    # Обработка других ссылок Instagram (не Reels)
-    elif "instagram.com/" in text:
-        await bot.send_message(message.chat.id, "⚠️ Похоже, это ссылка на Instagram, но не на Reel.\n"
-                                 "Я умею скачивать только видео из раздела Reels (ссылки вида `https://www.instagram.com/reel/...`).")
+# --- Запуск бота ---
+SHUTDOWN_TIMEOUT = float(os.environ.get('SHUTDOWN_TIMEOUT', '30')) # Секунд на обработку уже принятых сообщений при остановке
 
-    # Обработка любого другого текста
+def _in_flight_tasks():
+    """Задачи, которые сейчас обрабатывают принятые обновления или доотправляют ответы."""
+    return _update_tasks | _background_tasks
+
+async def drain_in_flight(timeout):
+    """Ждет окончания обработки принятых обновлений не дольше timeout, остальное отменяет."""
+    deadline = time.monotonic() + timeout
+    tasks = _in_flight_tasks()
+    if tasks:
+        print(f"Дожидаемся обработки принятых сообщений: {len(tasks)} (до {timeout:.0f} с)...")
+    # Обработчики могут запустить новые фоновые задачи (например, правку статуса) - ждем и их
+    while tasks:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            print(f"Не успели обработать за {timeout:.0f} с, отменяем: {len(tasks)}")
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            return
+        await asyncio.wait(tasks, timeout=remaining)
+        tasks = _in_flight_tasks()
+
+async def main():
+    """Запускает polling (или webhook), а браузер и соединения прогревает в фоне; по SIGTERM плавно останавливается."""
+    print("Запуск бота...")
+    load_bot_files()
+    open_storage()
+    report_startup()
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        with contextlib.suppress(NotImplementedError): # add_signal_handler недоступен в Windows
+            loop.add_signal_handler(sig, stopping.set)
+
+    background = [asyncio.create_task(spool_sweeper())]
+    local_workers = []
+    if JOB_QUEUE_ENABLED:
+        # Браузер в этом процессе не нужен - скачивают воркеры
+        print(f"Скачивание вынесено в процессы-воркеры, очередь: {JOB_QUEUE_DB}")
+        local_workers = [asyncio.create_task(_run_local_worker(index)) for index in range(1, WORKERS + 1)]
     else:
-        await bot.send_message(message.chat.id, "🤔 Чтобы я скачал видео, отправь мне, пожалуйста, ссылку на Instagram Reel.")
+        background.append(asyncio.create_task(prewarm()))
+    metrics_runner = await start_metrics_server()
+    try:
+        if WEBHOOK_URL:
+            receiver = asyncio.create_task(run_webhook())
+        else:
+            # Старые сообщения, пришедшие, пока бот был выключен, не обрабатываем
+            receiver = asyncio.create_task(run_polling(skip_pending=True))
+        print(f"Бот запущен и готов к работе: {time.perf_counter() - IMPORT_STARTED:.2f} с от начала загрузки.")
+        stop = asyncio.create_task(stopping.wait())
+        await asyncio.wait({receiver, stop}, return_when=asyncio.FIRST_COMPLETED)
+        stop.cancel()
+        if stopping.is_set():
+            # Сначала перестаем принимать обновления, потом доделываем уже принятые (сессия Bot API остается открытой)
+            print("Получен сигнал остановки, новые сообщения больше не принимаем.")
+            receiver.cancel()
+            await asyncio.gather(receiver, return_exceptions=True)
+        else:
+            receiver.result() # Прием обновлений завершился сам - пробрасываем его ошибку
+        await drain_in_flight(SHUTDOWN_TIMEOUT)
+    finally:
+        # Незавершенные задачи остаются в очереди SQLite и будут выполнены после перезапуска
+        for task in local_workers + background:
+            task.cancel()
+        await asyncio.gather(*local_workers, *background, return_exceptions=True)
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        await browser_manager.close()
+        await close_http_session()
+        await close_bot_session()
+        sweep_spool(own=True)
 
+IMPORT_SECONDS = time.perf_counter() - IMPORT_STARTED # Все, что выше, выполняется при импорте модуля
 
-# --- Запуск бота ---
 if __name__ == '__main__':
     try:
-        print("Бот запущен и готов к работе.")
-        # Используем asyncio.run() для запуска асинхронной функции polling
-        asyncio.run(bot.polling(non_stop=True, skip_pending=True)) # non_stop для перезапуска при ошибках, skip_pending чтобы не обрабатывать старые сообщения
+        # Используем asyncio.run() для запуска асинхронной функции main
+        asyncio.run(run_worker() if '--worker' in sys.argv else main())
     except Exception as e:
         print(f"Критическая ошибка при запуске или работе бота: {e}")
         traceback.print_exc()
@@ -0,0 +1,8 @@
+import os
+import sys
+import tempfile
+
+# Файлы бота (кэш, очередь) открываются в BOT_DIR - в тестах это временная папка
+os.environ['BOT_DIR'] = tempfile.mkdtemp(prefix='insta-tests-')
+os.environ.setdefault('SPOOL_DIR', os.path.join(os.environ['BOT_DIR'], 'spool'))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
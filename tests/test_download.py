@@ -0,0 +1,167 @@
+import asyncio
+import os
+import threading
+
+import aiohttp
+
+import insta
+
+
+class FakeContent:
+    def __init__(self, chunks):
+        self.chunks = chunks
+
+    async def iter_chunked(self, size):
+        for chunk in self.chunks:
+            yield chunk
+
+
+class FakeResponse:
+    def __init__(self, chunks):
+        self.content = FakeContent(chunks)
+
+
+def test_pwrite_all_retries_short_writes(tmp_path, monkeypatch):
+    real_pwrite = os.pwrite
+    monkeypatch.setattr(os, 'pwrite', lambda fd, data, offset: real_pwrite(fd, bytes(data[:3]), offset))
+    path = tmp_path / 'video.mp4'
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT)
+    try:
+        assert insta._pwrite_all(fd, b'0123456789', 5) == 10
+    finally:
+        os.close(fd)
+    assert path.read_bytes() == b'\0' * 5 + b'0123456789'
+
+
+def test_write_stream_counts_bytes_actually_written(tmp_path, monkeypatch):
+    real_pwrite = os.pwrite
+    monkeypatch.setattr(os, 'pwrite', lambda fd, data, offset: real_pwrite(fd, bytes(data[:1000]), offset))
+    monkeypatch.setattr(insta, 'WRITE_BUFFER_SIZE', 4096)
+    chunks = [os.urandom(3000) for _ in range(5)]
+    path = tmp_path / 'video.mp4'
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT)
+    try:
+        written = asyncio.run(insta._write_stream(FakeResponse(chunks), fd, 0))
+    finally:
+        os.close(fd)
+    assert written == 15000
+    assert path.read_bytes() == b''.join(chunks)
+
+
+def test_pwrite_all_fails_instead_of_looping_forever(tmp_path, monkeypatch):
+    monkeypatch.setattr(os, 'pwrite', lambda fd, data, offset: 0)
+    fd = os.open(tmp_path / 'video.mp4', os.O_WRONLY | os.O_CREAT)
+    try:
+        try:
+            insta._pwrite_all(fd, b'data', 0)
+        except OSError:
+            pass
+        else:
+            raise AssertionError("ожидалась OSError")
+    finally:
+        os.close(fd)
+
+
+def test_fd_io_cancel_waits_for_running_write():
+    started = threading.Event()
+    release = threading.Event()
+    finished = []
+
+    def slow_write():
+        started.set()
+        release.wait(5)
+        finished.append(True)
+
+    async def scenario():
+        task = asyncio.create_task(insta._fd_io(slow_write))
+        await asyncio.to_thread(started.wait, 5)
+        task.cancel()
+        await asyncio.sleep(0.05)
+        assert not task.done() # Отмена ждет, пока поток допишет
+        release.set()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        else:
+            raise AssertionError("отмена должна дойти до вызывающего")
+        assert finished == [True]
+
+    asyncio.run(scenario())
+
+
+class FakeStreamResponse(FakeResponse):
+    def __init__(self, chunks):
+        super().__init__(chunks)
+        self.content_length = sum(len(chunk) for chunk in chunks)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+
+def test_video_stream_close_waits_for_spill_write(monkeypatch):
+    started = threading.Event()
+    release = threading.Event()
+    real_pwrite_all = insta._pwrite_all
+    writes = []
+
+    def slow_pwrite_all(fd, data, offset):
+        started.set()
+        release.wait(5)
+        writes.append(fd)
+        return real_pwrite_all(fd, data, offset)
+
+    monkeypatch.setattr(insta, '_pwrite_all', slow_pwrite_all)
+
+    async def scenario():
+        stream = insta.VideoStream(FakeStreamResponse([b'a' * 10, b'b' * 10]), memory_limit=15)
+        await asyncio.to_thread(started.wait, 5) # Второй кусок не влез в память - идет перенос в файл
+        path = stream.path
+        assert path and os.path.exists(path)
+        stream.close()
+        await asyncio.sleep(0.05)
+        assert not stream._task.done() # Задача ждет начатую запись, файл еще открыт
+        release.set()
+        await asyncio.gather(stream._task, return_exceptions=True)
+        await asyncio.sleep(0)
+        assert len(writes) == 1
+        try:
+            os.fstat(writes[0])
+        except OSError:
+            pass
+        else:
+            raise AssertionError("дескриптор должен быть закрыт после остановки скачивания")
+        assert not os.path.exists(path)
+
+    asyncio.run(scenario())
+
+
+def test_video_stream_close_after_download_releases_file():
+    async def scenario():
+        stream = insta.VideoStream(FakeStreamResponse([b'a' * 10, b'b' * 10]), memory_limit=15)
+        assert await stream.wait_complete() == 20
+        data = b''.join([chunk async for chunk in stream.iter_chunks()])
+        assert data == b'a' * 10 + b'b' * 10
+        path = stream.path
+        stream.close()
+        assert stream._fd is None
+        assert not os.path.exists(path)
+
+    asyncio.run(scenario())
+
+
+def test_upload_payload_reports_known_size():
+    async def scenario():
+        stream = insta.VideoStream(FakeStreamResponse([b'a' * 10, b'b' * 10]))
+        payload = stream.upload_payload()
+        assert payload.size == 20
+        writer = aiohttp.MultipartWriter('form-data')
+        writer.append_payload(payload)
+        assert writer.size is not None # Известна длина всего тела - запрос пойдет с Content-Length
+        await stream.wait_complete()
+        stream.close()
+
+    asyncio.run(scenario())
@@ -0,0 +1,103 @@
+import asyncio
+
+import insta
+
+
+def test_concurrent_joins_share_one_fetch():
+    async def scenario():
+        released = []
+        flights = insta.SingleFlight(release=released.append)
+        gate = asyncio.Event()
+        fetches = []
+
+        async def fetch():
+            fetches.append(1)
+            await gate.wait()
+            return 'video.mp4'
+
+        async def join():
+            async with flights.join('reel', fetch) as flight:
+                await asyncio.sleep(0)
+                assert released == [] # Пока результат используют, файл не удаляется
+                return flight.result
+
+        joins = [asyncio.create_task(join()) for _ in range(3)]
+        await asyncio.sleep(0)
+        assert 'reel' in flights
+        gate.set()
+        assert await asyncio.gather(*joins) == ['video.mp4'] * 3
+        assert fetches == [1]
+        assert released == ['video.mp4']
+        assert 'reel' not in flights
+
+    asyncio.run(scenario())
+
+
+def test_error_reaches_every_waiter_once():
+    async def scenario():
+        released = []
+        flights = insta.SingleFlight(release=released.append)
+        fetches = []
+
+        async def fetch():
+            fetches.append(1)
+            await asyncio.sleep(0.01)
+            raise insta.DownloadError('обрыв')
+
+        async def join():
+            async with flights.join('reel', fetch):
+                pass
+
+        results = await asyncio.gather(*(join() for _ in range(3)), return_exceptions=True)
+        assert all(isinstance(result, insta.DownloadError) for result in results)
+        assert fetches == [1]
+        assert released == []
+        assert 'reel' not in flights
+
+    asyncio.run(scenario())
+
+
+def test_result_released_when_all_waiters_left_early():
+    async def scenario():
+        released = []
+        flights = insta.SingleFlight(release=released.append)
+        gate = asyncio.Event()
+
+        async def fetch():
+            await gate.wait()
+            return 'video.mp4'
+
+        async def join():
+            async with flights.join('reel', fetch):
+                pass
+
+        waiters = [asyncio.create_task(join()) for _ in range(2)]
+        await asyncio.sleep(0)
+        for waiter in waiters:
+            waiter.cancel()
+        await asyncio.gather(*waiters, return_exceptions=True)
+        assert 'reel' not in flights
+        assert released == [] # Загрузка еще идет - отменять ее не нужно
+
+        gate.set()
+        for _ in range(10):
+            await asyncio.sleep(0)
+        assert released == ['video.mp4']
+
+    asyncio.run(scenario())
+
+
+def test_new_request_after_finish_fetches_again():
+    async def scenario():
+        flights = insta.SingleFlight(release=lambda result: None)
+        fetches = []
+
+        async def fetch():
+            fetches.append(1)
+            return len(fetches)
+
+        for expected in (1, 2):
+            async with flights.join('reel', fetch) as flight:
+                assert flight.result == expected
+
+    asyncio.run(scenario())
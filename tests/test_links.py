@@ -0,0 +1,35 @@
+import insta
+
+
+def test_link_forms():
+    cases = {
+        'https://www.instagram.com/reel/C1a2B3c4/?igsh=abc': 'https://www.instagram.com/reel/C1a2B3c4/',
+        'https://instagram.com/reels/C1a2B3c4/': 'https://www.instagram.com/reel/C1a2B3c4/',
+        'https://www.instagram.com/p/Cx_Y-z1/': 'https://www.instagram.com/p/Cx_Y-z1/',
+        'https://www.instagram.com/tv/B9abc/': 'https://www.instagram.com/tv/B9abc/',
+        'https://instagr.am/p/Cx1/': 'https://www.instagram.com/p/Cx1/',
+        'https://www.instagram.com/some.user_1/reel/C1a2B3c4/': 'https://www.instagram.com/reel/C1a2B3c4/',
+        'https://m.instagram.com/reel/C1a2B3c4/': 'https://www.instagram.com/reel/C1a2B3c4/',
+        'смотри instagram.com/p/Cx1 без схемы': 'https://www.instagram.com/p/Cx1/',
+    }
+    for text, link in cases.items():
+        assert insta.extract_instagram_links(text) == [link], text
+
+
+def test_several_links_keep_order_without_duplicates():
+    text = ('https://www.instagram.com/reel/AAA/ и https://instagr.am/p/BBB/\n'
+            'https://www.instagram.com/reels/AAA/?igsh=x https://www.instagram.com/tv/CCC/')
+    assert insta.extract_instagram_links(text) == [
+        'https://www.instagram.com/reel/AAA/', 'https://www.instagram.com/p/BBB/', 'https://www.instagram.com/tv/CCC/']
+
+
+def test_rejects_other_domains_and_non_media_pages():
+    for text in ('https://notinstagram.com/p/X/', 'https://instagram.com.evil.test/p/X/',
+                 'https://evil-instagram.com/reel/X/', 'https://www.instagram.com/reels/audio/123456/',
+                 'https://www.instagram.com/explore/tags/cats/', 'https://www.instagram.com/some.user/'):
+        assert insta.extract_instagram_links(text) == [], text
+
+
+def test_reel_shortcode():
+    assert insta.reel_shortcode('https://www.instagram.com/reel/C1a2B3c4/?igsh=abc') == 'C1a2B3c4'
+    assert insta.reel_shortcode('https://notinstagram.com/reel/C1a2B3c4/') is None
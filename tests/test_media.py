@@ -0,0 +1,99 @@
+import asyncio
+
+import insta
+
+
+def test_reel_ignores_cover_image():
+    html = ('<meta property="og:image" content="/cover.jpg">'
+            '<meta property="og:video" content="/v.mp4"><meta name="twitter:player:stream" content="/v.mp4">')
+    assert insta.find_media_in_html(html) == [('video', '/v.mp4')]
+    assert insta.find_media_in_html(html, photos=True) == [('video', '/v.mp4')]
+
+
+def test_photo_post():
+    html = '<meta property="og:image" content="/1.jpg"><meta property="og:image" content="/2.jpg">'
+    assert insta.find_media_in_html(html, photos=True) == [('photo', '/1.jpg'), ('photo', '/2.jpg')]
+    assert insta.find_media_in_html(html) == []
+
+
+def test_mixed_carousel_keeps_page_order():
+    html = ('<meta property="og:image" content="/1.jpg">'
+            '<meta property="og:image" content="/2-cover.jpg"><meta property="og:video" content="/2.mp4">'
+            '<meta property="og:image" content="/3.jpg">')
+    assert insta.find_media_in_html(html, photos=True) == [
+        ('photo', '/1.jpg'), ('video', '/2.mp4'), ('photo', '/3.jpg')]
+
+
+def test_carousel_slides_download_with_bounded_concurrency(monkeypatch):
+    async def scenario():
+        media = [('video', f'https://cdn.test/{index}.mp4') for index in range(8)]
+        active = peak = 0
+
+        async def extract_media_hedged(link):
+            return media
+
+        async def download_to_temp_file(url, suffix):
+            nonlocal active, peak
+            active += 1
+            peak = max(peak, active)
+            await asyncio.sleep(0.01)
+            active -= 1
+            return None # Как неудачная загрузка: файлы не создаются
+
+        monkeypatch.setattr(insta, 'extract_media_hedged', extract_media_hedged)
+        monkeypatch.setattr(insta, 'download_to_temp_file', download_to_temp_file)
+        monkeypatch.setattr(insta, 'SLIDE_DOWNLOAD_CONCURRENCY', 2)
+        results = await insta.download_post('https://www.instagram.com/p/x/')
+        assert results == [None] * len(media)
+        assert peak == 2
+
+    asyncio.run(scenario())
+
+
+class _FakePage:
+    def __init__(self, html, appears):
+        self.html = html
+        self.appears = appears # Появится ли нужный тег до таймаута
+        self.selectors = []
+
+    async def goto(self, url, **kwargs):
+        return type('Response', (), {'status': 200})()
+
+    async def wait_for_selector(self, selector, **kwargs):
+        from playwright.async_api import TimeoutError as PlaywrightTimeoutError
+        self.selectors.append(selector)
+        if not self.appears:
+            raise PlaywrightTimeoutError('timeout')
+
+    async def content(self):
+        return self.html
+
+
+def _fake_browser(monkeypatch, page):
+    class FakeBrowserManager:
+        @insta.contextlib.asynccontextmanager
+        async def page(self):
+            yield page
+
+        def report(self):
+            return ''
+
+    monkeypatch.setattr(insta, 'browser_manager', FakeBrowserManager())
+
+
+def test_browser_waits_for_photos_in_posts(monkeypatch):
+    page = _FakePage('<meta property="og:image" content="/1.jpg">', appears=True)
+    _fake_browser(monkeypatch, page)
+    assert asyncio.run(insta.extract_media_browser('https://m.test/p/X/')) == [('photo', '/1.jpg')]
+    assert 'meta[property="og:image"]' in page.selectors[0]
+
+    page = _FakePage('', appears=True)
+    _fake_browser(monkeypatch, page)
+    asyncio.run(insta.extract_media_browser('https://m.test/reel/X/'))
+    assert 'og:image' not in page.selectors[0] # У рилса og:image - обложка, ее не ждем
+
+
+def test_browser_parses_page_after_timeout(monkeypatch):
+    page = _FakePage('<video src="/late.mp4"></video>', appears=False)
+    _fake_browser(monkeypatch, page)
+    assert asyncio.run(insta.extract_media_browser('https://m.test/reel/X/')) == [('video', '/late.mp4')]
@@ -0,0 +1,100 @@
+import asyncio
+
+import pytest
+
+import insta
+
+
+def _mirrors(monkeypatch, *hosts):
+    health = {host: insta.MirrorHealth(host) for host in hosts}
+    monkeypatch.setattr(insta, 'mirror_health', health)
+    return health
+
+
+def _fake_extract(monkeypatch, answers, calls):
+    """answers: хост -> (задержка, результат или исключение)."""
+    async def extract_media(url):
+        host = insta.urlparse(url).netloc
+        calls.append(host)
+        delay, result = answers[host]
+        await asyncio.sleep(delay)
+        if isinstance(result, Exception):
+            raise result
+        return result
+    monkeypatch.setattr(insta, 'extract_media', extract_media)
+
+
+def test_breaker_opens_after_consecutive_failures():
+    health = insta.MirrorHealth('a')
+    for _ in range(insta.MIRROR_BREAKER_FAILURES):
+        assert health.available()
+        health.record(False, 0.1)
+    assert not health.available()
+    health.open_until = 0.0 # Пауза прошла - пропускаем один пробный запрос
+    assert health.available()
+
+
+def test_cancelled_attempt_can_only_raise_estimate():
+    health = insta.MirrorHealth('a')
+    for _ in range(10):
+        health.record(True, 2.0)
+    health.record_cancelled(0.5)
+    assert health.hedge_delay() == 2.0
+    assert len(health.latencies) == 10
+    health.record_cancelled(5.0)
+    assert len(health.latencies) == 11
+
+
+def test_no_media_is_final_and_not_a_failure(monkeypatch):
+    health = _mirrors(monkeypatch, 'a.test', 'b.test')
+    calls = []
+    _fake_extract(monkeypatch, {'a.test': (0, []), 'b.test': (0, [('video', 'https://b.test/v.mp4')])}, calls)
+    for _ in range(insta.MIRROR_BREAKER_FAILURES + 1):
+        assert asyncio.run(insta.extract_media_hedged('https://www.instagram.com/reel/x/')) == []
+    assert calls == ['a.test'] * (insta.MIRROR_BREAKER_FAILURES + 1)
+    assert health['a.test'].available()
+    assert health['a.test'].failures == 0
+
+
+def test_mirror_error_fails_over_to_next_mirror(monkeypatch):
+    health = _mirrors(monkeypatch, 'a.test', 'b.test')
+    calls = []
+    media = [('video', 'https://b.test/v.mp4')]
+    _fake_extract(monkeypatch, {'a.test': (0, insta.MirrorError('статус 502')), 'b.test': (0, media)}, calls)
+    assert asyncio.run(insta.extract_media_hedged('https://www.instagram.com/reel/x/')) == media
+    assert calls == ['a.test', 'b.test']
+    assert health['a.test'].failures == 1
+    assert health['b.test'].successes == 1
+
+
+def test_slow_mirror_is_hedged_without_lowering_its_estimate(monkeypatch):
+    health = _mirrors(monkeypatch, 'a.test', 'b.test')
+    for _ in range(10):
+        health['a.test'].record(True, 0.05)
+    health['b.test'].latencies.append(1.0) # b хуже по статистике - его спрашиваем вторым
+    calls = []
+    media = [('video', 'https://b.test/v.mp4')]
+    _fake_extract(monkeypatch, {'a.test': (10, []), 'b.test': (0, media)}, calls)
+    assert asyncio.run(insta.extract_media_hedged('https://www.instagram.com/reel/x/')) == media
+    assert calls == ['a.test', 'b.test']
+    assert health['a.test'].hedge_delay() >= 0.05
+    assert health['a.test'].failures == 0
+
+
+def test_extract_media_raises_only_when_mirror_never_answered(monkeypatch):
+    async def unreachable(url):
+        raise insta.aiohttp.ClientConnectionError('connection refused')
+
+    async def no_media(url):
+        return []
+
+    async def broken_browser(url):
+        raise insta.MirrorError('net::ERR_CONNECTION_RESET')
+
+    monkeypatch.setattr(insta, 'extract_media_static', unreachable)
+    monkeypatch.setattr(insta, 'extract_media_browser', broken_browser)
+    with pytest.raises(insta.MirrorError):
+        asyncio.run(insta.extract_media('https://a.test/reel/x/'))
+
+    monkeypatch.setattr(insta, 'extract_media_static', no_media)
+    assert asyncio.run(insta.extract_media('https://a.test/reel/x/')) == []
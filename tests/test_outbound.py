@@ -0,0 +1,178 @@
+import asyncio
+
+import pytest
+
+from telebot import asyncio_helper
+
+import insta
+
+
+def _too_many_requests(retry_after):
+    return asyncio_helper.ApiTelegramException(
+        'sendMessage', None, {'error_code': 429, 'description': 'Too Many Requests',
+                              'parameters': {'retry_after': retry_after}})
+
+
+def test_retries_text_message_after_429():
+    async def scenario():
+        dispatcher = insta.OutboundDispatcher(global_rate=0, chat_rate=0)
+        attempts = []
+
+        async def send(files):
+            attempts.append(files)
+            if len(attempts) == 1:
+                raise _too_many_requests(0.01)
+            return 'ok'
+
+        assert await dispatcher.call('sendMessage', {'chat_id': 1, 'text': 'x'}, None, send) == 'ok'
+        assert attempts == [None, None]
+        assert dispatcher.throttled == 1
+
+    asyncio.run(scenario())
+
+
+def test_token_bucket_refills_at_rate():
+    bucket = insta.TokenBucket(rate=2, capacity=3)
+    now = bucket.updated
+    for _ in range(3):
+        assert bucket.delay(now) == 0
+        bucket.take()
+    assert bucket.delay(now) == pytest.approx(0.5)
+    assert bucket.delay(now + 0.5) == 0
+    assert not bucket.idle(now + 0.5)
+    assert bucket.idle(now + 10) # Не копит больше capacity
+    assert bucket.tokens == 3
+
+
+def test_token_bucket_reserve_and_pause():
+    bucket = insta.TokenBucket(rate=1, capacity=3)
+    now = bucket.updated
+    bucket.take()
+    bucket.take()
+    assert bucket.delay(now) == 0
+    assert bucket.delay(now, reserve=1) == pytest.approx(1.0) # Последний токен статусам не отдаем
+    bucket.paused_until = now + 5
+    assert bucket.delay(now + 1) == pytest.approx(4.0)
+
+
+def test_media_is_granted_before_status_edits():
+    async def scenario():
+        dispatcher = insta.OutboundDispatcher(global_rate=0, chat_rate=50, chat_burst=1)
+        assert await dispatcher.acquire('sendMessage', '1')
+        order = []
+
+        async def acquire(method, message_id=None):
+            assert await dispatcher.acquire(method, '1', message_id)
+            order.append(method)
+
+        edit = asyncio.create_task(acquire('editMessageText', message_id=10))
+        await asyncio.sleep(0)
+        video = asyncio.create_task(acquire('sendVideo'))
+        await asyncio.gather(edit, video)
+        assert order == ['sendVideo', 'editMessageText']
+
+    asyncio.run(scenario())
+
+
+def test_newer_edit_and_delete_drop_pending_edits():
+    async def scenario():
+        dispatcher = insta.OutboundDispatcher(global_rate=0, chat_rate=20, chat_burst=1)
+        assert await dispatcher.acquire('sendMessage', '1')
+        old = asyncio.create_task(dispatcher.acquire('editMessageText', '1', 10))
+        await asyncio.sleep(0)
+        new = asyncio.create_task(dispatcher.acquire('editMessageText', '1', 10))
+        await asyncio.sleep(0)
+        assert await old is False
+        assert await dispatcher.acquire('deleteMessage', '1', 10) # Не тратит токены
+        assert await new is False
+        assert not dispatcher._waiting
+        assert not dispatcher._edits
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_waiter_leaves_queue():
+    async def scenario():
+        dispatcher = insta.OutboundDispatcher(global_rate=0, chat_rate=1, chat_burst=1)
+        assert await dispatcher.acquire('sendMessage', '1')
+        waiter = asyncio.create_task(dispatcher.acquire('sendMessage', '1'))
+        await asyncio.sleep(0)
+        assert len(dispatcher._waiting) == 1
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        assert not dispatcher._waiting
+
+    asyncio.run(scenario())
+
+
+class _CdnResponse:
+    """Ответ CDN для VideoStream: отдает куски с паузами, как настоящая загрузка."""
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.content_length = sum(len(chunk) for chunk in chunks)
+        self.content = self
+
+    async def iter_chunked(self, size):
+        for chunk in self.chunks:
+            await asyncio.sleep(0)
+            yield chunk
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+
+class _Writer:
+    def __init__(self):
+        self.data = b''
+
+    async def write(self, chunk):
+        self.data += chunk
+
+
+def test_stream_upload_is_retried_from_start_after_429():
+    async def scenario():
+        dispatcher = insta.OutboundDispatcher(global_rate=0, chat_rate=0)
+        stream = insta.VideoStream(_CdnResponse([b'a' * 10, b'b' * 10, b'c' * 10]))
+        uploads = []
+
+        async def send(files):
+            file_name, payload = files['video']
+            writer = _Writer()
+            if not uploads:
+                # Первая попытка: Telegram ответил 429, прочитав только начало тела
+                async for chunk in payload._iter:
+                    writer.data += chunk
+                    break
+                uploads.append(writer.data)
+                raise _too_many_requests(0.01)
+            await payload.write(writer)
+            uploads.append(writer.data)
+            return 'ok'
+
+        files = {'video': ('video.mp4', stream.upload_payload())}
+        assert await dispatcher.call('sendVideo', {'chat_id': 1}, files, send) == 'ok'
+        assert uploads == [b'a' * 10, b'a' * 10 + b'b' * 10 + b'c' * 10]
+        assert dispatcher.throttled == 1
+        stream.close()
+
+    asyncio.run(scenario())
+
+
+def test_unreplayable_upload_is_not_retried_after_429():
+    async def scenario():
+        dispatcher = insta.OutboundDispatcher(global_rate=0, chat_rate=0)
+        attempts = []
+
+        async def send(files):
+            attempts.append(files)
+            raise _too_many_requests(0.01)
+
+        with pytest.raises(asyncio_helper.ApiTelegramException):
+            await dispatcher.call('sendVideo', {'chat_id': 1}, {'video': ('v.mp4', object())}, send)
+        assert len(attempts) == 1
+
+    asyncio.run(scenario())
@@ -0,0 +1,138 @@
+import asyncio
+
+import pytest
+
+import insta
+
+
+async def _wait_for(condition):
+    for _ in range(100):
+        if condition():
+            return
+        await asyncio.sleep(0)
+    raise AssertionError("условие не выполнилось")
+
+
+def test_round_robin_between_users():
+    async def scenario():
+        scheduler = insta.JobScheduler(concurrency=1, per_user_limit=5)
+        order = []
+        gate = asyncio.Event()
+
+        async def job(name):
+            if name == 'blocker':
+                await gate.wait()
+            order.append(name)
+
+        tasks = [asyncio.create_task(scheduler.run('x', lambda: job('blocker')))]
+        await asyncio.sleep(0)
+        for user, name in (('a', 'a1'), ('a', 'a2'), ('a', 'a3'), ('b', 'b1')):
+            tasks.append(asyncio.create_task(scheduler.run(user, lambda name=name: job(name))))
+        await asyncio.sleep(0)
+        gate.set()
+        await asyncio.gather(*tasks)
+        assert order == ['blocker', 'a1', 'b1', 'a2', 'a3']
+        assert scheduler.running == 0
+
+    asyncio.run(scenario())
+
+
+def test_per_user_queue_limit():
+    async def scenario():
+        scheduler = insta.JobScheduler(concurrency=1, per_user_limit=1)
+        gate = asyncio.Event()
+        running = asyncio.create_task(scheduler.run('a', gate.wait))
+        queued = asyncio.create_task(scheduler.run('a', gate.wait))
+        await asyncio.sleep(0)
+        try:
+            await scheduler.run('a', gate.wait)
+        except insta.QueueFullError:
+            pass
+        else:
+            raise AssertionError("ожидалась QueueFullError")
+        gate.set()
+        await asyncio.gather(running, queued)
+
+    asyncio.run(scenario())
+
+
+def test_cancel_queued_waiters_while_running_job_finishes():
+    """Отмена ожидающих в тот же момент, когда освобождается место, не должна терять слот."""
+    async def scenario():
+        scheduler = insta.JobScheduler(concurrency=1, per_user_limit=5)
+        gate = asyncio.Event()
+        running = asyncio.create_task(scheduler.run('a', gate.wait))
+        await _wait_for(lambda: scheduler.running == 1)
+        waiters = [asyncio.create_task(scheduler.run(user, gate.wait)) for user in ('b', 'c')]
+        await _wait_for(lambda: scheduler.depth() == 2)
+
+        # Как drain_in_flight при остановке: работающая задача завершается, ожидающие отменяются
+        gate.set()
+        for waiter in waiters:
+            waiter.cancel()
+        await running
+        results = await asyncio.gather(*waiters, return_exceptions=True)
+        assert all(isinstance(result, asyncio.CancelledError) for result in results)
+        assert scheduler.running == 0
+        assert scheduler.depth() == 0
+
+        # Место не потеряно: новая задача запускается сразу
+        assert await asyncio.wait_for(scheduler.run('d', lambda: asyncio.sleep(0, 'ok')), 1) == 'ok'
+
+    asyncio.run(scenario())
+
+
+def test_cancel_while_being_dispatched_returns_slot():
+    """Место уже выдали, но задачу отменили раньше, чем она начала работать."""
+    async def scenario():
+        scheduler = insta.JobScheduler(concurrency=1, per_user_limit=5)
+        gate = asyncio.Event()
+        running = asyncio.create_task(scheduler.run('a', gate.wait))
+        await _wait_for(lambda: scheduler.running == 1)
+        waiter = asyncio.create_task(scheduler.run('b', gate.wait))
+        await _wait_for(lambda: scheduler.depth() == 1)
+
+        dispatch = scheduler._dispatch
+
+        def dispatch_then_cancel():
+            dispatch()
+            if scheduler.depth() == 0 and not waiter.done():
+                waiter.cancel() # Будущее started уже выполнено - отмена придет при пробуждении
+        scheduler._dispatch = dispatch_then_cancel
+
+        gate.set()
+        await running
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            pass
+        else:
+            raise AssertionError("ожидалась отмена")
+        scheduler._dispatch = dispatch
+        assert scheduler.running == 0
+        assert await asyncio.wait_for(scheduler.run('c', lambda: asyncio.sleep(0, 'ok')), 1) == 'ok'
+
+    asyncio.run(scenario())
+
+
+def test_batch_counts_as_one_queue_entry():
+    """Все ссылки одного сообщения принимаются, даже если их больше лимита очереди."""
+    async def scenario():
+        scheduler = insta.JobScheduler(concurrency=2, per_user_limit=5)
+        gate = asyncio.Event()
+        batch = object()
+        jobs = [asyncio.create_task(scheduler.run('a', gate.wait, batch=batch)) for _ in range(10)]
+        await _wait_for(lambda: scheduler.depth() == 8)
+
+        # Другое сообщение того же пользователя занимает следующее место, а не шестое
+        other = [asyncio.create_task(scheduler.run('a', gate.wait, batch=object())) for _ in range(4)]
+        await _wait_for(lambda: scheduler.depth() == 12)
+        with pytest.raises(insta.QueueFullError):
+            await scheduler.run('a', gate.wait)
+
+        gate.set()
+        await asyncio.gather(*jobs, *other)
+        assert scheduler.running == 0
+        assert not scheduler._batches
+
+    asyncio.run(scenario())
@@ -0,0 +1,63 @@
+import asyncio
+import types
+
+import insta
+
+
+def test_stopping_polling_keeps_session_for_in_flight_updates(monkeypatch):
+    """Как main() по SIGTERM: прием обновлений отменяется, а принятые сообщения доделываются."""
+    async def scenario():
+        calls = []
+        uploading = asyncio.Event()
+
+        async def get_updates(offset=None, timeout=None, request_timeout=None):
+            calls.append(offset)
+            if len(calls) == 1:
+                return [types.SimpleNamespace(update_id=7)]
+            await asyncio.Event().wait() # Long polling до отмены
+
+        async def process_new_updates(updates):
+            uploading.set()
+            await asyncio.sleep(0.05) # Видео еще загружается в Telegram
+            processed.extend(update.update_id for update in updates)
+
+        async def close_session():
+            closed.append(True)
+
+        processed, closed = [], []
+        monkeypatch.setattr(insta.bot, 'get_updates', get_updates)
+        monkeypatch.setattr(insta.bot, 'process_new_updates', process_new_updates)
+        monkeypatch.setattr(insta.bot, 'close_session', close_session)
+
+        receiver = asyncio.create_task(insta.run_polling(timeout=1, skip_pending=False))
+        await asyncio.wait_for(uploading.wait(), 1)
+        receiver.cancel()
+        await asyncio.gather(receiver, return_exceptions=True)
+        assert closed == [] # Сессию Bot API закроет main() только после drain_in_flight
+
+        await insta.drain_in_flight(1)
+        assert processed == [7]
+        assert calls[:2] == [None, 8]
+
+    asyncio.run(scenario())
+
+
+def test_polling_skips_pending_updates(monkeypatch):
+    async def scenario():
+        calls = []
+
+        async def get_updates(offset=None, timeout=None, request_timeout=None):
+            calls.append(offset)
+            if offset == -1:
+                return [types.SimpleNamespace(update_id=41)]
+            await asyncio.Event().wait()
+
+        monkeypatch.setattr(insta.bot, 'get_updates', get_updates)
+        receiver = asyncio.create_task(insta.run_polling(timeout=1))
+        for _ in range(10):
+            await asyncio.sleep(0)
+        receiver.cancel()
+        await asyncio.gather(receiver, return_exceptions=True)
+        assert calls == [-1, 42]
+
+    asyncio.run(scenario())
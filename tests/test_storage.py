@@ -0,0 +1,161 @@
+import asyncio
+import os
+
+import pytest
+
+import insta
+
+
+def test_open_storage(monkeypatch):
+    monkeypatch.setattr(insta, 'file_id_cache', None)
+    monkeypatch.setattr(insta, 'job_queue', None)
+    monkeypatch.setattr(insta, 'JOB_QUEUE_ENABLED', False)
+    insta.open_storage()
+    assert isinstance(insta.file_id_cache, insta.FileIdCache)
+    assert insta.job_queue is None
+    insta.open_storage(worker=True)
+    assert isinstance(insta.job_queue, insta.JobQueue)
+
+
+def test_file_id_cache_ttl_and_limit(tmp_path):
+    async def scenario():
+        cache = insta.FileIdCache(str(tmp_path / 'cache.sqlite3'), ttl=60, max_entries=2)
+        await cache.put('a', 'file-a')
+        await cache.put('b', 'file-b')
+        assert await cache.get('a') == 'file-a' # a использован позже b
+        await cache.put('c', 'file-c') # Сверх лимита удаляется самая давно использованная запись
+        assert await cache.get('b') is None
+        assert await cache.get('c') == 'file-c'
+        await cache.delete('c')
+        assert await cache.get('c') is None
+        assert (cache.hits, cache.misses) == (2, 2)
+
+        cache.ttl = 0
+        await asyncio.sleep(0.01)
+        assert await cache.get('a') is None # Просрочен
+
+    asyncio.run(scenario())
+
+
+def _queue(tmp_path, **kwargs):
+    return insta.JobQueue(str(tmp_path / 'jobs.sqlite3'), **kwargs)
+
+
+def test_job_queue_round_robin_and_limit(tmp_path):
+    async def scenario():
+        queue = _queue(tmp_path, lease=60, per_user_limit=2)
+        await queue.enqueue(1, {'n': 'a1'})
+        await queue.enqueue(1, {'n': 'a2'})
+        with pytest.raises(insta.QueueFullError):
+            await queue.enqueue(1, {'n': 'a3'})
+        await queue.enqueue(2, {'n': 'b1'})
+        order = []
+        while True:
+            job, abandoned = await queue.claim('w')
+            assert abandoned == []
+            if job is None:
+                break
+            job_id, payload, attempt, _ = job
+            assert attempt == 1
+            order.append(payload['n'])
+            await queue.ack(job_id, 'w')
+        assert order == ['a1', 'b1', 'a2']
+        assert await queue.report() == "в очереди: 0, выполняется: 0"
+
+    asyncio.run(scenario())
+
+
+def test_job_queue_lease_expiry_and_abandon(tmp_path):
+    async def scenario():
+        queue = _queue(tmp_path, lease=0.01, max_attempts=2)
+        await queue.enqueue(1, {'n': 'a'})
+        (job_id, _, attempt, _), _ = await queue.claim('w1')
+        assert attempt == 1
+        await asyncio.sleep(0.02) # w1 упал - аренда истекла
+        assert not await queue.extend(job_id, 'w2')
+        (job_id, _, attempt, _), abandoned = await queue.claim('w2')
+        assert (attempt, abandoned) == (2, [])
+        assert not await queue.extend(job_id, 'w1') # Задачу уже отдали другому воркеру
+        assert await queue.extend(job_id, 'w2')
+        await queue.ack(job_id, 'w1') # Чужое подтверждение ничего не удаляет
+        await asyncio.sleep(0.02) # И w2 упал - попытки исчерпаны
+        job, abandoned = await queue.claim('w3')
+        assert job is None
+        assert abandoned == [{'n': 'a'}]
+
+    asyncio.run(scenario())
+
+
+def test_job_queue_release(tmp_path):
+    async def scenario():
+        queue = _queue(tmp_path, lease=60, max_attempts=2)
+        await queue.enqueue(1, {'n': 'a'})
+        (job_id, _, _, _), _ = await queue.claim('w')
+        assert await queue.release(job_id, 'w', count_attempt=False) is None # Остановка воркера
+        (job_id, _, attempt, _), _ = await queue.claim('w')
+        assert attempt == 1
+        assert await queue.release(job_id, 'w') is None # Ошибка: попытка засчитана
+        (job_id, _, attempt, _), _ = await queue.claim('w')
+        assert attempt == 2
+        assert await queue.release(job_id, 'w') == {'n': 'a'} # Попытки исчерпаны - задача удалена
+        assert await queue.claim('w') == (None, [])
+
+    asyncio.run(scenario())
+
+
+def test_line_set_store_reloads_when_file_changes(tmp_path):
+    path = tmp_path / 'users.txt'
+    path.write_text('alice\n\nbob\nalice\n')
+    store = insta.LineSetStore(str(path))
+    assert store.items() == ['alice', 'bob'] # Пустые строки и повторы не считаются
+    path.write_text('carol\n')
+    os.utime(path, ns=(0, 10 ** 9)) # Другое время модификации, даже если ФС его округляет
+    assert 'carol' in store
+    assert 'alice' not in store
+
+
+def test_line_set_store_does_not_reread_unchanged_file(tmp_path, monkeypatch):
+    path = tmp_path / 'users.txt'
+    path.write_text('alice\n')
+    store = insta.LineSetStore(str(path))
+    assert 'alice' in store
+    monkeypatch.setattr('builtins.open', None) # Любое чтение файла упадет
+    assert 'alice' in store
+    assert store.items() == ['alice']
+
+
+def test_line_set_store_append_adds_missing_newline(tmp_path):
+    path = tmp_path / 'access.txt'
+    path.write_text('alice') # Файл правили вручную, переноса в конце нет
+    store = insta.LineSetStore(str(path))
+    assert store.append('bob')
+    assert not store.append('bob')
+    assert path.read_text() == 'alice\nbob\n'
+    assert insta.LineSetStore(str(path)).items() == ['alice', 'bob']
+
+
+def test_line_set_store_remove_replaces_file_atomically(tmp_path, monkeypatch):
+    path = tmp_path / 'users.txt'
+    path.write_text('alice\nbob\ncarol\n')
+    store = insta.LineSetStore(str(path))
+    replaced = []
+    real_replace = os.replace
+
+    def replace(source, target):
+        assert open(source).read() == 'alice\ncarol\n' # Новое содержимое целиком во временном файле
+        assert path.read_text() == 'alice\nbob\ncarol\n' # Старый файл до замены не тронут
+        replaced.append((source, target))
+        real_replace(source, target)
+
+    monkeypatch.setattr(os, 'replace', replace)
+    assert store.remove('bob')
+    assert not store.remove('bob')
+    assert replaced == [(f"{path}.tmp", str(path))]
+    assert path.read_text() == 'alice\ncarol\n'
+    assert not os.path.exists(f"{path}.tmp")
+    assert store.items() == ['alice', 'carol']
+
+
+def test_display_user():
+    assert insta.display_user('123456789') == '123456789'
+    assert insta.display_user('someuser') == '@someuser'
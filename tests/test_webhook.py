@@ -0,0 +1,22 @@
+import asyncio
+
+from aiohttp.test_utils import TestClient, TestServer
+
+import insta
+
+
+async def _post(headers, data=b'{}'):
+    async with TestClient(TestServer(insta.make_webhook_app())) as client:
+        response = await client.post(insta.WEBHOOK_PATH, data=data, headers=headers)
+        return response.status
+
+
+def test_webhook_rejects_wrong_or_missing_secret():
+    assert asyncio.run(_post({})) == 403
+    assert asyncio.run(_post({'X-Telegram-Bot-Api-Secret-Token': insta.WEBHOOK_SECRET + 'x'})) == 403
+    assert asyncio.run(_post({'X-Telegram-Bot-Api-Secret-Token': 'кириллица'})) == 403
+
+
+def test_webhook_accepts_correct_secret():
+    headers = {'X-Telegram-Bot-Api-Secret-Token': insta.WEBHOOK_SECRET}
+    assert asyncio.run(_post(headers, data=b'not json')) == 400